@@ -8,6 +8,7 @@ import geemap
 import pandas as pd
 import ee 
 from area_change import AreaChange
+from county_index import load_county_index
 import joblib
 import nltk
 import sklearn
@@ -25,7 +26,7 @@ def plot(lat, lng, pa): #terrain
       'features':[{
           'type': 'Feature',
           'geometry': {
-            'type': 'Polygon',
+            'type': 'MultiPolygon',
             'coordinates': pa
           }
       }]
@@ -38,135 +39,19 @@ def plot(lat, lng, pa): #terrain
 
     return geo_source
 
-# Read in json data form text file and do work with it
-with open('NorthernCaliforniaCounties.txt') as f: #project_contents/app/NorthernCaliforniaCounties.txt
-    data = json.load(f)
-    county = "Sonoma" # Contra Costa (44x1) Glenn (1x1923x2) Yuba (1,4355,2)
-    num_counties = len(data["features"])
-    county_list = list()
-    county_coordinates_list = list()
+# Look up the county in the county index (built from the text file once and cached next to it)
+counties = load_county_index('NorthernCaliforniaCounties.txt') #project_contents/app/NorthernCaliforniaCounties.txt
+county = "Sonoma" # Contra Costa (44x1) Glenn (1x1923x2) Yuba (1,4355,2)
+county_list = counties.names
 
-    # Get list of counties
-    for i in range(num_counties):
-        county_list.append(data["features"][i]["properties"]["ADM2_NAME"])
+# Get coordinates for county
+county_coordinates_list = counties.multipolygon(county)
+lon_center, lat_center = counties.centroid(county)
+geo_json_results = plot(float(lat_center), float(lon_center), county_coordinates_list)
 
-    county_list.sort()
-
-    # Get coordinates for county
-    for i in range(num_counties):
-        if data["features"][i]["properties"]["ADM2_NAME"] == county:
-
-            if "coordinates" in data["features"][i]["geometry"]:
-
-                county_coordinates = np.array(data["features"][i]["geometry"]["coordinates"])
-
-                print("success, first level presence of coordinates:", county_coordinates.shape)
-                
-                if len(county_coordinates.shape) == 2:
-
-                    num_coordinates = county_coordinates.shape[0]
-                    transformed_coordinates = list()
-                    print("Number of coordinates:", num_coordinates)
-
-                    for i in range(num_coordinates):
-
-                        # Get the sub array of coordinates
-                        sub_coordinates = county_coordinates[i]
-
-                        transformed_coordinates.extend(sub_coordinates[0])
-
-                        print("Length of sub coordinates:", sub_coordinates.shape[0])
-
-                        #if i == 1:
-                        #    print(sub_coordinates[0])
-                        #    print("only 2 here")
-                        #    print(transformed_coordinates)
-                        print(i)
-
-                    print("length of transformed coordinates:", len(transformed_coordinates))
-                    wrapping_list = list()
-                    wrapping_list.append(transformed_coordinates)
-
-                    print("transformed length", len(wrapping_list))
-
-                    county_coordinates_array = np.asarray(transformed_coordinates)
-                    center_county = county_coordinates_array.mean(axis=0)
-                    lat_center = float(center_county[1])
-                    lon_center = float(center_county[0])
-                    geo_json_results = plot(lat_center, lon_center, transformed_coordinates)
-
-                    print(lat_center)
-                    print(lon_center)
-                    print(geo_json_results)
-
-                else:
-
-                    # Run plot command to generage geo_json data structure
-                    #print(county_coordinates_2)
-                    #print("untransformed length", len(transformed_coordinates))
-
-                    # Extract data directly into array and lists
-                    county_coordinates_list = data["features"][i]["geometry"]["coordinates"]
-                    county_coordinates_array = np.array(data["features"][i]["geometry"]["coordinates"])
-
-                    # Computer center of the county
-                    center_county = county_coordinates_array[0].mean(axis=0)
-                    lat_center = float(center_county[1])
-                    lon_center = float(center_county[0])
-
-                    geo_json_results = plot(lat_center, lon_center, county_coordinates_list)
-
-                    print(lat_center)
-                    print(lon_center)
-                    print(geo_json_results)
-
-            else:
-                print("failure, no first level coordinates")
-
-                county_coordinates = np.array(data["features"][i]["geometry"]["geometries"])
-                num_geometries = county_coordinates.shape[0]
-
-                # Enumerate through list of geometries
-                for i in range(num_geometries):
-                   # Get the sub array of coordinates and append to single growing list
-                   sub_coordinates = county_coordinates[i]["coordinates"]
-                   
-                   num_sub_coordinates = len(sub_coordinates[0])
-
-                   if num_sub_coordinates == 2:
-                       #print(sub_coordinates[0])
-                       #print(num_sub_coordinates)
-                       county_coordinates_list.extend(sub_coordinates)
-                   else:
-                       county_coordinates_list.extend(sub_coordinates[0])
-                   
-                   #for j in range(num_sub_coordinates):
-                   #    print(sub_coordinates[0][j])
-                   #    county_coordinates_list.extend(sub_coordinates[0][j])
-                     
-                # Conver list to array to compute center lat and lon
-                wrapping_list = list()
-                wrapping_list.append(county_coordinates_list)
-                county_coordinates_array = np.asarray(county_coordinates_list)
-
-                print(county_coordinates_array)
-
-                center_county = county_coordinates_array.mean(axis=0)
-                lat_center = float(center_county[1])
-                lon_center = float(center_county[0])
-
-                # Call plot function to create the Bokeh Google Map
-                geo_json_results = plot(lat_center, lon_center, wrapping_list)
-
-                print(lat_center)
-                print(lon_center)
-                print(geo_json_results)
-                
-
-    # Test pa
-    #pa = np.array([["-122.267", "37.875"], ["-122.266", "37.87"], ["-122.257", "37.87"], ["-122.259", "37.873"]])
-    #coordinates = [[[ pa[0][0], pa[0][1] ], [ pa[1][0], pa[1][1] ], [ pa[2][0], pa[2][1] ], [ pa[3][0], pa[3][1] ]]]
-    #print("type of pa", type(coordinates))
+print(lat_center)
+print(lon_center)
+print(geo_json_results)
 
 #print("setting geometry")
 #geometry =  transformed_coordinates
@@ -56,14 +56,74 @@ Annual GPP Estimate:  {'GPP_sum': 5702355.25882353}
 import math
 import geemap
 import pandas as pd
-
+import numpy as np
 import ee
 from datetime import datetime
+from dataclasses import dataclass
+from query_planner import QueryPlanner, nesting_depth
+import change_labels
+from geometry_pyramid import simplify_geometry, vertex_count
+from single_flight import coalesced, geometry_key
+from quota_scheduler import scheduler
 
 service_account = "calucapstone@ee-calucapstone.iam.gserviceaccount.com"
 credentials = ee.ServiceAccountCredentials(service_account, '/w210containermount/private-key.json')
 ee.Initialize(credentials)
 
+def ee_geometry(geo):
+    '''
+    An ee.Geometry for a list of [longitude, latitude] pairs (or of rings),
+    a Polygon, or for a list of polygons (e.g. a county), a MultiPolygon
+    '''
+    if nesting_depth(geo) == 4:
+        return ee.Geometry.MultiPolygon(geo)
+    return ee.Geometry.Polygon(geo)
+
+
+def as_multipolygon(geo):
+    '''
+    MultiPolygon coordinates of a list of [longitude, latitude] pairs, a
+    list of rings or MultiPolygon coordinates
+    '''
+    depth = nesting_depth(geo)
+    if depth == 2:
+        return [[geo]]
+    if depth == 3:
+        return [geo]
+    return geo
+
+
+def bounding_box(geometries):
+    '''
+    Rectangle (list of [longitude, latitude] pairs) around all the
+    geometries
+    '''
+    points = np.concatenate([np.asarray(ring, dtype='float64').reshape(-1, 2)
+                             for geometry in geometries for polygon in as_multipolygon(geometry) for ring in polygon])
+    (min_x, min_y), (max_x, max_y) = points.min(axis=0).tolist(), points.max(axis=0).tolist()
+    return [[min_x, min_y], [max_x, min_y], [max_x, max_y], [min_x, max_y]]
+
+
+@dataclass
+class ChangeStatistics:
+    """
+    Result of AreaChange.get_change_statistics.
+
+    area_by_class: {change label: area in meters^2}, labels 1-10 as in
+                   get_area_of_change (0, no change, is left out)
+    changed_pixels: number of pixels with a change label
+    total_pixels: number of pixels in the area
+    percentage: changed_pixels / total_pixels * 100
+    scale: effective pixel size in meters, derived from the total area
+           and pixel count (see QueryPlanner for how the scale is picked)
+    """
+    area_by_class: dict
+    changed_pixels: int
+    total_pixels: int
+    percentage: float
+    scale: float
+
+
 class AreaChange:
     #  an ee.Image with 1 band. That band has integer values
     #  between 0 and 10 representing the change in land class.
@@ -74,63 +134,64 @@ class AreaChange:
 
     # constants
     MIN_PIXEL_SCALE_METERS = 10
-    NODATA_VALUE = -1
-    DYNAMIC_WORLD_COLUMNS = ['water',
-                             'trees',
-                             'grass',
-                             'flooded_vegetation',
-                             'crops',
-                             'shrub_and_scrub',
-                             'built',
-                             'bare',
-                             'snow_and_ice']
-
-    # BIG_LABELS: imagine a pixel in a dynamic world image has
-    # land class label X at time A and label Y at time B. We can
-    # detect the change by multiplying the label at time A by 100
-    # and adding the label at time A and time B together. If we
-    # were to do that, we'd get the following possible values:
-    BIG_LABELS = ee.List(
-        [0, 1, 2, 3, 4, 5, 6, 7, 8,
-         100, 101, 102, 103, 104, 105, 106, 107, 108,
-         200, 201, 202, 203, 204, 205, 206, 207, 208,
-         300, 301, 302, 303, 304, 305, 306, 307, 308,
-         400, 401, 402, 403, 404, 405, 406, 407, 408,
-         500, 501, 502, 503, 504, 505, 506, 507, 508,
-         600, 601, 602, 603, 604, 605, 606, 607, 608,
-         700, 701, 702, 703, 704, 705, 706, 707, 708,
-         800, 801, 802, 803, 804, 805, 806, 807, 808])
-
-    # ADJUSTED_LABELS: We don't care about most of the possible
-    # changes. For example, if water stayed water....we don't care.
-    # However, we do care if grass went to built or if built turned into
-    # grass. So we set most of the list to 0 and we remap changes we care
-    # to new labels. So now 1 represents trees that are now considered built.
-
-    # See:
-    # https://docs.google.com/spreadsheets/d/1jRIu3ly6NOzFR9X5of_NDq2ZfgFpiM5AL9LdtuzXDiw/edit?usp=sharing
-    ADJUSTED_LABELS = ee.List(
-        [0, 0, 0, 0, 0, 0, 0, 0, 0,
-         0, 0, 0, 0, 0, 0, 1, 1, 0,
-         0, 0, 0, 0, 0, 0, 2, 2, 0,
-         0, 0, 0, 0, 0, 0, 3, 3, 0,
-         0, 0, 0, 0, 0, 0, 4, 4, 0,
-         0, 0, 0, 0, 0, 0, 5, 5, 0,
-         0, 6, 7, 8, 9, 10, 0, 0, 0,
-         0, 6, 7, 8, 9, 10, 0, 0, 0,
-         0, 0, 0, 0, 0, 0, 0, 0, 0])
-
-    def __init__(self, geo, year):
+    # polygons are simplified before they are sent to Earth Engine. Half
+    # the finest pixel, the boundary moves less than the pixels it covers.
+    GEOMETRY_TOLERANCE_METERS = 5
+    # get_area_of_change_by_parcel sends at most this many parcels (and
+    # vertices) per request, a bigger collection is split into chunks
+    MAX_PARCELS_PER_REQUEST = 500
+    MAX_VERTICES_PER_REQUEST = 100000
+    # get_change_raster downloads rasters in tiles of at most this many
+    # pixels a side, each tile is one computePixels request
+    RASTER_TILE_PIXELS = 1024
+    # days of Dynamic World averaged by get_annual_change_image
+    # (Sep-Dec of year-1 and Jan-Mar of year+1)
+    CHANGE_WINDOW_DAYS = 182
+    NODATA_VALUE = change_labels.NODATA_VALUE
+    DYNAMIC_WORLD_COLUMNS = change_labels.DYNAMIC_WORLD_COLUMNS
+
+    # label_A * 100 + label_B of a pixel and the change label it maps to,
+    # see change_labels.py
+    BIG_LABELS = ee.List(change_labels.BIG_LABELS)
+    ADJUSTED_LABELS = ee.List(change_labels.ADJUSTED_LABELS)
+
+    def __init__(self, geo, year, token=None):
         if isinstance(geo, list):
-            # an ee.Geometry.Polygon representing the area to analyse
-            self.geo = ee.Geometry.Polygon(geo)
+            # fewer vertices make smaller request graphs (see geometry_pyramid.py)
+            geo = simplify_geometry(geo, self.GEOMETRY_TOLERANCE_METERS)
+
+            # an ee.Geometry representing the area to analyse
+            self.geo = ee_geometry(geo)
         else:
             self.geo = geo
 
         # the year to analyze.
         self.year = year
 
+        # identifies the polygon when concurrent identical requests are
+        # coalesced across sessions (see single_flight.py)
+        self.geometry_key = geometry_key(geo)
+
+        # picks scale and tileScale per request from the polygon size. The
+        # plan each request actually ran with is kept in self.plans so the
+        # effective resolution can be reported with the results.
+        self.planner = QueryPlanner(geo if isinstance(geo, list) else None)
+        self.plans = {}
+
+        # optional CancellationToken (see cancellation.py). It is checked
+        # before every request and between export pages.
+        self.token = token
+
+    def checkpoint(self):
+        '''
+        Raises AnalysisCancelled if the analysis was cancelled or
+        superseded. Called before every request to Earth Engine.
+        '''
+        if self.token is not None:
+            self.token.raise_if_cancelled()
 
+
+    @coalesced
     def get_area_of_change(self):
         '''
         This method computes the area (meters^2) of change in
@@ -176,23 +237,170 @@ class AreaChange:
         self.change = self.change.addBands(pixelArea)
 
         # group pixels by label and compute the sum of the area
-        label_stats = self.change.reduceRegion(
-            reducer=ee.Reducer.sum().unweighted().group(
-                groupField=0,
-                groupName='change'
-            ),
-            geometry=self.geo,
-            scale=self.MIN_PIXEL_SCALE_METERS,
-            tileScale=16,
-            crs='EPSG:32610',
-            maxPixels=1e9,
-            bestEffort=True
-        )
+        def request(plan):
+            self.checkpoint()
+            label_stats = self.change.reduceRegion(
+                reducer=ee.Reducer.sum().unweighted().group(
+                    groupField=0,
+                    groupName='change'
+                ),
+                geometry=self.geo,
+                scale=plan.scale,
+                tileScale=plan.tile_scale,
+                crs='EPSG:32610',
+                maxPixels=1e9
+            )
+
+            # extract the list of dictionaries
+            groups = ee.List(label_stats.get('groups'))
+            return scheduler.call(groups.getInfo)
+
+        groups, self.plans['area_of_change'] = self.planner.run(request, self.plan_change_request())
+        return groups
+
+    @coalesced
+    def get_change_statistics(self):
+        '''
+        Computes everything get_area_of_change and get_pixel_count
+        report with a single reduceRegion and a single getInfo: the change
+        label is unmasked to 0 and the pixel area is summed and the pixels
+        counted for each label in one grouped reducer.
+
+        Returns:
+            ChangeStatistics
+        '''
+        self.get_annual_change_image()
+
+        stats_image = (ee.Image.pixelArea().rename('area')
+                       .addBands(self.change.unmask(0).rename('change')))
+        reducer = (ee.Reducer.sum().unweighted()
+                   .combine(ee.Reducer.count(), sharedInputs=True)
+                   .group(groupField=1, groupName='change'))
+
+        def request(plan):
+            self.checkpoint()
+            label_stats = stats_image.reduceRegion(
+                reducer=reducer,
+                geometry=self.geo,
+                scale=plan.scale,
+                tileScale=plan.tile_scale,
+                crs='EPSG:32610',
+                maxPixels=1e9
+            )
+            return scheduler.call(ee.List(label_stats.get('groups')).getInfo) or []
+
+        groups, self.plans['change_statistics'] = self.planner.run(request, self.plan_change_request())
+
+        area_by_class = {int(g['change']): g['sum'] for g in groups if int(g['change']) != 0}
+        changed_pixels = sum(int(g['count']) for g in groups if int(g['change']) != 0)
+        total_pixels = sum(int(g['count']) for g in groups)
+        total_area = sum(g['sum'] for g in groups)
+        return ChangeStatistics(
+            area_by_class=area_by_class,
+            changed_pixels=changed_pixels,
+            total_pixels=total_pixels,
+            percentage=changed_pixels / total_pixels * 100 if total_pixels else 0.0,
+            scale=math.sqrt(total_area / total_pixels) if total_pixels else float(self.MIN_PIXEL_SCALE_METERS))
+
+    @classmethod
+    def for_parcels(cls, parcels, year, token=None):
+        '''
+        An AreaChange over the bounding box of many parcels, to get the
+        change of all of them with get_area_of_change_by_parcel
+
+        Arguments:
+            parcels: {parcel id: list of [longitude, latitude] pairs, list
+                     of rings or MultiPolygon coordinates}
+        '''
+        return cls(bounding_box(list(parcels.values())), year, token=token)
+
+    def get_area_of_change_by_parcel(self, parcels):
+        '''
+        get_area_of_change for many parcels: the change image is built once
+        over this AreaChange's area (see for_parcels) and reduced over a
+        FeatureCollection of the parcels with a grouped reduceRegions, so a
+        chunk of parcels costs one getInfo instead of one per parcel.
+        Collections bigger than MAX_PARCELS_PER_REQUEST parcels or
+        MAX_VERTICES_PER_REQUEST vertices are split into chunks.
 
-        # extract the list of dictionaries
-        groups = ee.List(label_stats.get('groups'))
-        return groups.getInfo()
+        Arguments:
+            parcels: {parcel id: list of [longitude, latitude] pairs, list
+                     of rings or MultiPolygon coordinates}
+
+        Returns:
+            {parcel id: [{'change': 1, 'sum': 7871904.116004944}, ...]}, the
+            list get_area_of_change returns for each parcel (empty when
+            nothing changed)
+        '''
+        self.get_annual_change_image()
+        change_area = self.change.addBands(ee.Image.pixelArea().rename('area'))
+        reducer = ee.Reducer.sum().unweighted().group(groupField=0, groupName='change')
+
+        simplified = {str(parcel_id): simplify_geometry(geometry, self.GEOMETRY_TOLERANCE_METERS)
+                      for parcel_id, geometry in parcels.items()}
+        names = {str(parcel_id): parcel_id for parcel_id in parcels}
+
+        results = {}
+        self.plans['area_of_change_by_parcel'] = []
+        for chunk in self.parcel_chunks(simplified):
+            collection = ee.FeatureCollection([ee.Feature(ee_geometry(simplified[parcel_id]), {'parcel': parcel_id})
+                                               for parcel_id in chunk])
+            planner = QueryPlanner([polygon for parcel_id in chunk for polygon in as_multipolygon(simplified[parcel_id])])
+
+            def request(plan):
+                self.checkpoint()
+                reduced = change_area.reduceRegions(
+                    collection=collection,
+                    reducer=reducer,
+                    scale=plan.scale,
+                    tileScale=plan.tile_scale,
+                    crs='EPSG:32610'
+                )
+                # only the properties come back, not the parcel geometries
+                return scheduler.call(reduced.select(['parcel', 'groups'], None, False).getInfo)
+
+            reduced, plan = planner.run(request, self.plan_change_request(planner))
+            self.plans['area_of_change_by_parcel'].append(plan)
+            for feature in reduced['features']:
+                properties = feature['properties']
+                results[names[properties['parcel']]] = properties.get('groups') or []
+        return results
+
+    def parcel_chunks(self, parcels):
+        '''
+        Splits {parcel id: coordinates} into lists of parcel ids within
+        MAX_PARCELS_PER_REQUEST and MAX_VERTICES_PER_REQUEST
+        '''
+        chunks = []
+        chunk, vertices = [], 0
+        for parcel_id, geometry in parcels.items():
+            count = vertex_count(geometry)
+            if chunk and (len(chunk) >= self.MAX_PARCELS_PER_REQUEST or vertices + count > self.MAX_VERTICES_PER_REQUEST):
+                chunks.append(chunk)
+                chunk, vertices = [], 0
+            chunk.append(parcel_id)
+            vertices += count
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def plan_change_request(self, planner=None):
+        '''
+        Plan for reducing the change image: every Dynamic World band of
+        every image in the change window, plus the pixel area.
+        '''
+        planner = planner or self.planner
+        images = planner.images('dynamic_world', self.CHANGE_WINDOW_DAYS)
+        return planner.plan(bands=len(self.DYNAMIC_WORLD_COLUMNS) + 1, images=images,
+                            min_scale=self.MIN_PIXEL_SCALE_METERS)
 
+    def effective_resolution(self):
+        '''
+        Scale (meters) each request ran at, e.g. {'area_of_change': 10}
+        '''
+        return {name: plan.scale for name, plan in self.plans.items()}
+
+    @coalesced
     def get_change_that_might_occur(self):
         dwCol = (ee.ImageCollection('GOOGLE/DYNAMICWORLD/V1')
                     .filterBounds(self.geo)
@@ -212,6 +420,7 @@ class AreaChange:
         return self.get_climate_data_for_change_and_join()
 
 
+    @coalesced
     def get_change_that_occurred(self):
         self.get_annual_change_image()
         return self.get_climate_data_for_change_and_join()
@@ -226,6 +435,7 @@ class AreaChange:
             pandas DataFrame
         """
 
+        self.checkpoint()
         start_date = str(self.year - 1) + '-12-01'
         end_date = str(self.year) + '-11-30'
 
@@ -297,6 +507,12 @@ class AreaChange:
 
         DWJoined = DWJoined.map(flatten_join_dw)
 
+        # one sample per 8 day GRIDMET image with every band joined to it.
+        # Never finer than the 50m we have always sampled at.
+        self.plans['sample'] = self.planner.plan(
+            bands=len(self.DYNAMIC_WORLD_COLUMNS) + 10,
+            images=self.planner.images('gridmet_8_day', 365),
+            min_scale=50)
         final_result = ee.FeatureCollection(DWJoined.map(self.convert_to_fc_10m).flatten())
         return self.convert_fc_to_dataframe(final_result, [ 'change', 
                                     'elevation',
@@ -375,6 +591,47 @@ class AreaChange:
         self.change_mask = change.neq(0)
         self.change = change.updateMask(self.change_mask)
 
+    def get_change_raster(self, bounds, scale=MIN_PIXEL_SCALE_METERS):
+        '''
+        Downloads the change labels of get_annual_change_image as an array,
+        on a longitude/latitude grid of about scale meters over bounds, so
+        the change can be aggregated locally (see change_index.py).
+
+        Arguments:
+            bounds: (west, south, east, north) in degrees
+            scale: pixel size (meters) at the center of bounds
+
+        Returns:
+            (uint8 array of labels 0-10, rows north to south, 0 where
+             nothing changed, (west, north, pixel width, pixel height) in
+             degrees)
+        '''
+        self.get_annual_change_image()
+        labels = self.change.select('change').unmask(0).toByte()
+
+        west, south, east, north = bounds
+        lat_0 = math.radians((south + north) / 2)
+        dy = scale / (111132.954 - 559.822 * math.cos(2 * lat_0))
+        dx = scale / (111319.488 * math.cos(lat_0))
+        width = max(1, math.ceil((east - west) / dx))
+        height = max(1, math.ceil((north - south) / dy))
+
+        raster = np.zeros((height, width), dtype='uint8')
+        for row in range(0, height, self.RASTER_TILE_PIXELS):
+            for column in range(0, width, self.RASTER_TILE_PIXELS):
+                self.checkpoint()
+                rows = min(self.RASTER_TILE_PIXELS, height - row)
+                columns = min(self.RASTER_TILE_PIXELS, width - column)
+                request = {'expression': labels,
+                           'fileFormat': 'NUMPY_NDARRAY',
+                           'grid': {'dimensions': {'width': columns, 'height': rows},
+                                    'affineTransform': {'scaleX': dx, 'shearX': 0, 'translateX': west + column * dx,
+                                                        'shearY': 0, 'scaleY': -dy, 'translateY': north - row * dy},
+                                    'crsCode': 'EPSG:4326'}}
+                tile = scheduler.call(ee.data.computePixels, request)
+                raster[row:row + rows, column:column + columns] = tile['change']
+        return raster, (west, north, dx, dy)
+
 
     def get_daily_gridmet_for_change(self, start_date, end_date):
         '''
@@ -604,9 +861,11 @@ class AreaChange:
         export_number = 0
         while(True):
             print("Export Number: ", export_number)
+            # checked outside the try, the bare except below ends the export
+            self.checkpoint()
             try:
                 subset = ee.FeatureCollection(fc.toList(5000, export_number * 5000))
-                df = geemap.ee_to_pandas(subset)
+                df = scheduler.call(geemap.ee_to_pandas, subset)
                 exports.append(df)
                 export_number+=1
             except:
@@ -633,13 +892,14 @@ class AreaChange:
         '''
         pixelLatLngImg = ee.Image.pixelLonLat()
         added_lat_lng = ee.Image(img).addBands(pixelLatLngImg)
+        plan = self.plans.get('sample') or self.planner.plan(bands=1, images=1, min_scale=50)
         feature_collection = added_lat_lng.sample(
             region=self.geo,
             numPixels=1e9,
             geometries=True,
-            scale=50,
+            scale=plan.scale,
             projection='EPSG:4326',
-            tileScale=16
+            tileScale=plan.tile_scale
         )
 
         return feature_collection
@@ -649,38 +909,48 @@ class AreaChange:
         """
         Gets pixel statistics about the change that occurred. 
         Ex. What percentage of the area had vegetation change?
-        """
-        pixel_count = (self.change.select(band).reduceRegion(
-        reducer= ee.Reducer.count(),
-        geometry= self.geo,
-        scale= 10,
-        tileScale=16,
-        maxPixels= 1e9, bestEffort=True).get(band))
-
-        all_pixels = (self.change.select(band).unmask().reduceRegion(
-        reducer= ee.Reducer.count(),
-        geometry= self.geo,
-        scale= 10,
-                tileScale=16,
-
-        maxPixels= 1e9, bestEffort=True).get(band))
-
-        ratio = ee.Number(pixel_count).divide(all_pixels).multiply(100)
-        print("Number of unmasked pixels: ", pixel_count.getInfo())
-        print("Total nuber of pixels in the area: ", all_pixels.getInfo())
-        print("Percentage: ", ratio.getInfo())
-
 
+        The masked and unmasked band are counted in one reduceRegion
+        (count is applied to each band with its own mask) and the ratio
+        is computed server side, so this is a single getInfo.
+        """
+        def request(plan):
+            self.checkpoint()
+            counts = (self.change.select(band)
+                      .addBands(self.change.select(band).unmask().rename('all_pixels'))
+                      .reduceRegion(
+                          reducer= ee.Reducer.count(),
+                          geometry= self.geo,
+                          scale= plan.scale,
+                          tileScale=plan.tile_scale,
+                          maxPixels= 1e9))
+
+            pixel_count = ee.Number(counts.get(band))
+            all_pixels = ee.Number(counts.get('all_pixels'))
+            ratio = pixel_count.divide(all_pixels).multiply(100)
+            return scheduler.call(ee.Dictionary({'pixel_count': pixel_count, 'all_pixels': all_pixels, 'ratio': ratio}).getInfo)
+
+        result, self.plans['pixel_count'] = self.planner.run(request, self.plan_change_request())
+        result['scale'] = self.plans['pixel_count'].scale
+        print("Number of unmasked pixels: ", result['pixel_count'])
+        print("Total nuber of pixels in the area: ", result['all_pixels'])
+        print("Percentage: ", result['ratio'])
+        return result
+
+
+    @coalesced
     def is_area_within_limits(self):
         """
         Checks if the input geometry is too big
         """
-        area = self.geo.area().getInfo()
+        self.checkpoint()
+        area = scheduler.call(self.geo.area().getInfo)
         if  area > 1000000:
             return False
         return True
             
 
+    @coalesced
     def mod17_estimate(self):
         """
         Returns GPP kg*C/m^2/year
@@ -689,8 +959,16 @@ class AreaChange:
                             .filter(ee.Filter.calendarRange(self.year, self.year, 'year'))
                             .select("GPP"))
         reduced  = gpp_col.reduce(ee.Reducer.sum())
-        reducedRegion = reduced.reduceRegion(geometry=self.geo, reducer=ee.Reducer.sum(), scale=30)
-        return reducedRegion.getInfo()
+
+        def request(plan):
+            self.checkpoint()
+            reducedRegion = reduced.reduceRegion(geometry=self.geo, reducer=ee.Reducer.sum(),
+                                                 scale=plan.scale, tileScale=plan.tile_scale)
+            return scheduler.call(reducedRegion.getInfo)
+
+        plan = self.planner.plan(bands=1, images=self.planner.images('landsat_gpp', 365), min_scale=30)
+        result, self.plans['mod17'] = self.planner.run(request, plan)
+        return result
 
 
 
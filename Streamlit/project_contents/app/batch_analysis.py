@@ -0,0 +1,209 @@
+'''
+Headless carbon analysis of many polygons (e.g. a portfolio of parcels),
+without the Streamlit page.
+
+Polygons are read from a GeoJSON FeatureCollection (Polygon and
+MultiPolygon features) or a CSV with an id column and a geometry column
+(GeoJSON geometry or coordinates). Every polygon is analysed for every year
+of the range like gpp_analysis.run_analysis does for a site: vegetation
+change from AreaChange and GPP from the model (through the inference
+service).
+
+Each finished polygon and year is appended to a JSON lines results file
+right away, so an interrupted run started again with the same results file
+skips everything already done and retries what failed. Polygon-years run
+on a pool of threads in the batch lane of the Earth Engine scheduler, so a
+batch running on the app's machine doesn't delay the interactive pages.
+
+Usage (from the Streamlit folder, like the app):
+    python project_contents/app/batch_analysis.py parcels.geojson results.jsonl --workers 8
+    python project_contents/app/batch_analysis.py parcels.csv results.jsonl --start-year 2019 --end-year 2021 --csv results.csv --model GPP_boost_mod.pkl
+'''
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+from gpp_analysis import MODEL_PATH, VEGETATION_TYPES, YEARS, AreaTooLarge, predict_gpp, sum_vegetation_change
+from inference_service import get_inference_service
+from quota_scheduler import scheduler, BATCH
+
+DONE = 'done'
+FAILED = 'failed'
+# seconds between progress lines
+REPORT_SECONDS = 30
+
+
+def read_polygons(path, id_field='id', geometry_field='geometry'):
+    '''
+    {polygon id: Polygon or MultiPolygon coordinates} from a GeoJSON or CSV
+    file. Features without the id field are numbered in file order. Raises
+    ValueError when two features have the same id, results are recorded by
+    id.
+    '''
+    polygons = {}
+
+    def add(polygon_id, geometry):
+        if polygon_id in polygons:
+            raise ValueError(f'{path} has more than one polygon with {id_field} {polygon_id!r}')
+        polygons[polygon_id] = geometry_coordinates(geometry)
+
+    if path.lower().endswith('.csv'):
+        with open(path, newline='') as f:
+            for i, row in enumerate(csv.DictReader(f)):
+                add(row.get(id_field) or str(i), json.loads(row[geometry_field]))
+        return polygons
+
+    with open(path) as f:
+        collection = json.load(f)
+    features = collection['features'] if collection.get('type') == 'FeatureCollection' else [collection]
+    for i, feature in enumerate(features):
+        properties = feature.get('properties') or {}
+        add(str(properties.get(id_field, feature.get('id', i))), feature['geometry'])
+    return polygons
+
+
+def geometry_coordinates(geometry):
+    '''
+    Coordinates of a GeoJSON Polygon or MultiPolygon geometry (coordinates
+    are passed through)
+    '''
+    if isinstance(geometry, dict):
+        if geometry.get('type') not in ('Polygon', 'MultiPolygon'):
+            raise ValueError(f"unsupported geometry type {geometry.get('type')}, expected Polygon or MultiPolygon")
+        return geometry['coordinates']
+    return geometry
+
+
+def read_results(path):
+    '''
+    {(polygon id, year): record} of a results file, the last record of a
+    polygon and year wins. A line cut short by an interruption is skipped.
+    '''
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            results[(record['id'], record['year'])] = record
+    return results
+
+
+def analyse_polygon(geometry, year, service):
+    '''
+    Vegetation change and GPP of one polygon and year
+    '''
+    # imported here so reading and summarising results doesn't log in to Earth Engine
+    from area_change import AreaChange # Custom module for GEE calls
+
+    with scheduler.lane(BATCH):
+        ac = AreaChange(geometry, year)
+        if ac.is_area_within_limits() == False:
+            raise AreaTooLarge('Area is too large for Google Earth Engine API processing.')
+        land_change = sum_vegetation_change(year, ac.get_area_of_change())
+        gpp = predict_gpp(ac.get_change_that_might_occur(), service)
+    return land_change, float(gpp)
+
+
+def run_batch(polygons, results_path, years=YEARS, workers=4, model_path=MODEL_PATH):
+    '''
+    Analyses every polygon and year not done in the results file yet,
+    appending a record for each as it finishes. Returns (done, failed).
+    '''
+    finished = read_results(results_path)
+    todo = [(polygon_id, year) for polygon_id in polygons for year in years
+            if finished.get((polygon_id, year), {}).get('status') != DONE]
+    print(f'{len(polygons)} polygons x {len(years)} years, {len(polygons) * len(years) - len(todo)} already done, {len(todo)} to run')
+    if len(todo) == 0:
+        return 0, 0
+
+    service = get_inference_service(model_path)
+    started = time.time()
+    reported = started
+    done = failed = 0
+    with open(results_path, 'a') as results, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyse_polygon, polygons[polygon_id], year, service): (polygon_id, year)
+                   for polygon_id, year in todo}
+        try:
+            for future in as_completed(futures):
+                polygon_id, year = futures[future]
+                record = {'id': polygon_id, 'year': year, 'finished': time.time()}
+                try:
+                    land_change, gpp = future.result()
+                    record.update(status=DONE, land_change=land_change, gpp=gpp)
+                    done += 1
+                except Exception as e:
+                    record.update(status=FAILED, error=str(e))
+                    failed += 1
+                    print(f'{polygon_id} {year} failed: {e}')
+                # checkpoint: on disk before the next one is counted
+                results.write(json.dumps(record) + '\n')
+                results.flush()
+                os.fsync(results.fileno())
+
+                now = time.time()
+                if now - reported >= REPORT_SECONDS or done + failed == len(todo):
+                    reported = now
+                    print_progress(done, failed, len(todo), now - started)
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            print('Interrupted, run again with the same results file to resume')
+            raise
+    return done, failed
+
+
+def print_progress(done, failed, total, elapsed):
+    rate = (done + failed) / elapsed if elapsed > 0 else 0.0
+    eta = (total - done - failed) / rate if rate > 0 else float('nan')
+    ee_stats = scheduler.stats()
+    batch_lane = ee_stats['lanes'][BATCH]
+    print(f'{done + failed}/{total} polygon-years ({failed} failed), {rate * 3600:.0f}/hour, '
+          f'{eta / 60:.1f} min left, Earth Engine: {batch_lane["served"]} requests, '
+          f'mean wait {batch_lane["mean_wait"]:.2f}s, {ee_stats["rate_limited"]} rate limited')
+
+
+def results_table(results_path):
+    '''
+    One row per polygon and year done: vegetation change and GPP
+    '''
+    rows = []
+    for (polygon_id, year), record in sorted(read_results(results_path).items()):
+        if record['status'] == DONE:
+            row = {'id': polygon_id}
+            row.update(record['land_change'])
+            row['GPP'] = record['gpp']
+            rows.append(row)
+    return pd.DataFrame(rows, columns=['id', 'Year'] + VEGETATION_TYPES + ['GPP'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Carbon analysis of the polygons of a GeoJSON or CSV file')
+    parser.add_argument('polygons', help='GeoJSON FeatureCollection or CSV with id and geometry columns')
+    parser.add_argument('results', help='JSON lines results file, resumed when it exists')
+    parser.add_argument('--start-year', type=int, default=YEARS[0])
+    parser.add_argument('--end-year', type=int, default=YEARS[-1])
+    parser.add_argument('--workers', type=int, default=4, help='polygon-years analysed at once')
+    parser.add_argument('--id-field', default='id', help='feature property or CSV column with the polygon id')
+    parser.add_argument('--geometry-field', default='geometry', help='CSV column with the geometry')
+    parser.add_argument('--csv', help='also write the results as a table to this CSV file')
+    parser.add_argument('--model', default=MODEL_PATH)
+    args = parser.parse_args()
+
+    polygons = read_polygons(args.polygons, args.id_field, args.geometry_field)
+    years = list(range(args.start_year, args.end_year + 1))
+    done, failed = run_batch(polygons, args.results, years, args.workers, args.model)
+    print(f'{done} done, {failed} failed')
+
+    if args.csv:
+        results_table(args.results).to_csv(args.csv, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+'''
+The change detection of AreaChange.get_annual_change_image and
+get_area_of_change in NumPy, for Dynamic World probabilities that were
+downloaded or cached instead of living in Earth Engine.
+
+Each of the two periods is a stack of Dynamic World images: the
+probabilities of the bands of change_labels.DYNAMIC_WORLD_COLUMNS are
+averaged over the images (NaN where an image has no data), the pixels
+without any data get NODATA_VALUE in every band like unmask does, and the
+label of each pixel is the band with the highest mean. The change label
+is then looked up in the 9x9 transition table of change_labels (the remap
+of label_A * 100 + label_B from BIG_LABELS to ADJUSTED_LABELS).
+
+The rasters are on a longitude/latitude grid, so every pixel of a row has
+the same geodesic area and the area of each change label is a per-row
+pixel count times the row's area. Rows are processed in chunks of about
+CHUNK_PIXELS pixels over all the images of a stack, and the images of a
+chunk are summed one at a time in float32, so a chunk stays in the CPU
+caches and a county-sized (or memory-mapped) raster never has to be loaded
+whole.
+
+The cost grows with pixels times images. On one core, a county-sized
+6000x6000 raster takes a few seconds from one image (a composite) per
+period, but a window of 40 images per period is 2.9 billion pixel-images,
+about 35 seconds at the roughly 80 million pixel-images a second of the
+summing. The seconds are for composites: average a window once with
+composite() (like the mean get_annual_change_image takes in Earth Engine),
+keep it, and detect the change between composites.
+
+# Sample Usage
+
+-------------
+# before, after: (images, 9, rows, columns) float arrays, NaN where masked
+change = detect_change(before, after)
+print(area_of_change(before, after, north=41.2, dx=9e-5, dy=9e-5))
+# the same change from composites kept between runs
+change = detect_change(composite(before), composite(after))
+'''
+import math
+import numpy as np
+from change_labels import DYNAMIC_WORLD_COLUMNS, NODATA_VALUE, transition_table
+
+# pixels of all the images of a stack per chunk, rows are processed a
+# chunk at a time
+CHUNK_PIXELS = 2 ** 18
+# change labels 0-10, see AreaChange.get_area_of_change
+CHANGE_LABELS = 11
+TRANSITIONS = transition_table()
+
+# WGS84
+SEMI_MAJOR_AXIS = 6378137.0
+FLATTENING = 1 / 298.257223563
+
+
+def row_areas_m2(north, dx, dy, rows):
+    '''
+    Geodesic area (meters^2, WGS84 ellipsoid) of one pixel of every row of
+    a longitude/latitude grid
+
+    Arguments:
+        north: latitude of the top edge of the first row (degrees)
+        dx, dy: pixel width and height (degrees)
+        rows: number of rows
+    '''
+    e2 = FLATTENING * (2 - FLATTENING)
+    e = math.sqrt(e2)
+    b2 = SEMI_MAJOR_AXIS ** 2 * (1 - e2)
+    edges = np.radians(north - dy * np.arange(rows + 1))
+    sin = np.sin(edges)
+    # integral of the ellipsoid's area element over latitude
+    q = sin / (1 - e2 * sin ** 2) + np.log((1 + e * sin) / (1 - e * sin)) / (2 * e)
+    return b2 * math.radians(dx) / 2 * (q[:-1] - q[1:])
+
+
+def _as_stack(stack):
+    stack = np.asarray(stack) if not isinstance(stack, np.ndarray) else stack
+    # a single image (or a mean already taken)
+    if stack.ndim == 3:
+        stack = stack[None]
+    if stack.ndim != 4 or stack.shape[1] != len(DYNAMIC_WORLD_COLUMNS):
+        raise ValueError(f'expected (images, {len(DYNAMIC_WORLD_COLUMNS)}, rows, columns) probabilities, got shape {stack.shape}')
+    return stack
+
+
+def argmax_labels(stack):
+    '''
+    Dynamic World label (0-8) of every pixel of a stack: the band with the
+    highest mean probability over the images, 0 where no image has data
+
+    Arguments:
+        stack: (images, 9, rows, columns) or (9, rows, columns) array, NaN
+               where an image is masked
+    '''
+    # bands without data are unmasked to NODATA_VALUE, and like arrayArgmax
+    # ties go to the first band
+    return _band_means(_as_stack(stack), NODATA_VALUE).argmax(axis=0).astype('uint8')
+
+
+def _band_means(stack, fill):
+    '''
+    (9, rows, columns) float32 mean of every band over the images, fill
+    where no image has data
+    '''
+    if len(stack) == 1:
+        image = stack[0]
+        return np.where(np.isnan(image), np.float32(fill), image).astype('float32', copy=False)
+    # summed in place one image at a time, a mask or copy of the whole
+    # stack would take (images x) the memory of the chunk
+    means = np.zeros(stack.shape[1:], dtype='float32')
+    counts = np.zeros(stack.shape[1:], dtype='int32')
+    valid = np.empty(stack.shape[1:], dtype=bool)
+    for image in stack:
+        np.equal(image, image, out=valid)
+        np.add(means, image, out=means, where=valid)
+        counts += valid
+    np.divide(means, counts, out=means, where=counts > 0)
+    means[counts == 0] = fill
+    return means
+
+
+def composite(stack, chunk_pixels=CHUNK_PIXELS):
+    '''
+    (9, rows, columns) float32 mean of a stack over its images, NaN where
+    no image has data: one image that detect_change and area_of_change take
+    in place of the stack
+    '''
+    stack = _as_stack(stack)
+    images, bands, rows, columns = stack.shape
+    means = np.empty((bands, rows, columns), dtype='float32')
+    step = chunk_rows(columns, chunk_pixels, images)
+    for start in range(0, rows, step):
+        stop = min(start + step, rows)
+        means[:, start:stop] = _band_means(stack[:, :, start:stop], np.nan)
+    return means
+
+
+def chunk_rows(columns, chunk_pixels=CHUNK_PIXELS, images=1):
+    '''
+    Rows per chunk, so a chunk holds about chunk_pixels pixels of all the
+    images of a stack
+    '''
+    return max(1, chunk_pixels // (columns * images))
+
+
+def detect_change(before, after, chunk_pixels=CHUNK_PIXELS):
+    '''
+    Change label (0-10) of every pixel between two stacks of the same
+    grid, see argmax_labels for the stacks
+    '''
+    before, after = _as_stack(before), _as_stack(after)
+    if before.shape[2:] != after.shape[2:]:
+        raise ValueError(f'stacks cover different grids: {before.shape[2:]} and {after.shape[2:]}')
+    rows, columns = before.shape[2:]
+    change = np.empty((rows, columns), dtype='uint8')
+    step = chunk_rows(columns, chunk_pixels, max(len(before), len(after)))
+    for start in range(0, rows, step):
+        stop = min(start + step, rows)
+        change[start:stop] = TRANSITIONS[argmax_labels(before[:, :, start:stop]), argmax_labels(after[:, :, start:stop])]
+    return change
+
+
+def change_areas(change, north, dx, dy, mask=None):
+    '''
+    Area (meters^2) of every change label 0-10 of a change raster
+
+    Arguments:
+        change: (rows, columns) change labels, rows north to south
+        north: latitude of the top edge (degrees)
+        dx, dy: pixel width and height (degrees)
+        mask: optional (rows, columns) booleans, only True pixels count
+    '''
+    rows = change.shape[0]
+    labels = change.astype('int64') + CHANGE_LABELS * np.arange(rows)[:, None]
+    if mask is not None:
+        labels = labels[mask]
+    counts = np.bincount(labels.ravel(), minlength=rows * CHANGE_LABELS).reshape(rows, CHANGE_LABELS)
+    return row_areas_m2(north, dx, dy, rows) @ counts
+
+
+def area_of_change(before, after, north, dx, dy, mask=None, chunk_pixels=CHUNK_PIXELS):
+    '''
+    The list get_area_of_change returns, [{'change': 1, 'sum': ...}, ...]
+    for the change labels 1-10 present, computed from two stacks of Dynamic
+    World probabilities on a longitude/latitude grid
+
+    Arguments:
+        before, after: (images, 9, rows, columns) probabilities of the two
+                       periods, NaN where masked
+        north: latitude of the top edge (degrees)
+        dx, dy: pixel width and height (degrees)
+        mask: optional (rows, columns) booleans of the area to count
+    '''
+    before, after = _as_stack(before), _as_stack(after)
+    rows, columns = before.shape[2:]
+    totals = np.zeros(CHANGE_LABELS)
+    step = chunk_rows(columns, chunk_pixels, max(len(before), len(after)))
+    for start in range(0, rows, step):
+        stop = min(start + step, rows)
+        change = detect_change(before[..., start:stop, :], after[..., start:stop, :], chunk_pixels)
+        totals += change_areas(change, north - start * dy, dx, dy, None if mask is None else mask[start:stop])
+    # label 0 (no change we care about) is masked out by get_area_of_change
+    return [{'change': label, 'sum': float(totals[label])} for label in range(1, CHANGE_LABELS) if totals[label] > 0]
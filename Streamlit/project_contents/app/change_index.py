@@ -0,0 +1,274 @@
+'''
+Local index of the change raster of a neighborhood and year, so the area
+of change of a site can be answered again and again (while a user nudges
+its corners) without another Earth Engine reduction.
+
+The change labels (see AreaChange.get_change_raster) are downloaded once
+on a longitude/latitude grid of about 10m around the site, and every pixel
+is weighted by its geodesic area (all pixels of a row have the same area).
+Two structures are built over them:
+
+- a summed-area table per change class, answering any longitude/latitude
+  rectangle (what render_site_selection produces) in constant time. Pixels
+  the rectangle only partly covers count with the fraction covered.
+- a quadtree of per-class areas (a pyramid of 2x2 sums), answering any
+  polygon: nodes fully inside the polygon add their areas, nodes fully
+  outside are skipped and only the pixels on the boundary are clipped to
+  the polygon, so the cost grows with the boundary, not the area.
+
+Indices are kept per year for the last CACHE_SIZE neighborhoods, a site
+inside one of them is answered from it. Set CALCULATOR_CHANGE_INDEX=1 to
+have gpp_analysis use them for the vegetation change.
+
+# Sample Usage
+
+-------------
+index = get_change_index(geometry, 2021)
+print(index.area_of_change(geometry))
+print(index.rectangle_area(-124.145, 41.114, -124.139, 41.118))
+'''
+from collections import OrderedDict
+import math
+import os
+import threading
+import numpy as np
+from change_detection import row_areas_m2
+from geometry_pyramid import clip_ring
+from query_planner import nesting_depth
+
+USE_CHANGE_INDEX = os.environ.get('CALCULATOR_CHANGE_INDEX', '0') == '1'
+# change labels 1-10, see AreaChange.get_area_of_change
+CHANGE_CLASSES = np.arange(1, 11)
+# margin around a site downloaded with it (meters)
+NEIGHBORHOOD_METERS = 1000
+PIXEL_METERS = 10
+
+
+def _segments(low, high, size):
+    '''
+    (start, stop, fraction) of the pixels the interval [low, high) (pixel
+    coordinates) covers: the partial first and last pixels and the full
+    ones between
+    '''
+    low, high = max(low, 0.0), min(high, float(size))
+    if high <= low:
+        return []
+    first, last = math.floor(low), math.ceil(high)
+    if last - first == 1:
+        return [(first, last, high - low)]
+    segments = [(first, first + 1, first + 1 - low)]
+    if last - first > 2:
+        segments.append((first + 1, last - 1, 1.0))
+    segments.append((last - 1, last, high - (last - 1)))
+    return segments
+
+
+def _ring_area(ring):
+    x, y = ring[:, 0], ring[:, 1]
+    return abs(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1])) / 2
+
+
+class ChangeIndex:
+
+    def __init__(self, labels, west, north, dx, dy):
+        '''
+        Arguments:
+            labels: 2D array of change labels 0-10, rows north to south
+            west, north: longitude and latitude of the top left corner
+            dx, dy: pixel width and height (degrees)
+        '''
+        self.west, self.north, self.dx, self.dy = west, north, dx, dy
+        self.height, self.width = labels.shape
+        self.east = west + dx * self.width
+        self.south = north - dy * self.height
+        self.row_area = row_areas_m2(north, dx, dy, self.height)
+
+        # (class, row, column) area of the pixels of each class
+        areas = (labels[None, :, :] == CHANGE_CLASSES[:, None, None]) * self.row_area[None, :, None]
+
+        # summed-area table, table[k, r, c] = area of class k above row r
+        # and left of column c
+        self.table = np.zeros((len(CHANGE_CLASSES), self.height + 1, self.width + 1))
+        self.table[:, 1:, 1:] = areas.cumsum(axis=1).cumsum(axis=2)
+
+        # quadtree levels, level k node (r, c) holds the areas of the
+        # 2^k x 2^k pixels from (r * 2^k, c * 2^k)
+        self.levels = [areas]
+        while self.levels[-1].shape[1] > 1 or self.levels[-1].shape[2] > 1:
+            level = self.levels[-1]
+            padded = np.pad(level, ((0, 0), (0, level.shape[1] % 2), (0, level.shape[2] % 2)))
+            self.levels.append(padded.reshape(len(CHANGE_CLASSES), padded.shape[1] // 2, 2, padded.shape[2] // 2, 2).sum(axis=(2, 4)))
+
+    def contains(self, west, south, east, north):
+        return west >= self.west and east <= self.east and south >= self.south and north <= self.north
+
+    def to_pixels(self, points):
+        '''
+        (column, row) pixel coordinates of [longitude, latitude] pairs
+        '''
+        points = np.asarray(points, dtype='float64').reshape(-1, 2)
+        return np.column_stack([(points[:, 0] - self.west) / self.dx, (self.north - points[:, 1]) / self.dy])
+
+    def block(self, row_start, row_stop, column_start, column_stop):
+        '''
+        Per-class area of a block of whole pixels, from the summed-area table
+        '''
+        t = self.table
+        return t[:, row_stop, column_stop] - t[:, row_start, column_stop] - t[:, row_stop, column_start] + t[:, row_start, column_start]
+
+    def rectangle_area(self, west, south, east, north):
+        '''
+        Per-class area (meters^2, array in CHANGE_CLASSES order) of a
+        longitude/latitude rectangle, pixels it partly covers count with the
+        fraction covered
+        '''
+        columns = _segments((west - self.west) / self.dx, (east - self.west) / self.dx, self.width)
+        rows = _segments((self.north - north) / self.dy, (self.north - south) / self.dy, self.height)
+        total = np.zeros(len(CHANGE_CLASSES))
+        for row_start, row_stop, row_fraction in rows:
+            for column_start, column_stop, column_fraction in columns:
+                total += row_fraction * column_fraction * self.block(row_start, row_stop, column_start, column_stop)
+        return total
+
+    def polygon_area(self, geometry):
+        '''
+        Per-class area (meters^2, array in CHANGE_CLASSES order) of a list of
+        [longitude, latitude] pairs, a list of rings or MultiPolygon
+        coordinates. Boundary pixels count with the fraction covered.
+        '''
+        depth = nesting_depth(geometry)
+        polygons = [[geometry]] if depth == 2 else [geometry] if depth == 3 else geometry
+        # closed rings in pixel coordinates, +1 for exteriors and -1 for holes
+        rings, signs = [], []
+        for polygon in polygons:
+            for i, ring in enumerate(polygon):
+                ring = self.to_pixels(ring)
+                if (ring[0] != ring[-1]).any():
+                    ring = np.vstack([ring, ring[:1]])
+                rings.append(ring)
+                signs.append(1 if i == 0 else -1)
+        edges = np.vstack([np.hstack([ring[:-1], ring[1:]]) for ring in rings])
+
+        total = np.zeros(len(CHANGE_CLASSES))
+        top = len(self.levels) - 1
+        stack = [(top, 0, 0, np.arange(len(edges)))]
+        while stack:
+            level, row, column, candidates = stack.pop()
+            size = 2 ** level
+            x0, y0 = column * size, row * size
+            x1, y1 = min(x0 + size, self.width), min(y0 + size, self.height)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            crossing = candidates[self._crossing(edges[candidates], x0, y0, x1, y1)]
+            if len(crossing) == 0:
+                if self._inside(edges, (x0 + x1) / 2, (y0 + y1) / 2):
+                    total += self.levels[level][:, row, column]
+            elif level == 0:
+                covered = 0.0
+                for ring, sign in zip(rings, signs):
+                    clipped = clip_ring(ring, (x0, y0, x1, y1))
+                    if clipped is not None:
+                        covered += sign * _ring_area(np.asarray(clipped))
+                total += min(max(covered, 0.0), 1.0) * self.levels[0][:, row, column]
+            else:
+                for child_row in (2 * row, 2 * row + 1):
+                    for child_column in (2 * column, 2 * column + 1):
+                        stack.append((level - 1, child_row, child_column, crossing))
+        return total
+
+    @staticmethod
+    def _crossing(edges, x0, y0, x1, y1):
+        '''
+        Mask of the edges (x0, y0, x1, y1 rows) that touch a rectangle
+        '''
+        ax, ay, bx, by = edges.T
+        overlaps = ((np.minimum(ax, bx) <= x1) & (np.maximum(ax, bx) >= x0) &
+                    (np.minimum(ay, by) <= y1) & (np.maximum(ay, by) >= y0))
+        # the rectangle's corners on both sides of the edge's line
+        sides = np.stack([(bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+                          for cx, cy in ((x0, y0), (x1, y0), (x0, y1), (x1, y1))])
+        return overlaps & (sides.min(axis=0) <= 0) & (sides.max(axis=0) >= 0)
+
+    @staticmethod
+    def _inside(edges, x, y):
+        '''
+        Even-odd test of a point against all the rings
+        '''
+        ax, ay, bx, by = edges.T
+        straddles = (ay > y) != (by > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossing_x = ax + (y - ay) * (bx - ax) / (by - ay)
+        return bool(np.count_nonzero(straddles & (crossing_x > x)) % 2)
+
+    def area_of_change(self, geometry):
+        '''
+        The list get_area_of_change returns, [{'change': 1, 'sum': ...}, ...]
+        for the classes present in the geometry. Rectangles (four corners on
+        two longitudes and two latitudes) use the summed-area table, other
+        polygons the quadtree.
+        '''
+        points = np.asarray(geometry, dtype='float64') if nesting_depth(geometry) == 2 else None
+        if points is not None and len(np.unique(points[:, 0])) == 2 and len(np.unique(points[:, 1])) == 2:
+            areas = self.rectangle_area(points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max())
+        else:
+            areas = self.polygon_area(geometry)
+        return [{'change': int(change), 'sum': float(area)} for change, area in zip(CHANGE_CLASSES, areas) if area > 0]
+
+
+def _points(geometry):
+    if nesting_depth(geometry) <= 2:
+        return np.asarray(geometry, dtype='float64').reshape(-1, 2)
+    return np.vstack([_points(part) for part in geometry])
+
+
+def geometry_bounds(geometry):
+    '''
+    (west, south, east, north) of coordinates of any nesting
+    '''
+    points = _points(geometry)
+    return points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()
+
+
+def build_change_index(bounds, year, token=None, scale=PIXEL_METERS):
+    '''
+    Downloads the change raster of bounds (west, south, east, north) for a
+    year from Earth Engine and indexes it
+    '''
+    # imported here, importing area_change logs in to Earth Engine
+    from area_change import AreaChange # Custom module for GEE calls
+
+    west, south, east, north = bounds
+    rectangle = [[west, south], [east, south], [east, north], [west, north]]
+    labels, (west, north, dx, dy) = AreaChange(rectangle, year, token=token).get_change_raster(bounds, scale)
+    return ChangeIndex(labels, west, north, dx, dy)
+
+
+# (year, bounds) -> ChangeIndex of the neighborhoods analysed last
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+CACHE_SIZE = 16
+
+
+def get_change_index(geometry, year, token=None):
+    '''
+    A ChangeIndex covering the geometry for a year: a cached one when the
+    geometry is inside a neighborhood indexed before, otherwise the
+    geometry's bounding box and NEIGHBORHOOD_METERS around it are indexed
+    '''
+    west, south, east, north = geometry_bounds(geometry)
+    with _cache_lock:
+        for key, index in reversed(_cache.items()):
+            if key[0] == year and index.contains(west, south, east, north):
+                _cache.move_to_end(key)
+                return index
+
+    lat_0 = math.radians((south + north) / 2)
+    margin_lat = NEIGHBORHOOD_METERS / (111132.954 - 559.822 * math.cos(2 * lat_0))
+    margin_lon = NEIGHBORHOOD_METERS / (111319.488 * math.cos(lat_0))
+    bounds = (west - margin_lon, south - margin_lat, east + margin_lon, north + margin_lat)
+    index = build_change_index(bounds, year, token)
+    with _cache_lock:
+        _cache[(year, bounds)] = index
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return index
@@ -0,0 +1,72 @@
+'''
+The Dynamic World bands and the change labels AreaChange detects, as plain
+Python lists so the change can also be computed without Earth Engine (see
+change_detection.py in the app).
+
+# Sample Usage
+
+-------------
+table = transition_table()
+# change label of a pixel that was trees (1) and is now built (6)
+print(table[1, 6])
+'''
+import numpy as np
+
+NODATA_VALUE = -1
+DYNAMIC_WORLD_COLUMNS = ['water',
+                         'trees',
+                         'grass',
+                         'flooded_vegetation',
+                         'crops',
+                         'shrub_and_scrub',
+                         'built',
+                         'bare',
+                         'snow_and_ice']
+
+# BIG_LABELS: imagine a pixel in a dynamic world image has
+# land class label X at time A and label Y at time B. We can
+# detect the change by multiplying the label at time A by 100
+# and adding the label at time A and time B together. If we
+# were to do that, we'd get the following possible values:
+BIG_LABELS = [0, 1, 2, 3, 4, 5, 6, 7, 8,
+              100, 101, 102, 103, 104, 105, 106, 107, 108,
+              200, 201, 202, 203, 204, 205, 206, 207, 208,
+              300, 301, 302, 303, 304, 305, 306, 307, 308,
+              400, 401, 402, 403, 404, 405, 406, 407, 408,
+              500, 501, 502, 503, 504, 505, 506, 507, 508,
+              600, 601, 602, 603, 604, 605, 606, 607, 608,
+              700, 701, 702, 703, 704, 705, 706, 707, 708,
+              800, 801, 802, 803, 804, 805, 806, 807, 808]
+
+# ADJUSTED_LABELS: We don't care about most of the possible
+# changes. For example, if water stayed water....we don't care.
+# However, we do care if grass went to built or if built turned into
+# grass. So we set most of the list to 0 and we remap changes we care
+# to new labels. So now 1 represents trees that are now considered built.
+
+# See:
+# https://docs.google.com/spreadsheets/d/1jRIu3ly6NOzFR9X5of_NDq2ZfgFpiM5AL9LdtuzXDiw/edit?usp=sharing
+ADJUSTED_LABELS = [0, 0, 0, 0, 0, 0, 0, 0, 0,
+                   0, 0, 0, 0, 0, 0, 1, 1, 0,
+                   0, 0, 0, 0, 0, 0, 2, 2, 0,
+                   0, 0, 0, 0, 0, 0, 3, 3, 0,
+                   0, 0, 0, 0, 0, 0, 4, 4, 0,
+                   0, 0, 0, 0, 0, 0, 5, 5, 0,
+                   0, 6, 7, 8, 9, 10, 0, 0, 0,
+                   0, 6, 7, 8, 9, 10, 0, 0, 0,
+                   0, 0, 0, 0, 0, 0, 0, 0, 0]
+
+
+def transition_table(big_labels=BIG_LABELS, adjusted_labels=ADJUSTED_LABELS):
+    '''
+    9x9 table of the change label of a pixel, indexed by its Dynamic World
+    label at time A and at time B: the remap of label_A * 100 + label_B
+    from big_labels to adjusted_labels
+    '''
+    classes = len(DYNAMIC_WORLD_COLUMNS)
+    remap = dict(zip(big_labels, adjusted_labels))
+    table = np.zeros((classes, classes), dtype='uint8')
+    for before in range(classes):
+        for after in range(classes):
+            table[before, after] = remap[before * 100 + after]
+    return table
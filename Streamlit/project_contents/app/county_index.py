@@ -0,0 +1,366 @@
+'''
+This module indexes the county boundaries of NorthernCaliforniaCounties.txt
+(a GeoJSON FeatureCollection with the county name in ADM2_NAME) so a
+county can be looked up by name without parsing the file again.
+
+Every county is normalized to a MultiPolygon, whatever its geometry type in
+the file (Polygon, MultiPolygon or a GeometryCollection of those): a list
+of polygons, each a closed exterior ring (counter-clockwise) followed by
+its holes (clockwise). The vertices of all counties are kept in one
+contiguous float64 [longitude, latitude] buffer, with offsets marking where
+each ring, polygon and county starts, plus the bounding box and centroid
+of every county.
+
+The index is built once per process (see load_county_index) and persisted
+next to the source file as a .npz, which is rebuilt when the source file
+changes.
+
+It also answers the reverse question, which county a point is in, for
+millions of points at once (e.g. the pixels AreaChange samples), so pixel
+results can be rolled up by county without more Earth Engine requests.
+Points are filtered by the county bounding boxes, then ray cast against the
+county edges in the same horizontal band (see EdgeBands).
+
+# Sample Usage
+
+-------------
+counties = load_county_index()
+print(counties.names)
+print(counties.bbox('Sonoma'), counties.centroid('Sonoma'))
+geometry = counties.multipolygon('Sonoma')
+map_geometry = counties.pyramid('Sonoma').at_zoom(8)
+print(counties.county_at(-122.72, 38.44))
+print(counties.rollup(pixels, ['GPP']))
+'''
+from functools import lru_cache
+import json
+import os
+import numpy as np
+import pandas as pd
+from geometry_pyramid import GeometryPyramid
+
+COUNTY_FILE = 'project_contents/app/NorthernCaliforniaCounties.txt'
+NAME_PROPERTY = 'ADM2_NAME'
+
+
+def signed_area(ring):
+    '''
+    Shoelace area of a closed ring in degrees^2, positive when the ring is
+    counter-clockwise
+    '''
+    x, y = ring[:, 0], ring[:, 1]
+    return (np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1])) / 2
+
+
+def normalize_ring(ring, counter_clockwise):
+    '''
+    Closes a ring and orients it. None for a degenerate ring.
+    '''
+    ring = np.asarray(ring, dtype='float64').reshape(-1, 2)
+    if len(ring) > 0 and (ring[0] != ring[-1]).any():
+        ring = np.vstack([ring, ring[:1]])
+    if len(ring) < 4:
+        return None
+    if (signed_area(ring) > 0) != counter_clockwise:
+        ring = ring[::-1]
+    return np.ascontiguousarray(ring)
+
+
+def geometry_polygons(geometry):
+    '''
+    Polygons (lists of rings) of a GeoJSON geometry of any polygonal type
+    '''
+    if geometry is None:
+        return []
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return list(geometry['coordinates'])
+    if geometry['type'] == 'GeometryCollection':
+        return [polygon for part in geometry['geometries'] for polygon in geometry_polygons(part)]
+    return []
+
+
+class EdgeBands:
+    '''
+    The edges of one county bucketed into horizontal bands of its bounding
+    box, so a point is only ray cast against the edges spanning its
+    latitude. With ~sqrt(edges) bands each band holds a few hundred edges
+    even for a detailed coastline.
+    '''
+
+    # points tested against a band's edges at once
+    CHUNK = 50000
+
+    def __init__(self, edges, bbox):
+        '''
+        Arguments:
+            edges: (n, 4) x1, y1, x2, y2 of every ring edge of the county
+            bbox: min longitude, min latitude, max longitude, max latitude
+        '''
+        self.edges = edges
+        self.y0 = bbox[1]
+        self.bands = max(1, int(np.sqrt(len(edges))))
+        self.height = (bbox[3] - bbox[1]) / self.bands or 1.0
+
+        low = self.band_of(np.minimum(edges[:, 1], edges[:, 3]))
+        high = self.band_of(np.maximum(edges[:, 1], edges[:, 3]))
+        counts = high - low + 1
+        # edge e is listed in every band from low[e] to high[e]
+        edge_ids = np.repeat(np.arange(len(edges)), counts)
+        bands = np.repeat(low - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        order = np.argsort(bands, kind='stable')
+        self.band_edges = edge_ids[order]
+        self.band_offsets = np.searchsorted(bands[order], np.arange(self.bands + 1))
+
+    def band_of(self, y):
+        return np.clip(((y - self.y0) / self.height).astype('int64'), 0, self.bands - 1)
+
+    def contains(self, x, y):
+        '''
+        Even-odd ray casting, so holes and separate parts of a MultiPolygon
+        are handled by the same crossing count
+        '''
+        inside = np.zeros(len(x), dtype=bool)
+        bands = self.band_of(y)
+        order = np.argsort(bands, kind='stable')
+        starts = np.searchsorted(bands[order], np.arange(self.bands + 1))
+        for band in range(self.bands):
+            points = order[starts[band]:starts[band + 1]]
+            if len(points) == 0:
+                continue
+            edges = self.edges[self.band_edges[self.band_offsets[band]:self.band_offsets[band + 1]]]
+            x1, y1, x2, y2 = (edges[:, k][None, :] for k in range(4))
+            for first in range(0, len(points), self.CHUNK):
+                chunk = points[first:first + self.CHUNK]
+                px, py = x[chunk][:, None], y[chunk][:, None]
+                spans = (y1 > py) != (y2 > py)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    crossing_x = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+                crossings = (spans & (px < crossing_x)).sum(axis=1)
+                inside[chunk] = crossings % 2 == 1
+        return inside
+
+
+class CountyIndex:
+
+    def __init__(self, names, coords, ring_offsets, polygon_offsets, county_offsets, bboxes, centroids):
+        '''
+        Arguments:
+            names: county names, in the order of county_offsets
+            coords: (vertices, 2) float64 [longitude, latitude] of every ring
+            ring_offsets: (rings + 1) start of each ring in coords
+            polygon_offsets: (polygons + 1) start of each polygon in rings,
+                             the first ring of a polygon is its exterior
+            county_offsets: (counties + 1) start of each county in polygons
+            bboxes: (counties, 4) min longitude, min latitude, max longitude,
+                    max latitude
+            centroids: (counties, 2) area weighted [longitude, latitude]
+
+        Raises ValueError when two counties have the same name.
+        '''
+        self.coords = coords
+        self.ring_offsets = ring_offsets
+        self.polygon_offsets = polygon_offsets
+        self.county_offsets = county_offsets
+        self.bboxes = bboxes
+        self.centroids = centroids
+        self.positions = {}
+        for i, name in enumerate(names):
+            if name in self.positions:
+                raise ValueError(f'more than one county named {name!r} ({NAME_PROPERTY})')
+            self.positions[name] = i
+        # sorted for the county selection box
+        self.names = sorted(self.positions)
+        # name -> GeometryPyramid, built the first time a county is shown
+        self.pyramids = {}
+        # EdgeBands of every county, built by the first point lookup
+        self.edge_bands = None
+
+    @classmethod
+    def from_geojson(cls, data):
+        names, rings, ring_counts, polygon_counts = [], [], [], []
+        for feature in data['features']:
+            polygons = []
+            for polygon in geometry_polygons(feature['geometry']):
+                exterior = normalize_ring(polygon[0], counter_clockwise=True) if len(polygon) > 0 else None
+                if exterior is None:
+                    continue
+                holes = [normalize_ring(hole, counter_clockwise=False) for hole in polygon[1:]]
+                polygons.append([exterior] + [hole for hole in holes if hole is not None])
+            if len(polygons) == 0:
+                continue
+            names.append(feature['properties'][NAME_PROPERTY])
+            polygon_counts.append(len(polygons))
+            for polygon in polygons:
+                ring_counts.append(len(polygon))
+                rings.extend(polygon)
+
+        coords = np.ascontiguousarray(np.vstack(rings)) if rings else np.empty((0, 2))
+        ring_offsets = np.concatenate([[0], np.cumsum([len(ring) for ring in rings])]).astype('int64')
+        polygon_offsets = np.concatenate([[0], np.cumsum(ring_counts)]).astype('int64')
+        county_offsets = np.concatenate([[0], np.cumsum(polygon_counts)]).astype('int64')
+
+        bboxes = np.empty((len(names), 4))
+        centroids = np.empty((len(names), 2))
+        for i in range(len(names)):
+            first_ring = polygon_offsets[county_offsets[i]]
+            last_ring = polygon_offsets[county_offsets[i + 1]]
+            vertices = coords[ring_offsets[first_ring]:ring_offsets[last_ring]]
+            bboxes[i] = np.concatenate([vertices.min(axis=0), vertices.max(axis=0)])
+
+            # holes are clockwise, so their negative areas subtract themselves
+            area, moment = 0.0, np.zeros(2)
+            for r in range(first_ring, last_ring):
+                ring = coords[ring_offsets[r]:ring_offsets[r + 1]]
+                cross = ring[:-1, 0] * ring[1:, 1] - ring[1:, 0] * ring[:-1, 1]
+                area += cross.sum() / 2
+                moment += ((ring[:-1] + ring[1:]) * cross[:, None]).sum(axis=0) / 6
+            centroids[i] = moment / area if area != 0 else vertices.mean(axis=0)
+
+        return cls(names, coords, ring_offsets, polygon_offsets, county_offsets, bboxes, centroids)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as arrays:
+            return cls(arrays['names'].tolist(), arrays['coords'], arrays['ring_offsets'], arrays['polygon_offsets'],
+                       arrays['county_offsets'], arrays['bboxes'], arrays['centroids'])
+
+    def save(self, path, **metadata):
+        names = [None] * len(self.positions)
+        for name, i in self.positions.items():
+            names[i] = name
+        # np.savez adds .npz to paths without it
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, names=np.array(names, dtype=str), coords=self.coords, ring_offsets=self.ring_offsets,
+                 polygon_offsets=self.polygon_offsets, county_offsets=self.county_offsets, bboxes=self.bboxes,
+                 centroids=self.centroids, **metadata)
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def index(self, name):
+        if name not in self.positions:
+            raise KeyError(f'unknown county {name}')
+        return self.positions[name]
+
+    def polygons(self, name):
+        '''
+        The county as a list of polygons, each a list of (n, 2) ring views
+        into the coordinate buffer (exterior first)
+        '''
+        i = self.index(name)
+        polygons = []
+        for p in range(self.county_offsets[i], self.county_offsets[i + 1]):
+            rings = range(self.polygon_offsets[p], self.polygon_offsets[p + 1])
+            polygons.append([self.coords[self.ring_offsets[r]:self.ring_offsets[r + 1]] for r in rings])
+        return polygons
+
+    def multipolygon(self, name):
+        '''
+        MultiPolygon coordinates of the county as nested lists, as GeoJSON
+        and ee.Geometry.MultiPolygon take them
+        '''
+        return [[ring.tolist() for ring in polygon] for polygon in self.polygons(name)]
+
+    def pyramid(self, name):
+        '''
+        Simplified versions of the county for the map (see
+        geometry_pyramid.py)
+        '''
+        if name not in self.pyramids:
+            self.pyramids[name] = GeometryPyramid(self.multipolygon(name))
+        return self.pyramids[name]
+
+    def geojson(self, name):
+        return {'type': 'MultiPolygon', 'coordinates': self.multipolygon(name)}
+
+    def bbox(self, name):
+        '''
+        [min longitude, min latitude, max longitude, max latitude]
+        '''
+        return self.bboxes[self.index(name)]
+
+    def centroid(self, name):
+        '''
+        [longitude, latitude]
+        '''
+        return self.centroids[self.index(name)]
+
+    def build_edge_bands(self):
+        self.edge_bands = []
+        for i in range(len(self)):
+            first_ring = self.polygon_offsets[self.county_offsets[i]]
+            last_ring = self.polygon_offsets[self.county_offsets[i + 1]]
+            edges = [np.hstack([ring[:-1], ring[1:]])
+                     for ring in (self.coords[self.ring_offsets[r]:self.ring_offsets[r + 1]] for r in range(first_ring, last_ring))]
+            self.edge_bands.append(EdgeBands(np.vstack(edges), self.bboxes[i]))
+
+    def locate_indices(self, longitudes, latitudes):
+        '''
+        Position (in the order counties were read) of the county each point
+        is in, -1 for points outside every county
+        '''
+        x = np.asarray(longitudes, dtype='float64').ravel()
+        y = np.asarray(latitudes, dtype='float64').ravel()
+        if self.edge_bands is None:
+            self.build_edge_bands()
+
+        located = np.full(len(x), -1, dtype='int64')
+        for i, (min_x, min_y, max_x, max_y) in enumerate(self.bboxes):
+            candidates = np.flatnonzero((located == -1) & (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y))
+            if len(candidates) == 0:
+                continue
+            inside = self.edge_bands[i].contains(x[candidates], y[candidates])
+            located[candidates[inside]] = i
+        return located
+
+    def locate(self, longitudes, latitudes):
+        '''
+        Name of the county each point is in (None outside every county)
+        '''
+        names = np.empty(len(self) + 1, dtype=object)
+        for name, i in self.positions.items():
+            names[i] = name
+        return names[self.locate_indices(longitudes, latitudes)]
+
+    def county_at(self, longitude, latitude):
+        return self.locate([longitude], [latitude])[0]
+
+    def rollup(self, df, columns, longitude='longitude', latitude='latitude', aggregate='sum'):
+        '''
+        Aggregates per pixel results (one row per pixel with its longitude
+        and latitude, like the DataFrames of AreaChange) by county
+        '''
+        counties = self.locate(df[longitude].to_numpy(), df[latitude].to_numpy())
+        located = pd.Series(counties, index=df.index, name='county')
+        return df[columns].groupby(located).agg(aggregate)
+
+
+def source_signature(source_path):
+    stat = os.stat(source_path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype='int64')
+
+
+@lru_cache(maxsize=None)
+def load_county_index(source_path=COUNTY_FILE, cache_path=None):
+    '''
+    The county index of source_path, read from the .npz cache when it was
+    built from the current version of the file
+    '''
+    cache_path = cache_path or os.path.splitext(source_path)[0] + '.npz'
+    signature = source_signature(source_path)
+    if os.path.exists(cache_path):
+        with np.load(cache_path, allow_pickle=False) as arrays:
+            fresh = 'source_signature' in arrays and np.array_equal(arrays['source_signature'], signature)
+        if fresh:
+            return CountyIndex.load(cache_path)
+
+    with open(source_path) as f:
+        index = CountyIndex.from_geojson(json.load(f))
+    index.save(cache_path, source_signature=signature)
+    return index
@@ -0,0 +1,258 @@
+'''
+Offline precompute of the carbon analysis of every county in
+NorthernCaliforniaCounties.txt, so the County Analysis page reads results
+instead of running a live analysis over a whole county.
+
+Every county is cut into tiles (TILE_KM square, clipped to the county
+boundary) and every tile is analysed for every year with AreaChange and the
+GPP model, like gpp_analysis.run_analysis does for a site. Vegetation
+change areas and GPP are sums over pixels, so the county result is the sum
+of its tiles. Tiles are kept under the area limit of the interactive page
+(MAX_AREA_M2, see AreaChange.is_area_within_limits), so Earth Engine never
+gets a larger request from the precompute than from the page, at the cost
+of a thousand or more tiles per county and year.
+
+Results go to a SQLite store (CALCULATOR_COUNTY_STORE) with one row per
+(county, year, tile). The tiles are planned into the store before any of
+them runs, so an interrupted run resumes with the tiles that aren't done
+and the page can tell how complete a county is. Tiles run on a pool of
+threads in the batch lane of the Earth Engine scheduler, so a running
+precompute never delays the interactive pages, and the tiles of all the
+threads are predicted together by the inference service.
+
+Usage (from the Streamlit folder, like the app):
+    python project_contents/app/county_precompute.py --workers 4
+    python project_contents/app/county_precompute.py --counties Sonoma Marin --years 2020 2021
+'''
+import argparse
+import json
+import math
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+import pandas as pd
+from county_index import COUNTY_FILE, load_county_index
+from geometry_pyramid import clip_ring
+from gpp_analysis import MODEL_PATH, VEGETATION_TYPES, YEARS, predict_gpp, sum_vegetation_change
+from inference_service import get_inference_service
+from quota_scheduler import scheduler, BATCH
+
+COUNTY_STORE = os.environ.get('CALCULATOR_COUNTY_STORE', 'project_contents/app/county_results.sqlite')
+# AreaChange.is_area_within_limits, the largest area the page analyses
+MAX_AREA_M2 = 1000000
+# the tile grid is laid out with KM_PER_DEGREE_LAT, within about 1% of the
+# geodesic size, so tiles stay this far under the limit
+TILE_MARGIN = 0.98
+TILE_KM = 0.95
+KM_PER_DEGREE_LAT = 111.32
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def county_tiles(polygons, bbox, tile_km=TILE_KM):
+    '''
+    Tiles of a county: {"<row>_<column>": MultiPolygon coordinates of the
+    county clipped to the tile}, tiles outside the county left out.
+
+    Arguments:
+        polygons: the county as returned by CountyIndex.polygons
+        bbox: bounding box of the county
+        tile_km: tile side (kilometers)
+    '''
+    min_x, min_y, max_x, max_y = bbox
+    lat_step = tile_km / KM_PER_DEGREE_LAT
+    lon_step = tile_km / (KM_PER_DEGREE_LAT * math.cos(math.radians((min_y + max_y) / 2)))
+    rows = max(1, math.ceil((max_y - min_y) / lat_step))
+    columns = max(1, math.ceil((max_x - min_x) / lon_step))
+
+    tiles = {}
+    for row in range(rows):
+        for column in range(columns):
+            tile = (min_x + column * lon_step, min_y + row * lat_step,
+                    min_x + (column + 1) * lon_step, min_y + (row + 1) * lat_step)
+            clipped = []
+            for polygon in polygons:
+                exterior_bbox = (polygon[0][:, 0].min(), polygon[0][:, 1].min(), polygon[0][:, 0].max(), polygon[0][:, 1].max())
+                if exterior_bbox[0] > tile[2] or exterior_bbox[2] < tile[0] or exterior_bbox[1] > tile[3] or exterior_bbox[3] < tile[1]:
+                    continue
+                exterior = clip_ring(polygon[0], tile)
+                if exterior is None:
+                    continue
+                holes = [clip_ring(hole, tile) for hole in polygon[1:]]
+                clipped.append([exterior] + [hole for hole in holes if hole is not None])
+            if clipped:
+                tiles[f'{row}_{column}'] = clipped
+    return tiles
+
+
+class CountyStore:
+
+    def __init__(self, path=COUNTY_STORE):
+        self.path = path
+        with self.connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS tiles (
+                              county TEXT NOT NULL,
+                              year INTEGER NOT NULL,
+                              tile TEXT NOT NULL,
+                              tile_km REAL NOT NULL,
+                              status TEXT NOT NULL,
+                              land_change TEXT,
+                              gpp REAL,
+                              error TEXT,
+                              updated REAL NOT NULL,
+                              PRIMARY KEY (county, year, tile))''')
+            db.execute('CREATE INDEX IF NOT EXISTS tiles_status ON tiles (status)')
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def plan(self, county, year, tiles, tile_km):
+        '''
+        Adds the tiles of a county and year that aren't in the store yet.
+        A county already planned with another tile size is planned again.
+        '''
+        with self.connect() as db:
+            planned = db.execute('SELECT DISTINCT tile_km FROM tiles WHERE county = ? AND year = ?', (county, year)).fetchall()
+            if planned and planned != [(tile_km,)]:
+                db.execute('DELETE FROM tiles WHERE county = ? AND year = ?', (county, year))
+            db.executemany('INSERT OR IGNORE INTO tiles (county, year, tile, tile_km, status, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                           [(county, year, tile, tile_km, PENDING, time.time()) for tile in tiles])
+
+    def remaining(self, counties=None, years=None):
+        '''
+        (county, year, tile) of the tiles that aren't done
+        '''
+        with self.connect() as db:
+            rows = db.execute('SELECT county, year, tile FROM tiles WHERE status != ? ORDER BY county, year, tile', (DONE,)).fetchall()
+        return [row for row in rows
+                if (counties is None or row[0] in counties) and (years is None or row[1] in years)]
+
+    def record(self, county, year, tile, land_change=None, gpp=None, error=None):
+        status = DONE if error is None else FAILED
+        with self.connect() as db:
+            db.execute('UPDATE tiles SET status = ?, land_change = ?, gpp = ?, error = ?, updated = ? WHERE county = ? AND year = ? AND tile = ?',
+                       (status, json.dumps(land_change) if land_change is not None else None, gpp, error, time.time(), county, year, tile))
+
+    def counties(self):
+        with self.connect() as db:
+            return [row[0] for row in db.execute('SELECT DISTINCT county FROM tiles ORDER BY county')]
+
+    def county_results(self, county):
+        '''
+        One row per year: the vegetation change and GPP summed over the done
+        tiles, with how many tiles are done out of how many were planned
+        '''
+        with self.connect() as db:
+            rows = db.execute('SELECT year, status, land_change, gpp FROM tiles WHERE county = ?', (county,)).fetchall()
+
+        results = []
+        for year in sorted({row[0] for row in rows}):
+            year_rows = [row for row in rows if row[0] == year]
+            done = [row for row in year_rows if row[1] == DONE]
+            result = {'Year': year}
+            for vegetation in VEGETATION_TYPES:
+                result[vegetation] = sum(json.loads(row[2])[vegetation] for row in done)
+            result['GPP'] = sum(row[3] for row in done)
+            result['tiles_done'] = len(done)
+            result['tiles'] = len(year_rows)
+            results.append(result)
+        return pd.DataFrame(results, columns=['Year'] + VEGETATION_TYPES + ['GPP', 'tiles_done', 'tiles'])
+
+
+@lru_cache(maxsize=None)
+def _open_county_store(path):
+    return CountyStore(path)
+
+
+def load_county_store(path=COUNTY_STORE):
+    '''
+    The county store shared by every session of this process, None when no
+    precompute has run yet (checked on every call, so the store shows up
+    once a precompute creates it)
+    '''
+    if not os.path.exists(path):
+        return None
+    return _open_county_store(path)
+
+
+def analyse_tile(geometry, year, service):
+    '''
+    Vegetation change and GPP of one tile and year, like
+    gpp_analysis.run_analysis for a single year. The area limit isn't
+    checked again here, precompute sizes the tiles under it.
+    '''
+    # imported here so the page can read the store without logging in to Earth Engine
+    from area_change import AreaChange # Custom module for GEE calls
+
+    with scheduler.lane(BATCH):
+        ac = AreaChange(geometry, year)
+        land_change = sum_vegetation_change(year, ac.get_area_of_change())
+        gpp = predict_gpp(ac.get_change_that_might_occur(), service)
+    return land_change, float(gpp)
+
+
+def precompute(store, source_path=COUNTY_FILE, counties=None, years=YEARS, tile_km=TILE_KM, workers=4, model_path=MODEL_PATH):
+    '''
+    Plans the tiles of the counties and years and runs the ones that aren't
+    done yet. Failed tiles are recorded and retried by the next run. Raises
+    ValueError when tile_km would make tiles over the area limit.
+    '''
+    if (tile_km * 1000) ** 2 > TILE_MARGIN * MAX_AREA_M2:
+        raise ValueError(f'{tile_km} km tiles are over the area limit of {MAX_AREA_M2} m^2, '
+                         f'use at most {math.sqrt(TILE_MARGIN * MAX_AREA_M2) / 1000:.2f} km')
+    county_index = load_county_index(source_path)
+    counties = counties or county_index.names
+    tiles = {}
+    for county in counties:
+        tiles[county] = county_tiles(county_index.polygons(county), county_index.bbox(county), tile_km)
+        for year in years:
+            store.plan(county, year, tiles[county], tile_km)
+
+    # tiles of an earlier plan the county boundary no longer has are skipped
+    remaining = [(county, year, tile) for county, year, tile in store.remaining(set(counties), set(years))
+                 if tile in tiles[county]]
+    print(f'{len(remaining)} tiles to compute for {len(counties)} counties and {len(years)} years')
+    if len(remaining) == 0:
+        return
+
+    service = get_inference_service(model_path)
+    started = time.time()
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyse_tile, tiles[county][tile], year, service): (county, year, tile)
+                   for county, year, tile in remaining}
+        for future in as_completed(futures):
+            county, year, tile = futures[future]
+            try:
+                land_change, gpp = future.result()
+                store.record(county, year, tile, land_change=land_change, gpp=gpp)
+            except Exception as e:
+                store.record(county, year, tile, error=str(e))
+                print(f'{county} {year} tile {tile} failed: {e}')
+            done += 1
+            if done % 10 == 0 or done == len(remaining):
+                rate = done / (time.time() - started)
+                print(f'{done}/{len(remaining)} tiles, {rate:.2f} tiles/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute the carbon analysis of every county')
+    parser.add_argument('--counties', nargs='*', help='county names (ADM2_NAME), all by default')
+    parser.add_argument('--years', nargs='*', type=int, default=YEARS)
+    parser.add_argument('--tile-km', type=float, default=TILE_KM)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--source', default=COUNTY_FILE)
+    parser.add_argument('--store', default=COUNTY_STORE)
+    parser.add_argument('--model', default=MODEL_PATH)
+    args = parser.parse_args()
+
+    store = CountyStore(args.store)
+    precompute(store, args.source, args.counties, args.years, args.tile_km, args.workers, args.model)
+
+
+if __name__ == '__main__':
+    main()
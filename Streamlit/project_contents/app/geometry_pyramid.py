@@ -0,0 +1,350 @@
+'''
+Simplified versions of a polygon at several tolerances, so maps and Earth
+Engine requests don't carry every vertex of a county boundary.
+
+Rings are simplified with Douglas-Peucker in meters (the vertices are
+projected onto a local equirectangular plane, like polygon_area_m2 in
+query_planner.py), so a tolerance of 30 means no point of the simplified
+boundary is more than 30m from the original one. A simplified ring that
+would cross itself is simplified again at half the tolerance (down to the
+original ring), and rings that collapse below the tolerance are dropped
+unless they are the only exterior. The simplified rings are then checked
+against each other: a hole that crosses or leaves its exterior, or parts
+of a MultiPolygon that cross or overlap, send the whole geometry back to
+be simplified at half the tolerance (down to the original geometry), so
+every level is still a valid polygon.
+
+GeometryPyramid keeps one level per tolerance in TOLERANCES_METERS. The
+map picks the coarsest level whose error is below a screen pixel at its
+zoom (at_zoom) and AreaChange the coarsest level within the error it
+allows (within_error).
+
+# Sample Usage
+
+-------------
+pyramid = GeometryPyramid(county_coordinates)
+print(pyramid.vertex_counts())
+map_coordinates = pyramid.at_zoom(8)
+request_coordinates = simplify_geometry(county_coordinates, tolerance=5)
+'''
+from collections import OrderedDict
+import hashlib
+import json
+import math
+import threading
+import numpy as np
+from query_planner import nesting_depth
+
+# 0 is the original geometry
+TOLERANCES_METERS = [0, 5, 15, 50, 150, 500, 1500]
+
+# meters per screen pixel at the equator at zoom 0 (256 pixel web mercator tiles)
+METERS_PER_PIXEL_ZOOM_0 = 156543.03392
+
+
+def local_projection(ring):
+    '''
+    Meters per degree of longitude and latitude around the ring
+    '''
+    lat_0 = math.radians(float(np.mean(ring[:, 1])))
+    meters_per_degree_lat = 111132.954 - 559.822 * math.cos(2 * lat_0)
+    meters_per_degree_lon = 111319.488 * math.cos(lat_0)
+    return np.array([meters_per_degree_lon, meters_per_degree_lat])
+
+
+def douglas_peucker(points, tolerance):
+    '''
+    Indices of the points of a polyline (in meters) Douglas-Peucker keeps
+    '''
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = math.hypot(segment[0], segment[1])
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = start + 1 + farthest
+            keep[middle] = True
+            stack.append((start, middle))
+            stack.append((middle, end))
+    return np.flatnonzero(keep)
+
+
+def self_intersects(ring, chunk=256):
+    '''
+    True when two non adjacent edges of a closed ring cross
+    '''
+    return rings_intersect([ring], chunk)
+
+
+def rings_intersect(rings, chunk=256):
+    '''
+    True when two edges of closed rings cross, edges next to each other on
+    the same ring left out
+    '''
+    starts = np.vstack([ring[:-1] for ring in rings])
+    ends = np.vstack([ring[1:] for ring in rings])
+    n = len(starts)
+    if n < 4:
+        return False
+    # ring of every edge, and the first and last edge of its ring
+    sizes = [len(ring) - 1 for ring in rings]
+    ring_of = np.repeat(np.arange(len(rings)), sizes)
+    ring_first = np.repeat(np.cumsum([0] + sizes[:-1]), sizes)
+    ring_last = ring_first + np.repeat(sizes, sizes) - 1
+    low = np.minimum(starts, ends)
+    high = np.maximum(starts, ends)
+
+    def orientation(a, b, c):
+        return np.sign((b[..., 0] - a[..., 0]) * (c[..., 1] - a[..., 1]) - (b[..., 1] - a[..., 1]) * (c[..., 0] - a[..., 0]))
+
+    for first in range(0, n, chunk):
+        i = np.arange(first, min(first + chunk, n))[:, None]
+        j = np.arange(n)[None, :]
+        # each pair once, adjacent edges (sharing a vertex) excluded
+        same_ring = ring_of[i] == ring_of[j]
+        candidates = (j > i) & ~(same_ring & ((j == i + 1) | ((i == ring_first[i]) & (j == ring_last[i]))))
+        candidates &= (low[i, 0] <= high[j, 0]) & (low[j, 0] <= high[i, 0])
+        candidates &= (low[i, 1] <= high[j, 1]) & (low[j, 1] <= high[i, 1])
+        pairs_i, pairs_j = np.nonzero(candidates)
+        if len(pairs_i) == 0:
+            continue
+        pairs_i += first
+        a, b, c, d = starts[pairs_i], ends[pairs_i], starts[pairs_j], ends[pairs_j]
+        crosses = ((orientation(a, b, c) * orientation(a, b, d) < 0) &
+                   (orientation(c, d, a) * orientation(c, d, b) < 0))
+        if crosses.any():
+            return True
+    return False
+
+
+def simplify_ring(ring, tolerance, keep_collapsed=False):
+    '''
+    Simplifies a closed ring of [longitude, latitude] pairs. Returns None
+    when the ring collapses below the tolerance (unless keep_collapsed, then
+    the original ring is returned).
+    '''
+    ring = np.asarray(ring, dtype='float64').reshape(-1, 2)
+    if tolerance <= 0 or len(ring) <= 4:
+        return ring
+    meters = ring * local_projection(ring)
+    while tolerance > 0.01:
+        simplified = ring[douglas_peucker(meters, tolerance)]
+        if len(simplified) < 4:
+            if not keep_collapsed:
+                return None
+        elif not self_intersects(simplified * local_projection(ring)):
+            return simplified
+        tolerance /= 2
+    return ring
+
+
+def _inside_ring(point, ring):
+    '''
+    Even-odd test of a point against a closed ring
+    '''
+    a, b = ring[:-1], ring[1:]
+    straddles = (a[:, 1] > point[1]) != (b[:, 1] > point[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing_x = a[:, 0] + (point[1] - a[:, 1]) * (b[:, 0] - a[:, 0]) / (b[:, 1] - a[:, 1])
+    return bool(np.count_nonzero(straddles & (crossing_x > point[0])) % 2)
+
+
+def _inside_polygon(point, polygon):
+    return _inside_ring(point, polygon[0]) and not any(_inside_ring(point, hole) for hole in polygon[1:])
+
+
+def is_valid(polygons):
+    '''
+    True when the rings of MultiPolygon coordinates don't cross, every hole
+    is inside its exterior and outside the other holes, and no part is
+    inside another
+    '''
+    polygons = [[_closed(ring) for ring in polygon] for polygon in polygons]
+    if rings_intersect([ring for polygon in polygons for ring in polygon]):
+        return False
+    # without crossings a ring is inside or outside another as a whole, one
+    # vertex tells which
+    for polygon in polygons:
+        for k, hole in enumerate(polygon[1:]):
+            if not _inside_ring(hole[0], polygon[0]):
+                return False
+            if any(_inside_ring(hole[0], other) for other in polygon[1 + k + 1:]) or \
+               any(_inside_ring(other[0], hole) for other in polygon[1 + k + 1:]):
+                return False
+    for k, polygon in enumerate(polygons):
+        for other in polygons[k + 1:]:
+            if _inside_polygon(polygon[0][0], other) or _inside_polygon(other[0][0], polygon):
+                return False
+    return True
+
+
+def _simplify(geometry, depth, tolerance):
+    '''
+    Simplifies the rings, then halves the tolerance until the rings don't
+    cross or overlap each other either
+    '''
+    simplified = _simplify_rings(geometry, depth, tolerance)
+    if depth == 2:
+        return simplified
+    while not is_valid([simplified] if depth == 3 else simplified):
+        tolerance /= 2
+        if tolerance <= 0.01:
+            return geometry
+        simplified = _simplify_rings(geometry, depth, tolerance)
+    return simplified
+
+
+def _simplify_rings(geometry, depth, tolerance):
+    if depth == 2:
+        ring = np.asarray(geometry, dtype='float64')
+        closed = len(ring) > 0 and (ring[0] == ring[-1]).all()
+        if not closed:
+            ring = np.vstack([ring, ring[:1]])
+        simplified = simplify_ring(ring, tolerance, keep_collapsed=True)
+        return simplified.tolist() if closed else simplified[:-1].tolist()
+    if depth == 3:
+        exterior = simplify_ring(_closed(geometry[0]), tolerance, keep_collapsed=True)
+        holes = [simplify_ring(_closed(hole), tolerance) for hole in geometry[1:]]
+        return [exterior.tolist()] + [hole.tolist() for hole in holes if hole is not None]
+    polygons = []
+    for polygon in geometry:
+        exterior = simplify_ring(_closed(polygon[0]), tolerance)
+        if exterior is None:
+            continue
+        holes = [simplify_ring(_closed(hole), tolerance) for hole in polygon[1:]]
+        polygons.append([exterior.tolist()] + [hole.tolist() for hole in holes if hole is not None])
+    # never drop every part of a geometry
+    if len(polygons) == 0 and len(geometry) > 0:
+        largest = max(geometry, key=lambda polygon: len(polygon[0]))
+        polygons.append(_simplify_rings(largest, 3, tolerance))
+    return polygons
+
+
+def _closed(ring):
+    ring = np.asarray(ring, dtype='float64').reshape(-1, 2)
+    if len(ring) > 0 and (ring[0] != ring[-1]).any():
+        ring = np.vstack([ring, ring[:1]])
+    return ring
+
+
+# (geometry hash, tolerance) -> simplified geometry, for the geometries
+# AreaChange is created with over and over (one instance per year)
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+CACHE_SIZE = 64
+
+
+def simplify_geometry(geometry, tolerance):
+    '''
+    Simplifies a list of [longitude, latitude] pairs, a list of rings or
+    MultiPolygon coordinates, keeping its structure.
+
+    Arguments:
+        geometry: nested lists of [longitude, latitude] pairs
+        tolerance: maximum distance (meters) between the simplified and the
+                   original boundary
+    '''
+    if tolerance <= 0:
+        return geometry
+    key = (hashlib.sha256(json.dumps(geometry).encode()).hexdigest(), tolerance)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    simplified = _simplify(geometry, nesting_depth(geometry), tolerance)
+    with _cache_lock:
+        _cache[key] = simplified
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return simplified
+
+
+def clip_ring(ring, bbox):
+    '''
+    Sutherland-Hodgman clip of a closed ring to a rectangle. Returns the
+    clipped ring (closed) or None when nothing is left.
+    '''
+    min_x, min_y, max_x, max_y = bbox
+    points = [(float(point[0]), float(point[1])) for point in ring[:-1]]
+    edges = [(0, min_x, True), (0, max_x, False), (1, min_y, True), (1, max_y, False)]
+    for axis, limit, keep_above in edges:
+        if len(points) == 0:
+            return None
+        clipped = []
+        for k in range(len(points)):
+            current, previous = points[k], points[k - 1]
+            current_in = (current[axis] >= limit) if keep_above else (current[axis] <= limit)
+            previous_in = (previous[axis] >= limit) if keep_above else (previous[axis] <= limit)
+            if current_in != previous_in:
+                t = (limit - previous[axis]) / (current[axis] - previous[axis])
+                clipped.append(tuple(previous[i] + t * (current[i] - previous[i]) for i in range(2)))
+            if current_in:
+                clipped.append(current)
+        points = clipped
+    if len(points) < 3:
+        return None
+    return [list(point) for point in points] + [list(points[0])]
+
+
+def vertex_count(geometry):
+    depth = nesting_depth(geometry)
+    if depth <= 2:
+        return len(geometry)
+    return sum(vertex_count(part) for part in geometry)
+
+
+class GeometryPyramid:
+
+    def __init__(self, geometry, tolerances=TOLERANCES_METERS):
+        '''
+        Arguments:
+            geometry: list of [longitude, latitude] pairs, list of rings or
+                      MultiPolygon coordinates
+            tolerances: meters, one level per tolerance
+        '''
+        self.tolerances = sorted(tolerances)
+        self.levels = [simplify_geometry(geometry, tolerance) for tolerance in self.tolerances]
+        points = np.asarray([point for point in _points(geometry)], dtype='float64').reshape(-1, 2)
+        self.latitude = float(points[:, 1].mean()) if len(points) else 0.0
+
+    def vertex_counts(self):
+        '''
+        {tolerance: vertices} of every level
+        '''
+        return {tolerance: vertex_count(level) for tolerance, level in zip(self.tolerances, self.levels)}
+
+    def within_error(self, max_error):
+        '''
+        Coarsest level whose tolerance (meters) is at most max_error
+        '''
+        level = 0
+        for i, tolerance in enumerate(self.tolerances):
+            if tolerance <= max_error:
+                level = i
+        return self.levels[level]
+
+    def at_zoom(self, zoom):
+        '''
+        Coarsest level whose error is below half a screen pixel at a web map
+        zoom level
+        '''
+        meters_per_pixel = METERS_PER_PIXEL_ZOOM_0 * math.cos(math.radians(self.latitude)) / 2 ** zoom
+        return self.within_error(meters_per_pixel / 2)
+
+
+def _points(geometry):
+    if nesting_depth(geometry) <= 2:
+        yield from geometry
+    else:
+        for part in geometry:
+            yield from _points(part)
@@ -0,0 +1,166 @@
+'''
+The carbon analysis behind the Carbon Analysis page: for every year from
+2017 to 2021 it gets the vegetation change and the climate data of a
+geometry from Earth Engine (see area_change.py) and runs the GPP model
+over them.
+
+It doesn't touch Streamlit, so it can run on a background worker (see
+job_runner.py). Progress and the results of each finished year are
+reported through a callback instead of a progress bar.
+
+# Sample Usage
+
+-------------
+geometry = [[-124.14507547221648, 41.11806816998926],
+            [-124.14507547221648, 41.11457637941072],
+            [-124.1394964774655, 41.11457637941072],
+            [-124.1394964774655, 41.11806816998926]]
+
+def report(progress, message, partial):
+    print(progress, message)
+
+results = run_analysis(geometry, report=report)
+print(results['gpp_mean'])
+'''
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+# use project_contents/app/GPP_boost_mod.pkl for local
+MODEL_PATH = '/w210containermount/GPP_boost_mod.pkl'
+YEARS = [2017, 2018, 2019, 2020, 2021]
+
+# columns the GPP model was trained on, in order
+MODEL_COLUMNS = ['srad', 'tmmn', 'tmmx', 'vpd', 'Fpar_500m', 'Lai_500m', 'latitude', 'longitude', 'elevation', 'water_mean', 'trees_mean', 'grass_mean', 'flooded_vegetation_mean', 'crops_mean', 'shrub_and_scrub_mean', 'built_mean', 'bare_mean', 'snow_and_ice_mean', 'label_mode']
+
+# change code -> (vegetation type, +1 for gained or -1 for lost)
+CHANGE_TYPES = {1: ('Trees', 1),
+                2: ('Grass', 1),
+                3: ('Flooded_Vegetation', 1),
+                4: ('Crops', 1),
+                5: ('Shrub_Scrub', 1),
+                6: ('Trees', -1),
+                7: ('Grass', -1),
+                8: ('Flooded_Vegetation', -1),
+                9: ('Crops', -1),
+                10: ('Shrub_Scrub', -1)}
+VEGETATION_TYPES = ['Trees', 'Grass', 'Flooded_Vegetation', 'Crops', 'Shrub_Scrub']
+
+
+class AreaTooLarge(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def load_model(path=MODEL_PATH):
+    '''
+    Loads the GPP model once per process
+    '''
+    import joblib
+    return joblib.load(path)
+
+
+def prepare_for_model(result):
+    '''
+    Re-formats the climate data of AreaChange for model inference
+    '''
+    result = result.reindex(columns=MODEL_COLUMNS)
+    result['Fpar_500m'] = result['Fpar_500m'].astype("float64")
+    result['Lai_500m'] = result['Lai_500m'].astype("float64")
+    result['label_mode'] = result['label_mode'].astype("category")
+    return result.rename(columns={"latitude": "LATITUDE_x", "longitude": "LONGITUDE_x", "elevation": "ee_elevation", "label_mode": "label_argmax_numeric"})
+
+
+def predict_gpp(result, service=None):
+    '''
+    Runs the model over the pixels of the climate data and aggregates the
+    predictions to a single GPP value (metric tons) for the entire geometry.
+    The model runs in the inference service shared by every session (see
+    inference_service.py).
+    '''
+    if service is None:
+        # imported here, inference_service imports this module
+        from inference_service import get_inference_service
+        service = get_inference_service()
+    predicted_results = service.predict(prepare_for_model(result)).result()
+    return np.sum(predicted_results) / 1000000
+
+
+def sum_vegetation_change(year, area_change):
+    '''
+    Net area gained (positive) or lost (negative) per vegetation type from
+    the list of {'change': code, 'sum': area} of get_area_of_change. This is
+    the change of the year alone, so tiles and parcels can be summed; see
+    cumulative_change for the totals the page shows.
+    '''
+    row = {'Year': year}
+    row.update({vegetation: 0 for vegetation in VEGETATION_TYPES})
+    for dict_area in area_change:
+        change_type = CHANGE_TYPES.get(dict_area.get('change'))
+        if change_type is not None:
+            vegetation, sign = change_type
+            row[vegetation] += sign * dict_area.get('sum')
+    return row
+
+
+def cumulative_change(land_change):
+    '''
+    Running totals over the years of the per-year rows of
+    sum_vegetation_change, what the Vegetation Net Gain and Loss chart
+    shows (the net change since the first year analysed)
+    '''
+    land_change = pd.DataFrame(land_change, columns=['Year'] + VEGETATION_TYPES).sort_values('Year').reset_index(drop=True)
+    land_change[VEGETATION_TYPES] = land_change[VEGETATION_TYPES].cumsum()
+    return land_change
+
+
+def run_analysis(geometry, token=None, report=None, years=YEARS):
+    '''
+    Gets the vegetation change and predicts the GPP of a geometry for every
+    year.
+
+    Arguments:
+        geometry: list of [longitude, latitude] pairs (or an ee.Geometry)
+        token: CancellationToken checked before every Earth Engine request
+        report: function(progress, message, partial) called after every
+                year. progress is 0-100 and partial holds the results so far.
+        years: years to analyse
+
+    Returns:
+        {'land_change': [{'Year': ..., 'Trees': ..., ...}],
+         'gpp': [{'Year': ..., 'GPP': ...}],
+         'gpp_mean': float}
+    '''
+    # imported here, importing area_change logs in to Earth Engine
+    from area_change import AreaChange # Custom module for GEE calls
+    from change_index import USE_CHANGE_INDEX, get_change_index
+
+    report = report if report is not None else (lambda progress, message, partial: None)
+    land_change = []
+    gpp = []
+
+    report(5, "Retrieving climate data and running carbon predictions for selected area...", None)
+
+    for i, year in enumerate(years):
+        ac = AreaChange(geometry, year, token=token)
+
+        if ac.is_area_within_limits() == False:
+            raise AreaTooLarge('Area is too large for Google Earth Engine API processing. Please reduce the size of your selected area.')
+
+        # Get the carbon capture change by vegetation type for specified geometry and year,
+        # from the local index of the neighborhood when it is enabled (see change_index.py)
+        if USE_CHANGE_INDEX and isinstance(geometry, list):
+            area_change = get_change_index(geometry, year, token=token).area_of_change(geometry)
+        else:
+            area_change = ac.get_area_of_change()
+        land_change.append(sum_vegetation_change(year, area_change))
+
+        # Get climate data for specified geometry and year and run model predictions on it
+        gpp.append({'Year': year, 'GPP': predict_gpp(ac.get_change_that_might_occur())})
+
+        partial = {'land_change': land_change, 'gpp': gpp}
+        report(5 + 95 * (i + 1) // len(years), f"Carbon predictions complete for {year}...", partial)
+
+    return {'land_change': land_change,
+            'gpp': gpp,
+            'gpp_mean': float(pd.DataFrame(gpp)["GPP"].mean())}
@@ -0,0 +1,138 @@
+'''
+Import-time report for the Streamlit pages, to keep cold starts fast.
+
+The module level imports of every page are run in a fresh interpreter with
+python -X importtime, and the time is broken down by the top level modules
+the page imports (each module's time includes everything it imports in
+turn, modules the interpreter imports at startup are left out). Each page
+is imported a few times and the fastest time of every module is kept, to
+take out the noise of a busy machine.
+
+A report can be saved as a baseline and later reports compared with it:
+modules that got slower than the tolerance allows are listed and the exit
+status is 1, so it can run as a check.
+
+Usage (from the Streamlit folder, like the app):
+    python project_contents/app/import_profile.py
+    python project_contents/app/import_profile.py --save import_baseline.json
+    python project_contents/app/import_profile.py --baseline import_baseline.json --tolerance 1.5
+'''
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+PAGES = ['Home.py', 'pages/Carbon_Analysis.py']
+
+# slower modules under this many milliseconds aren't reported as regressions
+MIN_REGRESSION_MS = 50
+
+
+def module_imports(page_path):
+    '''
+    Source of the import statements at the module level of a page
+    '''
+    with open(page_path) as f:
+        tree = ast.parse(f.read())
+    statements = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+    return '\n'.join(ast.unparse(statement) for statement in statements)
+
+
+def run_importtime(code):
+    '''
+    Runs code with -X importtime. Returns ({top level module: cumulative
+    milliseconds}, wall seconds).
+    '''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [APP_DIR, os.environ.get('PYTHONPATH')])))
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                               capture_output=True, text=True, env=env)
+    wall = time.perf_counter() - started
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+
+    modules = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, package = line[len('import time:'):].split('|')
+        # nested imports are indented under the module importing them
+        if package[1:].startswith(' '):
+            continue
+        name = package.strip().split('.')[0]
+        modules[name] = modules.get(name, 0) + int(cumulative) / 1000
+    return modules, wall
+
+
+def profile(pages=PAGES, repeat=3):
+    '''
+    {page: {'modules': {module: ms}, 'total_ms': ..., 'wall_s': ...}}
+    '''
+    startup, _ = run_importtime('pass')
+    report = {}
+    for page in pages:
+        code = module_imports(os.path.join(APP_DIR, page))
+        runs = [run_importtime(code) for _ in range(repeat)]
+        wall = min(run_wall for _, run_wall in runs)
+        modules = {name: min(run_modules.get(name, ms) for run_modules, _ in runs)
+                   for name, ms in runs[0][0].items() if name not in startup}
+        report[page] = {'modules': dict(sorted(modules.items(), key=lambda item: -item[1])),
+                        'total_ms': sum(modules.values()),
+                        'wall_s': wall}
+    return report
+
+
+def print_report(report, top=15):
+    for page, result in report.items():
+        print(f"{page}: {result['total_ms']:.0f} ms of imports, {result['wall_s']:.2f} s interpreter start to exit")
+        for name, ms in list(result['modules'].items())[:top]:
+            print(f'    {name:<24}{ms:>10.1f} ms')
+
+
+def regressions(report, baseline, tolerance):
+    '''
+    (page, module, baseline ms, ms) of the modules that got slower than
+    tolerance x their baseline time
+    '''
+    slower = []
+    for page, result in report.items():
+        before = baseline.get(page, {}).get('modules', {})
+        for name, ms in result['modules'].items():
+            limit = max(before.get(name, 0) * tolerance, before.get(name, 0) + MIN_REGRESSION_MS)
+            if ms > limit:
+                slower.append((page, name, before.get(name, 0), ms))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import-time report of the Streamlit pages')
+    parser.add_argument('pages', nargs='*', default=PAGES, help='pages relative to the app folder')
+    parser.add_argument('--save', help='write the report to this JSON file')
+    parser.add_argument('--baseline', help='compare with a report saved with --save')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='allowed slowdown factor per module')
+    parser.add_argument('--repeat', type=int, default=3, help='imports per page, the fastest is kept')
+    args = parser.parse_args()
+
+    report = profile(args.pages, args.repeat)
+    print_report(report)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(report, baseline, args.tolerance)
+        for page, name, before, ms in slower:
+            print(f'REGRESSION {page}: {name} {before:.1f} ms -> {ms:.1f} ms')
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
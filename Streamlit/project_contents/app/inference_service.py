@@ -0,0 +1,280 @@
+'''
+Inference service that owns the GPP model for every session of the app.
+
+Each session used to call model.predict on its own thread, so concurrent
+analyses took turns on the GIL for the CPU bound part. Sessions now hand
+their features to the service and get a Future back. A collector thread
+gathers the requests that arrive within a short window (WINDOW_MS, or until
+BATCH_ROWS rows are waiting) into one micro-batch and evaluates it on a pool
+of worker processes, each holding its own copy of the model, then splits
+the predictions back to the requests. Requests larger than a batch are cut
+into several batches, so a big geometry spreads over the workers too.
+
+No more batches are sent than the workers can take at once; while they are
+busy, new requests wait and make the next batch bigger.
+
+When a worker process dies (e.g. out of memory) the pool can't be used
+again, so it is replaced by a new one and the requests of the batches that
+were on it are sent once more, one by one. A request that kills a worker
+again fails, the others get their predictions.
+
+Settings (environment variables):
+    CALCULATOR_INFERENCE_WORKERS: worker processes, 0 evaluates in the
+                                  collector thread of this process
+    CALCULATOR_INFERENCE_BATCH_ROWS: rows of a micro-batch
+    CALCULATOR_INFERENCE_WINDOW_MS: how long a batch waits for more requests
+
+# Sample Usage
+
+-------------
+service = get_inference_service()
+future = service.predict(prepare_for_model(climate_data))
+predictions = future.result()
+print(service.stats())
+'''
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from gpp_analysis import MODEL_PATH, load_model
+
+WORKERS = int(os.environ.get('CALCULATOR_INFERENCE_WORKERS', str(min(4, os.cpu_count() or 1))))
+BATCH_ROWS = int(os.environ.get('CALCULATOR_INFERENCE_BATCH_ROWS', '20000'))
+WINDOW_MS = float(os.environ.get('CALCULATOR_INFERENCE_WINDOW_MS', '20'))
+
+# model of a worker process
+_model = None
+
+
+def _load_worker_model(model_path):
+    global _model
+    _model = load_model(model_path)
+
+
+def _predict(features):
+    return np.asarray(_model.predict(features))
+
+
+class InferenceService:
+
+    def __init__(self, model_path=MODEL_PATH, workers=WORKERS, batch_rows=BATCH_ROWS, window_ms=WINDOW_MS):
+        '''
+        Arguments:
+            model_path: pickled GPP model
+            workers: worker processes, 0 to evaluate in this process
+            batch_rows: rows of a micro-batch
+            window_ms: how long a batch waits for more requests (milliseconds)
+        '''
+        self.model_path = model_path
+        self.workers = workers
+        self.batch_rows = batch_rows
+        self.window = window_ms / 1000
+        self.executor = self.create_executor() if workers > 0 else None
+        self.requests = queue.Queue()
+        # batches sent and not finished yet, at most one per worker
+        self.slots = threading.Semaphore(max(1, workers))
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.rows = 0
+        self.requests_served = 0
+        self.batch_seconds = 0.0
+        self.broken_pools = 0
+        self.collector = threading.Thread(target=self.collect, name='inference-collector', daemon=True)
+        self.collector.start()
+
+    def create_executor(self):
+        # spawned, forking the threads of Streamlit and Earth Engine isn't safe
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_load_worker_model,
+                                   initargs=(self.model_path,))
+
+    def replace_executor(self, broken):
+        '''
+        Replaces a pool broken by a dead worker, once per broken pool.
+        Returns the pool to use.
+        '''
+        with self.lock:
+            if self.executor is broken:
+                self.executor = self.create_executor()
+                self.broken_pools += 1
+                broken.shutdown(wait=False)
+            return self.executor
+
+    def predict(self, features):
+        '''
+        Queues features (a DataFrame from gpp_analysis.prepare_for_model).
+        Returns a Future of the array of predictions, one per row.
+        '''
+        future = Future()
+        if len(features) == 0:
+            future.set_result(np.empty(0))
+            return future
+
+        pieces = [features.iloc[start:start + self.batch_rows] for start in range(0, len(features), self.batch_rows)]
+        if len(pieces) == 1:
+            self.requests.put((pieces[0], future))
+            return future
+
+        piece_futures = [Future() for _ in pieces]
+        remaining = [len(pieces)]
+        remaining_lock = threading.Lock()
+
+        def piece_done(_):
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            errors = [piece.exception() for piece in piece_futures if piece.exception() is not None]
+            if future.done():
+                return
+            if errors:
+                future.set_exception(errors[0])
+            else:
+                future.set_result(np.concatenate([piece.result() for piece in piece_futures]))
+
+        for piece, piece_future in zip(pieces, piece_futures):
+            piece_future.add_done_callback(piece_done)
+            self.requests.put((piece, piece_future))
+        return future
+
+    def collect(self):
+        '''
+        Collector thread: waits for a free worker, then gathers requests for
+        up to the window into a batch and sends it
+        '''
+        while True:
+            self.slots.acquire()
+            batch = [self.requests.get()]
+            rows = len(batch[0][0])
+            deadline = time.monotonic() + self.window
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                rows += len(request[0])
+                if rows >= self.batch_rows:
+                    break
+            try:
+                self.send(batch)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                self.slots.release()
+
+    def send(self, batch):
+        features = pd.concat([request_features for request_features, _ in batch])
+        # categories differ between requests, concat turns those columns to object
+        for column in batch[0][0].columns:
+            if isinstance(batch[0][0][column].dtype, pd.CategoricalDtype):
+                features[column] = features[column].astype('category')
+        started = time.monotonic()
+
+        def done():
+            with self.lock:
+                self.batches += 1
+                self.rows += len(features)
+                self.requests_served += len(batch)
+                self.batch_seconds += time.monotonic() - started
+            self.slots.release()
+
+        self.evaluate(batch, features, done)
+
+    def evaluate(self, batch, features, then, retry=True):
+        '''
+        Predicts a batch on the pool (or in this thread), hands the
+        predictions to the requests and calls then()
+        '''
+        executor = self.executor
+
+        def finish(done):
+            try:
+                predictions = done.result()
+                offset = 0
+                for request_features, future in batch:
+                    # a caller may have cancelled its future meanwhile
+                    if not future.done():
+                        future.set_result(predictions[offset:offset + len(request_features)])
+                    offset += len(request_features)
+            except BrokenProcessPool as e:
+                self.replace_executor(executor)
+                if retry:
+                    print(f"Inference worker died, retrying {len(batch)} requests one by one on a new pool: {e}")
+                    self.evaluate_separately(batch, then)
+                    return
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            then()
+
+        if executor is not None:
+            try:
+                submitted = executor.submit(_predict, features)
+            except BrokenProcessPool:
+                # broken by a batch that finished meanwhile
+                executor = self.replace_executor(executor)
+                submitted = executor.submit(_predict, features)
+            submitted.add_done_callback(finish)
+        else:
+            done = Future()
+            try:
+                done.set_result(np.asarray(load_model(self.model_path).predict(features)))
+            except Exception as e:
+                done.set_exception(e)
+            finish(done)
+
+    def evaluate_separately(self, batch, then):
+        '''
+        Sends the requests of a batch that broke the pool once more, each on
+        its own and one after the other, so only a request that kills a
+        worker again fails. The batch keeps its slot until the last one.
+        '''
+        remaining = list(batch)
+
+        def next_request():
+            if len(remaining) == 0:
+                then()
+                return
+            request = remaining.pop(0)
+            self.evaluate([request], request[0], next_request, retry=False)
+
+        next_request()
+
+    def stats(self):
+        '''
+        Batches evaluated, mean rows and requests per batch, mean seconds per
+        batch, requests waiting and pools replaced after a worker died
+        '''
+        with self.lock:
+            return {'workers': self.workers,
+                    'batches': self.batches,
+                    'requests': self.requests_served,
+                    'mean_rows': self.rows / self.batches if self.batches else 0.0,
+                    'mean_requests': self.requests_served / self.batches if self.batches else 0.0,
+                    'mean_seconds': self.batch_seconds / self.batches if self.batches else 0.0,
+                    'waiting': self.requests.qsize(),
+                    'broken_pools': self.broken_pools}
+
+
+@lru_cache(maxsize=None)
+def get_inference_service(model_path=MODEL_PATH):
+    '''
+    The inference service shared by every session of this process
+    '''
+    return InferenceService(model_path)
@@ -0,0 +1,195 @@
+'''
+Runs carbon analyses (see gpp_analysis.py) as background jobs so the
+Carbon Analysis page doesn't block on Earth Engine for minutes.
+
+Submitting a geometry returns a job id right away. Jobs wait in an
+in-process queue and are picked up by a fixed pool of worker threads, so
+the number of analyses running against Earth Engine at once is bounded
+(CALCULATOR_MAX_ANALYSES, 2 by default). The status, progress, partial
+results and final results of every job are kept in a SQLite table
+(CALCULATOR_JOB_DB), so the page can poll a job by id and a finished job
+can be opened again later from its URL (?job=<id>).
+
+# Sample Usage
+
+-------------
+runner = get_job_runner()
+job_id = runner.submit(geometry, session_id=session_id)
+job = runner.get(job_id)
+print(job['status'], job['progress'], job['message'])
+'''
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from gpp_analysis import run_analysis # Custom module running the GEE calls and model predictions
+from cancellation import AnalysisCancelled, CancellationToken, supersede, release
+
+JOB_DB = os.environ.get('CALCULATOR_JOB_DB', 'calculator_jobs.sqlite')
+MAX_ANALYSES = int(os.environ.get('CALCULATOR_MAX_ANALYSES', '2'))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class JobRunner:
+
+    COLUMNS = ['id', 'status', 'geometry', 'progress', 'message', 'partial', 'result', 'error', 'created', 'updated']
+
+    def __init__(self, db_path=JOB_DB, workers=MAX_ANALYSES, analysis=run_analysis):
+        '''
+        Arguments:
+            db_path: SQLite file holding the job table
+            workers: how many analyses run at once
+            analysis: function(geometry, token, report) returning the
+                      results of a job
+        '''
+        self.db_path = db_path
+        self.analysis = analysis
+        self.queue = queue.Queue()
+        # job id -> (session id, token) of the jobs not finished yet
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+        with self.connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                              id TEXT PRIMARY KEY,
+                              status TEXT NOT NULL,
+                              geometry TEXT NOT NULL,
+                              progress INTEGER NOT NULL DEFAULT 0,
+                              message TEXT,
+                              partial TEXT,
+                              result TEXT,
+                              error TEXT,
+                              created REAL NOT NULL,
+                              updated REAL NOT NULL)''')
+            # the threads running these died with the previous process
+            db.execute('UPDATE jobs SET status = ?, error = ?, updated = ? WHERE status = ?',
+                       (FAILED, 'The server restarted while the analysis was running.', time.time(), RUNNING))
+            queued = [row[0] for row in db.execute('SELECT id FROM jobs WHERE status = ? ORDER BY created', (QUEUED,))]
+
+        for job_id in queued:
+            self.tokens[job_id] = (None, CancellationToken())
+            self.queue.put(job_id)
+
+        self.workers = [threading.Thread(target=self.work, name=f'analysis-worker-{i}', daemon=True) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def connect(self):
+        # one connection per call, sqlite connections can't be shared between threads
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def submit(self, geometry, session_id=None):
+        '''
+        Queues an analysis of geometry and returns its job id. A new job of
+        a session cancels the job that session submitted before.
+        '''
+        job_id = uuid.uuid4().hex
+        token = supersede(session_id) if session_id is not None else CancellationToken()
+        now = time.time()
+        with self.connect() as db:
+            db.execute('INSERT INTO jobs (id, status, geometry, message, created, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                       (job_id, QUEUED, json.dumps(geometry), 'Waiting for an analysis worker...', now, now))
+        with self.lock:
+            self.tokens[job_id] = (session_id, token)
+        self.queue.put(job_id)
+        return job_id
+
+    def get(self, job_id):
+        '''
+        The job as a dictionary (partial and result decoded from JSON), None
+        for an unknown id
+        '''
+        with self.connect() as db:
+            row = db.execute(f'SELECT {", ".join(self.COLUMNS)} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(self.COLUMNS, row))
+        for column in ['geometry', 'partial', 'result']:
+            if job[column] is not None:
+                job[column] = json.loads(job[column])
+        job['position'] = self.position(job_id) if job['status'] == QUEUED else None
+        return job
+
+    def position(self, job_id):
+        '''
+        How many jobs are queued ahead of a queued job
+        '''
+        with self.queue.mutex:
+            waiting = list(self.queue.queue)
+        return waiting.index(job_id) if job_id in waiting else 0
+
+    def cancel(self, job_id):
+        with self.lock:
+            entry = self.tokens.get(job_id)
+        if entry is not None:
+            entry[1].cancel()
+
+    def update(self, job_id, **fields):
+        fields['updated'] = time.time()
+        for column in ['partial', 'result']:
+            if column in fields:
+                fields[column] = json.dumps(fields[column])
+        assignments = ', '.join(f'{column} = ?' for column in fields)
+        with self.connect() as db:
+            db.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', list(fields.values()) + [job_id])
+
+    def work(self):
+        while True:
+            job_id = self.queue.get()
+            try:
+                self.run(job_id)
+            finally:
+                self.queue.task_done()
+
+    def run(self, job_id):
+        with self.lock:
+            session_id, token = self.tokens.get(job_id, (None, CancellationToken()))
+        try:
+            if token.cancelled:
+                self.update(job_id, status=CANCELLED, message=token.reason)
+                return
+            with self.connect() as db:
+                geometry = json.loads(db.execute('SELECT geometry FROM jobs WHERE id = ?', (job_id,)).fetchone()[0])
+            self.update(job_id, status=RUNNING, message='Starting analysis...')
+
+            def report(progress, message, partial):
+                fields = {'progress': progress, 'message': message}
+                if partial is not None:
+                    fields['partial'] = partial
+                self.update(job_id, **fields)
+
+            result = self.analysis(geometry, token, report)
+            self.update(job_id, status=DONE, progress=100, message='Analysis complete.', result=result)
+        except AnalysisCancelled as e:
+            self.update(job_id, status=CANCELLED, message=str(e))
+        except Exception as e:
+            self.update(job_id, status=FAILED, error=str(e), message='Analysis failed.')
+        finally:
+            with self.lock:
+                self.tokens.pop(job_id, None)
+            if session_id is not None:
+                release(session_id, token)
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    '''
+    The job runner shared by every session of this process
+    '''
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = JobRunner()
+        return _runner
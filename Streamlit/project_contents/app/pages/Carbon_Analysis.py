@@ -1,26 +1,23 @@
 import json
 import numpy as np
 import pandas as pd
-import random # DELETE THIS LATER
 import streamlit as st
-import datetime
-import ee 
-import joblib
-import geemap
-import nltk
-import sklearn
-from area_change import AreaChange # Custom module for GEE calls
-from geopy.geocoders import GoogleV3
-import geopy.distance
-import googlemaps
-from bokeh.plotting import figure,show
+import time
+from tower_index import load_tower_index # Custom module for nearby flux towers
+from county_index import load_county_index # Custom module for county geometries
+from county_precompute import load_county_store # Custom module for precomputed county results
+from gpp_analysis import cumulative_change # Custom module for the carbon analysis results
+from job_runner import get_job_runner, QUEUED, FAILED, CANCELLED, FINISHED # Custom module running analyses in the background
+import uuid
+from bokeh.plotting import figure
 from bokeh.plotting import gmap
 from bokeh.models import GMapOptions
-from bokeh.io import output_notebook, output_file, curdoc, show
-from bokeh.models import ColumnDataSource, TapTool, PolyDrawTool, PolyEditTool, MultiLine, Selection, Span, HoverTool, Legend
-from bokeh.models.callbacks import CustomJS
+from bokeh.models import ColumnDataSource, Span, HoverTool, Legend
 from bokeh.models import GeoJSONDataSource
-from bokeh.palettes import GnBu3, OrRd3
+
+# Heavy modules are imported where they are used: Earth Engine (and its login) only when an
+# analysis runs, scikit-learn only when the tower index is built. Run import_profile.py to
+# check how long this page takes to import.
 
 
 ### GLOBAL VARIABLES & SETTINGS
@@ -33,6 +30,9 @@ with open('project_contents/app/style.css') as f:
 api_key = '' # Add your own Google Maps api key in this field
 bokeh_width, bokeh_height = 700,600
 
+# Seconds between two checks of a running analysis
+POLL_SECONDS = 2
+
 # Set Streamlit page details
 st.markdown("# Carbon Analysis")
 st.write("""You've taken the first step to understand Carbon Absorption Loss from Continued Urbanization by visiting this page. Here you will perform your detailed Carbon Analysis, but before we begin we need to understand a little bit more about what type of analysis you want to perform. Please choose your analysis options in Step 1 below.""")
@@ -46,9 +46,12 @@ def plot(lat, lng, pa, isCountyAnalysis=False):
     map_type='satellite'
 
     if isCountyAnalysis == True:
-       area_coordinates = pa
+       geometry_type = 'MultiPolygon'
        zoom=8
+       # pa is a GeometryPyramid, draw the level that's accurate to a pixel at this zoom
+       area_coordinates = pa.at_zoom(zoom)
     else:
+       geometry_type = 'Polygon'
        zoom=12
        area_coordinates = [[[ pa[0][0], pa[0][1] ], [ pa[1][0], pa[1][1] ], [ pa[2][0], pa[2][1] ], [ pa[3][0], pa[3][1] ]]]
     
@@ -58,7 +61,7 @@ def plot(lat, lng, pa, isCountyAnalysis=False):
       'features':[{
           'type': 'Feature',
           'geometry': {
-            'type': 'Polygon',
+            'type': geometry_type,
             'coordinates': area_coordinates
           }
       }]
@@ -76,10 +79,11 @@ def plot(lat, lng, pa, isCountyAnalysis=False):
     
     return p
 
-def render_site_selection():
+def render_site_selection(county_index):
     """This method renders the input controls for site analysis"""
     
     # Create GeoCoder class from Google Maps
+    from geopy.geocoders import GoogleV3
     geolocator = GoogleV3(api_key=api_key)
     
     # Create 2x2 Grid for Lat/Lon coordinate input
@@ -108,126 +112,71 @@ def render_site_selection():
     # Display the Bokeh Google Map in Streamlit. Nice!
     st.bokeh_chart(p, use_container_width=False)
 
+    # Show the county the selected area is in
+    selected_county = county_index.county_at(center_lon, center_lat)
+    if selected_county is not None:
+        st.write("Your selected area is in " + selected_county + " County.")
+
+    # Show the AmeriFlux towers closest to the selected area
+    render_nearby_towers(polygon_array.astype(float).tolist())
+
     return polygon_array.astype(float).tolist()
 
-def render_county_selection(county_list, county_data):
-    """This method renders the input controls for county analysis"""
+def render_nearby_towers(polygon, k=5):
+    """This method renders the AmeriFlux towers (measured GPP) closest to the selected area"""
 
-    # Holder for user selected geometry
-    polygon_array = []
+    # Tower index is built once per process and cached by the module
+    nearby = load_tower_index().nearest_to_polygon(polygon, k=k)
+    nearby['distance_km'] = nearby['distance_km'].round(1)
+    nearby = nearby.rename(columns={'SITE_ID': 'Tower', 'LULC': 'Land Cover (IGBP)', 'LATITUDE': 'Latitude', 'LONGITUDE': 'Longitude', 'ELEVATION': 'Elevation (m)', 'distance_km': 'Distance (km)'})
 
-    # List to hold lat/lon pairs for GeoJson format
-    county_coordinates_list = list()
+    st.write("Nearby reference towers: these AmeriFlux towers measure GPP close to your selected area.")
+    st.dataframe(nearby)
+
+    return True
+
+def render_county_selection(county_index):
+    """This method renders the input controls for county analysis"""
 
     # Populate the county selection box and grab the first value as the selected value
-    selected_county = st.selectbox("Please select a county for analysis:", county_list)
-
-    # Enumerate through list to find selected County. NEED TO OPTIMIZE IN FUTURE.
-    for i in range(len(county_list)):
-
-       # See if the county name in JSON matches selected county name in interface
-       if county_data["features"][i]["properties"]["ADM2_NAME"] == selected_county:
-           
-           # Extract the geometry into an array
-           if "coordinates" in county_data["features"][i]["geometry"]:
-
-              county_coordinates_array = np.array(county_data["features"][i]["geometry"]["coordinates"])
-
-              # Determine if the geometry has nested lists, shape of array is 2 vs 3 implies nested lists
-              if len(county_coordinates_array.shape) == 2:
-
-                  # Determine how many nested lists of lat/lon pairs we have
-                  num_coordinates = county_coordinates_array.shape[0]
-
-                  # Enumerate all nested lists to extract lat/lon pairs and put into a single list
-                  for i in range(num_coordinates):
-
-                      # Get the sub array of coordinates and append to single growing list
-                      sub_coordinates = county_coordinates_array[i]
-                      county_coordinates_list.extend(sub_coordinates[0])
-                            
-                  # Conver list to array to compute center lat and lon
-                  wrapping_list = list()
-                  wrapping_list.append(county_coordinates_list)
-                  county_coordinates_array = np.asarray(county_coordinates_list)
-                  center_county = county_coordinates_array.mean(axis=0)
-                  lat_center = float(center_county[1])
-                  lon_center = float(center_county[0])
-
-                  # Call plot function to create the Bokeh Google Map
-                  p = plot(lat_center, lon_center, wrapping_list, True)
-                  polygon_array = wrapping_list
-
-              else:
-                  # Extract data directly into array and lists
-                  county_coordinates_list = county_data["features"][i]["geometry"]["coordinates"]
-                  county_coordinates_array = np.array(county_data["features"][i]["geometry"]["coordinates"])
-
-                  # Computer center of the county
-                  center_county = county_coordinates_array[0].mean(axis=0)
-                  lat_center = float(center_county[1])
-                  lon_center = float(center_county[0])
-
-                  # Call plot function to create the Bokeh Google Map
-                  p = plot(lat_center, lon_center, county_coordinates_list, True)
-                  polygon_array = county_coordinates_list
-
-           else:
-               county_coordinates = np.array(county_data["features"][i]["geometry"]["geometries"])
-               num_geometries = county_coordinates.shape[0]
-
-               # Enumerate through list of geometries
-               for i in range(num_geometries):
-                   # Get the sub array of coordinates and append to single growing list
-                   sub_coordinates = county_coordinates[i]["coordinates"]
-                   num_sub_coordinates = len(sub_coordinates[0])
-
-                   if num_sub_coordinates == 2:
-                       #print(sub_coordinates[0])
-                       #print(num_sub_coordinates)
-                       county_coordinates_list.extend(sub_coordinates)
-                   else:
-                       county_coordinates_list.extend(sub_coordinates[0])
-                     
-               # Conver list to array to compute center lat and lon
-               wrapping_list = list()
-               wrapping_list.append(county_coordinates_list)
-               county_coordinates_array = np.asarray(county_coordinates_list)
-               center_county = county_coordinates_array.mean(axis=0)
-               lat_center = float(center_county[1])
-               lon_center = float(center_county[0])
-
-               # Call plot function to create the Bokeh Google Map
-               p = plot(lat_center, lon_center, wrapping_list, True)
-               polygon_array = wrapping_list
-    
-           # Display the Bokeh Google Map in Streamlit. Nice!
-           st.bokeh_chart(p, use_container_width=True)
+    selected_county = st.selectbox("Please select a county for analysis:", county_index.names)
+
+    # The county index holds every county as a normalized MultiPolygon, so this is a lookup
+    lon_center, lat_center = county_index.centroid(selected_county)
+    polygon_array = county_index.multipolygon(selected_county)
+
+    # Call plot function to create the Bokeh Google Map with a simplified boundary
+    p = plot(float(lat_center), float(lon_center), county_index.pyramid(selected_county), True)
 
-    return polygon_array
+    # Display the Bokeh Google Map in Streamlit. Nice!
+    st.bokeh_chart(p, use_container_width=True)
 
-def get_analysis_settings(county_list, county_data):
+    return selected_county, polygon_array
+
+def get_analysis_settings(county_index):
     """This method is used to get the user selections in terms of what analysis they want to perform"""
 
     selected_geometry = []
+    selected_county = None
 
     st.subheader('Step 1: Tells us more about your analysis')
     st.write("With our product you can analyze carbon absorption loss for a selected area within the contiguous United States by providing 4 pairs of latitude and longitude coordinates. Once you enter your coordinates we will provide the carbon absorption estimates over a 5 year period from 2017 through 2021.")
-    analysis_location = st.selectbox('Please select your type of analysis. Right now only Site Analysis is available. However, we plan to add additional options in the future.', ('Select...', 'Site Analysis')) # Add back 'County Analysis' at future date
+    analysis_location = st.selectbox('Please select your type of analysis. County Analysis shows results precomputed for Northern California counties.', ('Select...', 'Site Analysis', 'County Analysis'))
 
     if analysis_location == 'Site Analysis':
-       selected_geometry = render_site_selection()
+       selected_geometry = render_site_selection(county_index)
     elif analysis_location == 'County Analysis':
-       selected_geometry = render_county_selection(county_list, county_data)
+       selected_county, selected_geometry = render_county_selection(county_index)
 
     if (analysis_location != "Select..."):
-       return True, selected_geometry
+       return True, selected_geometry, selected_county
 
-    return False, selected_geometry
+    return False, selected_geometry, selected_county
 
 def render_carbon_results():
     """This method is used to render the chart for the carbon gain and loss for a selected vegetated area"""
 
+    import random # DELETE THIS LATER
     data = random.sample(range(10,500), 12) # DELETE THIS LATER, SHOULD POINT TO compute_change_in_region()
     data[6:] = [-x for x in data[6:]]
     
@@ -403,119 +352,71 @@ def run_carbon_calculator(GPP_mean):
     return True
 
 def get_GEE_data(geometry):
-    """This method makes calls to GEE to get LAI, FPAR, and land use/coverage data for a specified geometry. This is required for running model predictions."""
-    
-    # Set up variables for GEE runs and collecting results
-    year_list = [2017, 2018, 2019, 2020, 2021]
-    area_change_list = []
-    sum_trees = 0
-    sum_grass = 0
-    sum_flooeded_vegetation = 0
-    sum_crops = 0
-    sum_shrub_scrub = 0
-    land_change_df = pd.DataFrame()
-    GPP_df = pd.DataFrame()
-
-    # Create progress bar as these operations are length ;-)
-    progress_time = 10
-    progress_bar = st.progress(progress_time)
-
-    st.write("Retrieving climate data and running carbon predictions for selected area...") # let user know what we are doing
-
-    # Load model
-    # use project_contents/app/GPP_boost_mod.pkl for local
-    saved_knn = joblib.load('/w210containermount/GPP_boost_mod.pkl')
-
-    # Get biome data and run predictions for all 5 years
-    for i in range(len(year_list)):
-
-        # Grab the current year from the list
-        year = year_list[i]
-
-        # Create instance of custom AreaChange class for GEE calls
-        #ac = AreaChange()
-        ac = AreaChange(geometry, year)
-
-        if ac.is_area_within_limits() == False:
-            e = RuntimeError('Area is too large for Google Earth Engine API processing. Please reduce the size of your selected area.')
-            st.exception(e)
-            return None, None, None
-
-        # Get the carbon capture change by vegetation type for specified geometry and year
-        #change_list = ac.get_area_of_change(geometry, year)
-        change_list = ac.get_area_of_change()
-
-        area_change_list.append(change_list)
-
-        # Get climage data for specified geometry and year
-        #result = ac.get_climate_data_for_change(geometry, year)
-        #result = ac.get_climate_data_for_change_and_join()
-        result = ac.get_change_that_might_occur()
-        #within_gee_limit = ac.is_area_within_limits()
-
-        # Re-format the climate data for model inference
-        result = result.reindex(columns=['srad', 'tmmn', 'tmmx', 'vpd', 'Fpar_500m', 'Lai_500m', 'latitude', 'longitude', 'elevation', 'water_mean', 'trees_mean', 'grass_mean', 'flooded_vegetation_mean', 'crops_mean', 'shrub_and_scrub_mean', 'built_mean', 'bare_mean', 'snow_and_ice_mean', 'label_mode'])
-        result['Fpar_500m'] = result['Fpar_500m'].astype("float64")
-        result['Lai_500m'] = result['Lai_500m'].astype("float64")
-        result['label_mode'] = result['label_mode'].astype("category")
-        result.rename(columns={"latitude": "LATITUDE_x", "longitude": "LONGITUDE_x", "elevation": "ee_elevation", "label_mode": "label_argmax_numeric"}, inplace=True)
-
-        # Run model predictions using climate data for specified geometry and year
-        predicted_results = saved_knn.predict(result)
-    
-        # Aggregate the results (pixel level in geometry) to arrive a single GPP value for entire geometry
-        GPP_value = np.sum(predicted_results) / 1000000
+    """This method submits the GEE calls and model predictions for a specified geometry as a background job and returns the job. The job is only resubmitted when the geometry changes."""
 
-        # Add GPP results to data frame
-        dict_row = {'Year': year, 'GPP': GPP_value}
-        GPP_df = GPP_df.append(dict_row, ignore_index = True)
+    # A new analysis of this session cancels the one it submitted before, so a worker
+    # doesn't keep burning quota for a polygon that was abandoned.
+    if 'session_id' not in st.session_state:
+        st.session_state['session_id'] = str(uuid.uuid4())
 
-        # Update progress by 15% for each year we process
-        progress_time += 15
-        progress_bar.progress(progress_time)
+    runner = get_job_runner()
+    if st.session_state.get('job_geometry') != geometry or 'job_id' not in st.session_state:
+        st.session_state['job_id'] = runner.submit(geometry, session_id=st.session_state['session_id'])
+        st.session_state['job_geometry'] = geometry
 
-        #st.write("Carbon predictions complete for ", year, "...")
-    
-    st.write("Aggregating vegetation change data for selected region...") # let user know what we are doing
-
-    # Enumerate through years to aggregate vegetation change
-    for i in range(len(year_list)):
-        area_change = area_change_list[i]
-
-        for j in range(len(area_change)):
-
-            dict_area = area_change[j]
-            change_key = dict_area.get('change')
-
-            if change_key == 1:
-                sum_trees += dict_area.get('sum')
-            elif change_key == 2:
-                sum_grass += dict_area.get('sum')
-            elif change_key == 3:
-                sum_flooeded_vegetation += dict_area.get('sum')
-            elif change_key == 4:
-                sum_crops += dict_area.get('sum')
-            elif change_key == 5:
-                sum_shrub_scrub += dict_area.get('sum')
-            elif change_key == 6:
-                sum_trees -= dict_area.get('sum')
-            elif change_key == 7:
-                sum_grass -= dict_area.get('sum')
-            elif change_key == 8:
-                sum_flooeded_vegetation -= dict_area.get('sum')
-            elif change_key == 9:
-                sum_crops -= dict_area.get('sum')
-            elif change_key == 10:
-                sum_shrub_scrub -= dict_area.get('sum')
-            
-        #st.write("Completed gathering vegetation data for year", year_list[i], "...")
-
-        dict_row = {'Year': year_list[i], 'Trees': sum_trees, 'Grass': sum_grass, 'Flooded_Vegetation': sum_flooeded_vegetation, 'Crops': sum_crops, 'Shrub_Scrub': sum_shrub_scrub}
-        land_change_df = land_change_df.append(dict_row, ignore_index = True)
-
-        progress_time += 3
-        progress_bar.progress(progress_time)
+    # Keep the job id in the URL so the results can be opened again later
+    st.experimental_set_query_params(job=st.session_state['job_id'])
+    return runner.get(st.session_state['job_id'])
 
+def render_job_progress(job):
+    """This method shows the progress and the years already analysed of a job that hasn't finished, then polls the job again."""
+
+    if job['status'] == QUEUED:
+        st.write("Waiting for an analysis worker (" + str(job['position']) + " analyses ahead of yours)...")
+    else:
+        st.write(job['message'])
+    st.progress(max(int(job['progress']), 1))
+
+    partial = job['partial']
+    if partial is not None and len(partial['gpp']) > 0:
+        st.write("Results so far:")
+        st.dataframe(pd.DataFrame(partial['gpp']).merge(cumulative_change(partial['land_change']), on='Year'))
+
+    time.sleep(POLL_SECONDS)
+    st.experimental_rerun()
+
+def get_job_results(job):
+    """This method returns the land change, GPP and mean GPP of a finished job, or renders why there are none."""
+
+    if job['status'] == FAILED:
+        st.exception(RuntimeError(job['error']))
+        return None, None, None
+    if job['status'] == CANCELLED:
+        st.write("This analysis was cancelled (" + str(job['message']) + "). Please select your area again.")
+        return None, None, None
+
+    result = job['result']
+    # the chart shows the net change since the first year, the job keeps each year's change
+    return cumulative_change(result['land_change']), pd.DataFrame(result['gpp']), result['gpp_mean']
+
+def get_county_results(county):
+    """This method returns the land change, GPP and mean GPP of a county from the precomputed county store (see county_precompute.py). Counties are too large to analyse live."""
+
+    store = load_county_store()
+    results = store.county_results(county) if store is not None else pd.DataFrame()
+    results = results[results['tiles_done'] > 0] if len(results) > 0 else results
+
+    if len(results) == 0:
+        st.write("Results for " + county + " County have not been precomputed yet. Please check back later or choose Site Analysis.")
+        return None, None, None
+
+    incomplete = results[results['tiles_done'] < results['tiles']]
+    if len(incomplete) > 0:
+        st.write("The precompute for " + county + " County is still running, results cover " + str(int(incomplete['tiles_done'].sum())) + " of " + str(int(incomplete['tiles'].sum())) + " areas for some years.")
+
+    # the store keeps each year's change, the chart shows the net change since the first year
+    land_change_df = cumulative_change(results[['Year', 'Trees', 'Grass', 'Flooded_Vegetation', 'Crops', 'Shrub_Scrub']])
+    GPP_df = results[['Year', 'GPP']]
     return land_change_df, GPP_df, GPP_df["GPP"].mean()
 
 # Set variables for controlling UI element rendering
@@ -523,38 +424,40 @@ user_selections = False
 predictions_run = False
 calculations_run = False
 show_by_vegegation_type = False
-num_counties = 0
-county_list = list()
 selected_geometry = []
 
-# Get list of Counties from file
-with open('project_contents/app/NorthernCaliforniaCounties.txt') as f:
-    
-    # Extract json data from file
-    county_data = json.load(f)
-
-    # Determine how many counties/features in the file
-    num_counties = len(county_data["features"])
+# County geometries, parsed once per process and cached on disk by the module
+county_index = load_county_index()
 
-    # Enumerate through JSON structure to get County names
-    for i in range(num_counties):
-        county_list.append(county_data["features"][i]["properties"]["ADM2_NAME"])
-
-    # Sort Counties in alphabetical order
-    county_list.sort()
+# Job opened from the URL (?job=<id>), if any
+url_job_id = st.experimental_get_query_params().get('job', [None])[0]
 
 # Render user selections and results from selections for polygon selection
-selections_made, selected_geometry = get_analysis_settings(county_list, county_data)
+selections_made, selected_geometry, selected_county = get_analysis_settings(county_index)
+
+job = None
+GPP_df = None
+if selections_made == True and selected_county is None:
+    job = get_GEE_data(selected_geometry)
+elif selections_made == False and url_job_id is not None:
+    job = get_job_runner().get(url_job_id)
 
 # If user selections complete the compute the carbon gain and loss
-if selections_made == True:
+if job is not None or selected_county is not None:
     st.write('')
     st.write('')
     st.subheader('Step 2: Review the carbon absorption change for your selected area')
     st.write("Based upon your selected area, we have predicted the carbon absorption as well as determined the vegetation change over a 5 year period (2017 to 2021).")
     st.write('')
     st.write('')
-    land_change_df, GPP_df, GPP_mean = get_GEE_data(selected_geometry)
+    if selected_county is not None:
+        land_change_df, GPP_df, GPP_mean = get_county_results(selected_county)
+    else:
+        if job['status'] not in FINISHED:
+            render_job_progress(job)
+        land_change_df, GPP_df, GPP_mean = get_job_results(job)
+
+if GPP_df is not None:
     st.write('')
     st.write('')
     st.write("The predicted natural carbon absorption for your selected area is ", round(GPP_mean, 2), " metric tons per year.", )
@@ -0,0 +1,180 @@
+'''
+Central scheduler for the requests AreaChange and GeeModel send to Earth
+Engine.
+
+Every remote call (getInfo, ee_to_pandas) goes through scheduler.call(),
+which enforces a token bucket (EE_REQUESTS_PER_SECOND, EE_REQUEST_BURST)
+and a cap on the requests in flight (EE_MAX_CONCURRENT_REQUESTS), so under
+load requests wait their turn here instead of all going out at once and
+coming back as 429s.
+
+Waiting requests are served by priority lane, then in arrival order.
+Interactive requests (the Streamlit pages, the default) go ahead of batch
+requests (precompute jobs, the batch CLI), which run their code inside
+`with scheduler.lane(BATCH):`.
+
+A request rejected for quota anyway is retried with exponential backoff,
+and the bucket is emptied so the requests behind it slow down too.
+
+# Sample Usage
+
+-------------
+result = scheduler.call(image.reduceRegion(...).getInfo)
+
+with scheduler.lane(BATCH):
+    AreaChange(geometry, 2021).get_area_of_change()
+
+print(scheduler.stats())
+'''
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+# lower is served first
+LANE_PRIORITY = {INTERACTIVE: 0, BATCH: 1}
+
+_current_lane = contextvars.ContextVar('ee_request_lane', default=INTERACTIVE)
+
+
+class QuotaScheduler:
+
+    # error messages that mean Earth Engine rejected the request for quota
+    RATE_LIMIT_ERRORS = ['too many requests',
+                         'quota exceeded',
+                         'rate limit',
+                         '429']
+    MAX_RETRIES = 5
+    BACKOFF_SECONDS = 1.0
+    # wait times kept per lane for stats()
+    WAIT_HISTORY = 1000
+
+    def __init__(self, rate, burst, max_concurrent):
+        '''
+        Arguments:
+            rate: requests per second the bucket refills with
+            burst: bucket size, requests that can go out at once after idling
+            max_concurrent: requests in flight at once
+        '''
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._in_flight = 0
+        self._waiting = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._waits = {lane: deque(maxlen=self.WAIT_HISTORY) for lane in LANE_PRIORITY}
+        self._served = {lane: 0 for lane in LANE_PRIORITY}
+        self._rate_limited = 0
+
+    @contextmanager
+    def lane(self, lane):
+        '''
+        Sends the requests made inside the block (in this thread) in a lane
+        '''
+        if lane not in LANE_PRIORITY:
+            raise ValueError(f'unknown lane {lane}, expected one of {list(LANE_PRIORITY)}')
+        reset = _current_lane.set(lane)
+        try:
+            yield
+        finally:
+            _current_lane.reset(reset)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def acquire(self, lane=None):
+        '''
+        Blocks until the request may go out. Returns the seconds it waited.
+        '''
+        lane = lane or _current_lane.get()
+        ticket = (LANE_PRIORITY[lane], next(self._order))
+        start = time.monotonic()
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                self._refill()
+                if self._waiting[0] == ticket and self._in_flight < self.max_concurrent and self._tokens >= 1:
+                    break
+                # woken by release() or when the next token is due
+                timeout = None if self._tokens >= 1 else (1 - self._tokens) / self.rate
+                self._condition.wait(timeout)
+            heapq.heappop(self._waiting)
+            self._tokens -= 1
+            self._in_flight += 1
+            waited = time.monotonic() - start
+            self._waits[lane].append(waited)
+            self._served[lane] += 1
+            # the next ticket may be able to go too
+            self._condition.notify_all()
+        return waited
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def is_rate_limited(self, error):
+        message = str(error).lower()
+        return any(marker in message for marker in self.RATE_LIMIT_ERRORS)
+
+    def call(self, request, *args, lane=None, **kwargs):
+        '''
+        Sends request(*args, **kwargs) when the quota allows it, retrying
+        with backoff when Earth Engine rejects it for quota.
+        '''
+        for attempt in range(self.MAX_RETRIES + 1):
+            self.acquire(lane)
+            try:
+                return request(*args, **kwargs)
+            except Exception as e:
+                if not self.is_rate_limited(e) or attempt == self.MAX_RETRIES:
+                    raise
+                with self._condition:
+                    self._rate_limited += 1
+                    self._tokens = 0
+                backoff = self.BACKOFF_SECONDS * 2 ** attempt
+                print(f"Earth Engine quota exceeded, retrying in {backoff}s: {e}")
+            finally:
+                self.release()
+            time.sleep(backoff)
+
+    def stats(self):
+        '''
+        Queue depth and wait times (seconds) per lane, requests in flight
+        and how many requests were rejected for quota
+        '''
+        with self._condition:
+            self._refill()
+            depth = {lane: 0 for lane in LANE_PRIORITY}
+            priorities = {priority: lane for lane, priority in LANE_PRIORITY.items()}
+            for priority, _ in self._waiting:
+                depth[priorities[priority]] += 1
+            lanes = {}
+            for lane, waits in self._waits.items():
+                waits = sorted(waits)
+                lanes[lane] = {'queued': depth[lane],
+                               'served': self._served[lane],
+                               'mean_wait': sum(waits) / len(waits) if waits else 0.0,
+                               'p95_wait': waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                               'max_wait': waits[-1] if waits else 0.0}
+            return {'in_flight': self._in_flight,
+                    'tokens': self._tokens,
+                    'rate_limited': self._rate_limited,
+                    'lanes': lanes}
+
+
+# shared by every session and job of this process
+scheduler = QuotaScheduler(rate=float(os.environ.get('EE_REQUESTS_PER_SECOND', '5')),
+                           burst=int(os.environ.get('EE_REQUEST_BURST', '10')),
+                           max_concurrent=int(os.environ.get('EE_MAX_CONCURRENT_REQUESTS', '8')))
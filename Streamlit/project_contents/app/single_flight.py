@@ -0,0 +1,162 @@
+'''
+Process-wide request coalescing for AreaChange.
+
+When several sessions (or browser tabs) analyse the same polygon for the
+same year at the same time, only the first caller runs the Earth Engine
+requests. Callers asking for the same (geometry, year, method) while that
+computation is in flight wait for it and share its result instead of
+sending identical requests. Results are not cached after the computation
+finishes, this only merges concurrent work.
+
+A follower that is itself cancelled stops waiting. When the leader is
+cancelled, a waiting follower runs the computation itself.
+
+# Sample Usage
+
+-------------
+class AreaChange:
+    @coalesced
+    def get_area_of_change(self):
+        ...
+
+print(flights.stats())
+'''
+import copy
+import hashlib
+import json
+import threading
+from collections import Counter
+from dataclasses import is_dataclass
+from functools import wraps
+from cancellation import AnalysisCancelled
+
+# seconds between checks of a waiting follower's cancellation token
+WAIT_INTERVAL = 0.5
+
+# AreaChange attributes a method sets that later calls depend on
+SHARED_STATE = ('change', 'change_mask')
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._executed = Counter()
+        self._coalesced = Counter()
+
+    def do(self, key, compute, name=None, token=None):
+        '''
+        Runs compute() unless a call with the same key is in flight, in
+        which case it waits for that call.
+
+        Arguments:
+            key: hashable identifying the computation
+            compute: function without arguments
+            name: label the call is counted under in stats()
+            token: CancellationToken of the caller, checked while waiting
+
+        Returns:
+            (result, shared) where shared is True when the result came
+            from another caller's computation
+        '''
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = _Call()
+                    self._calls[key] = call
+                    self._executed[name] += 1
+                else:
+                    self._coalesced[name] += 1
+
+            if leader:
+                try:
+                    call.result = compute()
+                except BaseException as e:
+                    call.error = e
+                    raise
+                finally:
+                    with self._lock:
+                        del self._calls[key]
+                    call.done.set()
+                return call.result, False
+
+            while not call.done.wait(WAIT_INTERVAL):
+                if token is not None:
+                    token.raise_if_cancelled()
+            if call.error is None:
+                return call.result, True
+            if not isinstance(call.error, AnalysisCancelled):
+                raise call.error
+            # the leader was cancelled, not us: compute it ourselves
+            with self._lock:
+                self._coalesced[name] -= 1
+
+    def stats(self):
+        '''
+        Calls executed and coalesced (in total and per method) and the
+        number of computations in flight
+        '''
+        with self._lock:
+            return {'executed': sum(self._executed.values()),
+                    'coalesced': sum(self._coalesced.values()),
+                    'in_flight': len(self._calls),
+                    'by_method': {name: {'executed': self._executed[name], 'coalesced': self._coalesced[name]}
+                                  for name in set(self._executed) | set(self._coalesced)}}
+
+
+# shared by every session of this process
+flights = SingleFlight()
+
+
+def geometry_key(geo):
+    '''
+    sha256 of a geometry: of its coordinates for a list of [longitude,
+    latitude] pairs, of its serialized form for an ee.Geometry
+    '''
+    if isinstance(geo, (list, tuple)):
+        serialized = json.dumps(geo)
+    else:
+        serialized = geo.serialize()
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def coalesced(method):
+    '''
+    Coalesces concurrent calls of an AreaChange method for the same
+    geometry, year and (positional and keyword) arguments. The plans the
+    leader's requests ran with and the change image it built are copied to
+    the followers, and followers get a copy of the result so nobody mutates
+    a shared DataFrame.
+    '''
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (self.geometry_key, self.year, method.__name__, getattr(self, 'output_mode', None), args, tuple(sorted(kwargs.items())))
+
+        def compute():
+            plans_before = dict(self.plans)
+            result = method(self, *args, **kwargs)
+            plans = {name: plan for name, plan in self.plans.items() if plans_before.get(name) is not plan}
+            # ee objects are immutable descriptions of a computation, they can be shared as they are
+            state = {name: getattr(self, name) for name in SHARED_STATE}
+            return result, plans, state
+
+        (result, plans, state), shared = flights.do(key, compute, name=method.__name__, token=self.token)
+        if shared:
+            self.plans.update(copy.deepcopy(plans))
+            for name, value in state.items():
+                setattr(self, name, value)
+            if hasattr(result, 'copy') or is_dataclass(result):
+                result = copy.deepcopy(result)
+        return result
+    return wrapper
@@ -0,0 +1,102 @@
+'''
+Checks change_detection.py against a pixel by pixel replay of the Earth
+Engine steps of AreaChange.get_annual_change_image and get_area_of_change:
+mean of each band over the images (masked images left out), unmask to
+NODATA_VALUE, arrayArgmax, label_A * 100 + label_B remapped from BIG_LABELS
+to ADJUSTED_LABELS, and the area of each change label.
+
+Run from the app folder:
+    python -m pytest -q test_change_detection.py
+'''
+import warnings
+import numpy as np
+from change_detection import area_of_change, argmax_labels, composite, detect_change, row_areas_m2
+from change_labels import ADJUSTED_LABELS, BIG_LABELS, NODATA_VALUE
+
+NORTH, DX, DY = 41.2, 9e-5, 1.2e-4
+
+
+def reference_labels(stack):
+    with warnings.catch_warnings():
+        # mean of a band without data in any image
+        warnings.simplefilter('ignore', RuntimeWarning)
+        means = np.nanmean(stack, axis=0)
+    means = np.where(np.isnan(means), NODATA_VALUE, means)
+    rows, columns = means.shape[1:]
+    labels = np.zeros((rows, columns), dtype=int)
+    for row in range(rows):
+        for column in range(columns):
+            pixel = list(means[:, row, column])
+            labels[row, column] = pixel.index(max(pixel))
+    return labels
+
+
+def reference_change(before, after):
+    remap = dict(zip(BIG_LABELS, ADJUSTED_LABELS))
+    label_a, label_b = reference_labels(before), reference_labels(after)
+    return np.vectorize(lambda a, b: remap[a * 100 + b])(label_a, label_b)
+
+
+def stacks(images_before=4, images_after=3, rows=60, columns=45, seed=0):
+    rng = np.random.default_rng(seed)
+    before = rng.random((images_before, 9, rows, columns)).astype('float32')
+    after = rng.random((images_after, 9, rows, columns)).astype('float32')
+    # masked images and pixels without any data
+    before[0, :, :10] = np.nan
+    before[:, :, 50:] = np.nan
+    after[1, :, :, 5:9] = np.nan
+    after[:, :, 20:25, 30:] = np.nan
+    # every change label shows up
+    before[:, 1, 40:45, :] = 2
+    after[:, 6, 40:45, :] = 2
+    return before, after
+
+
+def test_labels_match_reference():
+    before, _ = stacks()
+    assert (argmax_labels(before) == reference_labels(before)).all()
+
+
+def test_change_matches_reference_across_chunks():
+    before, after = stacks()
+    expected = reference_change(before, after)
+    for chunk_pixels in (45, 45 * 7, 10 ** 6):
+        assert (detect_change(before, after, chunk_pixels) == expected).all()
+
+
+def test_change_from_composites_matches_reference():
+    before, after = stacks()
+    means = composite(before, chunk_pixels=45 * 4 * 3)
+    assert np.isnan(means[:, 50:]).all()
+    assert np.allclose(means[:, :50], np.nanmean(before[:, :, :50], axis=0), rtol=1e-6)
+    assert (detect_change(means, composite(after)) == reference_change(before, after)).all()
+
+
+def test_area_of_change_matches_reference():
+    before, after = stacks()
+    change = reference_change(before, after)
+    row_area = row_areas_m2(NORTH, DX, DY, change.shape[0])
+    expected = {label: float((row_area[:, None] * (change == label)).sum()) for label in range(1, 11)}
+
+    result = area_of_change(before, after, NORTH, DX, DY, chunk_pixels=45 * 7)
+    assert [group['change'] for group in result] == [label for label in range(1, 11) if expected[label] > 0]
+    for group in result:
+        assert np.isclose(group['sum'], expected[group['change']], rtol=1e-9)
+
+
+def test_area_of_change_mask():
+    before, after = stacks()
+    change = reference_change(before, after)
+    mask = np.zeros(change.shape, dtype=bool)
+    mask[5:30, 10:40] = True
+    row_area = row_areas_m2(NORTH, DX, DY, change.shape[0])
+
+    result = {group['change']: group['sum'] for group in area_of_change(before, after, NORTH, DX, DY, mask=mask, chunk_pixels=45 * 4)}
+    for label in range(1, 11):
+        expected = float((row_area[:, None] * ((change == label) & mask)).sum())
+        assert np.isclose(result.get(label, 0.0), expected, rtol=1e-9)
+
+
+def test_row_areas_cover_the_ellipsoid():
+    # WGS84 surface area
+    assert np.isclose(row_areas_m2(90, 360, 1, 180).sum(), 5.10065621724e14, rtol=1e-9)
@@ -0,0 +1,116 @@
+'''
+This module indexes the AmeriFlux flux towers by location so we can
+tell users which towers (with measured GPP) are close to the area they
+are analysing.
+
+The index is a scikit-learn BallTree with the haversine metric over the
+tower coordinates in ameriflux_lulc_lat_long.csv. It is built once per
+process (see load_tower_index) and answers k-nearest and within-radius
+queries for a point, a polygon, or thousands of polygons at once.
+
+# Sample Usage
+
+-------------
+geometry = [[-124.14507547221648, 41.11806816998926],
+            [-124.14507547221648, 41.11457637941072],
+            [-124.1394964774655, 41.11457637941072],
+            [-124.1394964774655, 41.11806816998926]]
+
+towers = load_tower_index()
+print(towers.nearest_to_polygon(geometry, k=5))
+print(towers.within_radius(-122.26, 37.87, radius_km=100))
+'''
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+TOWER_FILE = 'project_contents/app/ameriflux_lulc_lat_long.csv'
+EARTH_RADIUS_KM = 6371.0088
+
+
+def polygon_centroid(polygon):
+    '''
+    Mean [longitude, latitude] of the polygon vertices. A closing vertex
+    equal to the first one is ignored so it isn't counted twice.
+    '''
+    vertices = np.asarray(polygon, dtype='float64').reshape(-1, 2)
+    if len(vertices) > 1 and (vertices[0] == vertices[-1]).all():
+        vertices = vertices[:-1]
+    return vertices.mean(axis=0)
+
+
+class TowerIndex:
+
+    def __init__(self, towers):
+        '''
+        Arguments:
+            towers: pandas DataFrame with SITE_ID, LULC, LATITUDE,
+                    LONGITUDE and ELEVATION columns
+        '''
+        self.towers = (towers[['SITE_ID', 'LULC', 'LATITUDE', 'LONGITUDE', 'ELEVATION']]
+                       .dropna(subset=['LATITUDE', 'LONGITUDE'])
+                       .drop_duplicates(subset='SITE_ID')
+                       .reset_index(drop=True))
+        # the haversine metric expects [latitude, longitude] in radians
+        coordinates = np.radians(self.towers[['LATITUDE', 'LONGITUDE']].to_numpy(dtype='float64'))
+        # imported here, scikit-learn takes a while to import and only this needs it
+        from sklearn.neighbors import BallTree
+        self.tree = BallTree(coordinates, metric='haversine')
+
+    def _results(self, distances, indices):
+        result = self.towers.iloc[indices].reset_index(drop=True)
+        result['distance_km'] = distances * EARTH_RADIUS_KM
+        return result
+
+    def nearest(self, lon, lat, k=5):
+        '''
+        The k towers closest to a point, nearest first.
+
+        Returns:
+            pandas DataFrame with the tower metadata and distance_km
+        '''
+        k = min(k, len(self.towers))
+        distances, indices = self.tree.query(np.radians([[lat, lon]]), k=k)
+        return self._results(distances[0], indices[0])
+
+    def within_radius(self, lon, lat, radius_km):
+        '''
+        All towers within radius_km of a point, nearest first.
+        '''
+        indices, distances = self.tree.query_radius(np.radians([[lat, lon]]),
+                                                    r=radius_km / EARTH_RADIUS_KM,
+                                                    return_distance=True,
+                                                    sort_results=True)
+        return self._results(distances[0], indices[0])
+
+    def nearest_to_polygon(self, polygon, k=5):
+        '''
+        The k towers closest to the centroid of a polygon given as a list of
+        [longitude, latitude] pairs (same format as AreaChange).
+        '''
+        lon, lat = polygon_centroid(polygon)
+        return self.nearest(lon, lat, k)
+
+    def nearest_to_polygons(self, polygons, k=5):
+        '''
+        Batch version of nearest_to_polygon. All centroids are queried in
+        one call to the tree.
+
+        Returns:
+            pandas DataFrame with a polygon_id column (the position of the
+            polygon in the input list) and k rows per polygon.
+        '''
+        k = min(k, len(self.towers))
+        centroids = np.array([polygon_centroid(polygon) for polygon in polygons]).reshape(-1, 2)
+        distances, indices = self.tree.query(np.radians(centroids[:, ::-1]), k=k)
+        result = self._results(distances.ravel(), indices.ravel())
+        result.insert(0, 'polygon_id', np.repeat(np.arange(len(centroids)), k))
+        return result
+
+
+@lru_cache(maxsize=None)
+def load_tower_index(path=TOWER_FILE):
+    '''
+    Builds the tower index once per process and reuses it afterwards.
+    '''
+    return TowerIndex(pd.read_csv(path))
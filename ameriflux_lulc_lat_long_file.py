@@ -1,13 +1,20 @@
+import pandas as pd
+
+
 class lulc_lat_long_file():
     
     
-    def __init__(self, filepath, all_files:list):
+    def __init__(self, filepath, all_files:list, save_path=None):
         '''
         filepath:str
+            BADM workbook (AMF_AA-Flx_FLUXNET-BADM_*.xlsx)
         all_files:list
+        save_path:str, optional
+            where build() writes the csv, nothing is written when None
         '''
         self.filepath = filepath
         self.all_files = all_files
+        self.save_path = save_path
 
 
         
@@ -37,6 +44,8 @@ class lulc_lat_long_file():
         lulc_lat_long_df = pd.merge(lulc_df,self.df,on = ["SITE_ID"] )
         
         
-        lulc_lat_long_df.to_csv(self.save_path)
+        if self.save_path is not None:
+            lulc_lat_long_df.to_csv(self.save_path)
+        return lulc_lat_long_df
     def lat_longfloat(self,col):
         self.df[col] = self.df[col].astype(float)  
\ No newline at end of file
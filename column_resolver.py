@@ -0,0 +1,72 @@
+import csv
+import io
+import numpy as np
+import pandas as pd
+
+
+class column_resolver():
+    '''
+    potential_sites2.json lists several candidate columns per variable for
+    each site (for example TA and TA_PI_F, or TS_PI_1 and TS_PI_F_1), best
+    first. Not every BASE file has every candidate, so instead of guessing
+    we sniff the header of each CSV and keep the candidates that exist.
+    '''
+
+    def __init__(self, config:dict, variables=('TA', 'GPP', 'TS')):
+        '''
+        config: dict
+            contents of potential_sites2.json
+        variables: tuple
+            variables that have to resolve for a site to be ingested
+        '''
+        self.config = config
+        self.variables = variables
+
+
+    @staticmethod
+    def read_header(compressed, member, header=2):
+        '''
+        Reads only the column names of a CSV inside a zip archive. BASE
+        files start with two comment lines before the header row.
+
+        compressed: ZipFile
+        member: string
+            name of the CSV inside the archive
+        '''
+        with compressed.open(member) as raw:
+            lines = io.TextIOWrapper(raw, encoding='utf-8')
+            for _ in range(header):
+                lines.readline()
+            return next(csv.reader([lines.readline()]))
+
+
+    def resolve(self, site_id, header):
+        '''
+        Returns {variable: [available candidates, best first]}. Raises a
+        KeyError naming the variables without any candidate in the header
+        so the caller can report why a site was dropped.
+        '''
+        site_config = self.config[site_id]
+        available = set(header)
+        resolved = {}
+        missing = []
+        for variable in self.variables:
+            candidates = [col for col in site_config.get(variable, []) if col in available]
+            if len(candidates) == 0:
+                missing.append(variable)
+            resolved[variable] = candidates
+        if 'TIMESTAMP_START' not in available:
+            missing.append('TIMESTAMP_START')
+        if missing:
+            raise KeyError(f"{site_id} has no column for {', '.join(missing)}")
+        return resolved
+
+
+    @staticmethod
+    def coalesce(df, columns):
+        '''
+        First non-null value of each row across columns (in order).
+        '''
+        values = df[columns].to_numpy(dtype='float64')
+        first = (~np.isnan(values)).argmax(axis=1)
+        return pd.Series(values[np.arange(len(values)), first], index=df.index, name=columns[0])
@@ -1,59 +1,64 @@
 import pandas as pd
-import json
+import numpy as np
+import glob
 import re
+from concurrent.futures import ProcessPoolExecutor
 
-# Read in all files 
-change17 = pd.read_csv("norcal_change_2017.csv").drop(['system:index', ".geo"], axis=1)
-change18 = pd.read_csv("norcal_change_2018.csv").drop(['system:index', ".geo"], axis=1)
-change19 = pd.read_csv("norcal_change_2019.csv").drop(['system:index', ".geo"], axis=1)
-change20 = pd.read_csv("norcal_change_2020.csv").drop(['system:index', ".geo"], axis=1)
-change21 = pd.read_csv("norcal_change_2021.csv").drop(['system:index', ".geo"], axis=1)
-
-# Set Year
-change17["year"] = 2017
-change18["year"] = 2018
-change19["year"] = 2019
-change20["year"] = 2020
-change21["year"] = 2021
-
-# Convert "result" from a string of a list of dictionaries to a dataframe
-def unpack_change(change_string):
-	res = [json.loads(idx.replace("'", '"')) for idx in [change_string]]
-	return pd.DataFrame.from_dict(res[0])
-
-
-# For each dataset unpack the values
-for df in [change17, change18, change19, change20, change21]:
-	for i, row in df.iterrows():	
-		ifor_val = unpack_change(row["result"]).set_index("change").transpose()
-		for k in ifor_val.keys():
-			df.at[i, k] = ifor_val[k]["sum"]
-
-
-# Join all years
-all_change = pd.concat([change17,change18,change19,change20,change21], ignore_index=True).reset_index().drop(columns=["result"], axis=1)
-
-all_change=all_change.rename(columns={  0: 'other',
-										1: 'trees_gained',
-										2: 'grass_gained',
-										3: 'flooded_vegetation_gained',
-										4: 'crops_gained',
-										5: 'shrub_and_scrub_gained',
-										6: 'trees_lost',
-										7: 'grass_lost',
-										8: 'flooded_veg_lost',
-										9: 'crops_lost',
-										10: 'shrub_and_scrub_lost'})
-# Write to CSV
-all_change.to_csv("all_change.csv")
-
-
-# Read CSV into DF
-all_change = pd.read_csv("all_change.csv")
-
-# Examine content
-print(all_change.columns)
-print(all_change.describe())
-print(all_change.head())
+# Change codes written by AreaChange.get_area_of_change
+CHANGE_COLUMNS = {  0: 'other',
+					1: 'trees_gained',
+					2: 'grass_gained',
+					3: 'flooded_vegetation_gained',
+					4: 'crops_gained',
+					5: 'shrub_and_scrub_gained',
+					6: 'trees_lost',
+					7: 'grass_lost',
+					8: 'flooded_veg_lost',
+					9: 'crops_lost',
+					10: 'shrub_and_scrub_lost'}
 
 
+# Convert the "result" column (strings of a list of dictionaries like
+# "[{'change': 0, 'sum': 123.4}, ...]") into a dense rows x change codes array.
+# Every dictionary in the column is pulled out with one regex pass instead of
+# a json.loads per row.
+def unpack_results(results):
+	dicts = results.str.extractall(r"\{([^}]*)\}")[0]
+	change = dicts.str.extract(r"'change'\s*:\s*(\d+)", expand=False).astype("int64").to_numpy()
+	area = dicts.str.extract(r"'sum'\s*:\s*([^,\s]+)", expand=False).astype("float64").to_numpy()
+	rows = dicts.index.get_level_values(0).to_numpy()
+
+	dense = np.full((len(results), len(CHANGE_COLUMNS)), np.nan)
+	dense[results.index.get_indexer(rows), change] = area
+	return dense
+
+
+# Read one norcal_change_<year>.csv export and return its wide table
+def unpack_file(path):
+	df = pd.read_csv(path).drop(['system:index', ".geo"], axis=1)
+	df["year"] = int(re.search(r"(\d{4})\.csv$", path).group(1))
+	dense = unpack_results(df["result"])
+	df = df.drop(columns=["result"])
+	return pd.concat([df, pd.DataFrame(dense, columns=list(CHANGE_COLUMNS.values()), index=df.index)], axis=1)
+
+
+def unpack_all(pattern="norcal_change_*.csv", workers=None):
+	# Unpack every yearly export in parallel and join all years
+	paths = sorted(glob.glob(pattern))
+	if not paths:
+		raise FileNotFoundError(f"No exports match {pattern!r}, run from the folder with the norcal_change_<year>.csv files")
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		frames = list(executor.map(unpack_file, paths))
+	return pd.concat(frames, ignore_index=True).reset_index()
+
+
+if __name__ == '__main__':
+	all_change = unpack_all()
+
+	# Write to CSV
+	all_change.to_csv("all_change.csv")
+
+	# Examine content
+	print(all_change.columns)
+	print(all_change.describe())
+	print(all_change.head())
@@ -1,58 +1,162 @@
 from ftplib import FTP
 import string
-from unicodedata import name
 import pandas as  pd
 import glob
 import os
 from zipfile import ZipFile
 import json
+from ingest_state import ingest_state
+from column_resolver import column_resolver
+import timestamp_parser
+from site_metadata import site_metadata
 
 allfilespath = '/Users/csummitt/210/base_Items/*.zip'
 filepath= '/Users/csummitt/210/base_Items/cleaned'
 
 class data_cleanse():
 
-    def __init__(self, tower_filepath:string,  latlong_df:pd.DataFrame, air_temp_col:string, gpp_col:string, ts_col:string, dates =['TIMESTAMP_START']) -> None:
+    def __init__(self, tower_filepath:string,  latlong_df:pd.DataFrame, air_temp_col, gpp_col, ts_col, dates =['TIMESTAMP_START']) -> None:
         '''
         tower_filepath: string
             filepath to tower data
+        air_temp_col, gpp_col, ts_col: string or list
+            column holding each variable, or the candidate columns resolved
+            by column_resolver (best first). With several candidates each row
+            takes the first non-null value across them.
         
         '''
         self.filepath = tower_filepath
         # self.metadata_filepath= metadata_filepath
         self.lulc_lat_long_df = latlong_df
         self.dates = dates
-        self.col_sum = gpp_col
-        self.col_mean= air_temp_col
-        self.col_mean2= ts_col
-        self.cols = ['TIMESTAMP_START',gpp_col,air_temp_col,ts_col]
+        self.candidates = {}
+        for col in [gpp_col, air_temp_col, ts_col]:
+            col = [col] if isinstance(col, str) else list(col)
+            self.candidates[col[0]] = col
+        self.col_sum = list(self.candidates)[0]
+        self.col_mean= list(self.candidates)[1]
+        self.col_mean2= list(self.candidates)[2]
+        self.cols = ['TIMESTAMP_START'] + [col for cols in self.candidates.values() for col in cols]
 
 
-    def make_df(self):
+    def make_df(self, chunksize=None, since=None):
         '''
+        chunksize: int, optional
+            when set, the half-hourly file is streamed in chunks of this
+            many rows instead of being loaded whole. Only the finished days
+            of each chunk are rolled up, the last (possibly partial) day is
+            carried over into the next chunk, so memory stays bounded and
+            the output matches the in-memory path exactly.
+        since: int, optional
+            YYYYMMDDHHMM, only rows with TIMESTAMP_START at or after since
+            are rolled up. Used to ingest just the data appended to an archive.
+
+        TIMESTAMP_START is read as a plain int64 (see timestamp_parser.py)
+        and the last one read from the file is kept in self.last_timestamp.
+        The output has one row per DATE (datetime64) with its year and
+        8 day group.
         '''
-        self.tower_df = pd.read_csv(self.filepath,  low_memory = True, header=2, na_values="-9999",
-                                     parse_dates=self.dates,usecols= self.cols)
+        self.since = since
+        self.last_timestamp = None
+        read_args = dict(header=2, na_values="-9999", dtype={col: 'int64' for col in self.dates}, usecols=self.cols)
+        if chunksize is None:
+            self.tower_df = pd.read_csv(self.filepath,  low_memory = True, **read_args)
+            self.tower_df = self.roll_up_days(self.keep_new_rows(self.coalesce_candidates(self.tower_df)))
+        else:
+            reader = pd.read_csv(self.filepath, chunksize=chunksize, **read_args)
+            self.tower_df = self.roll_up_days_chunked(self.keep_new_rows(self.coalesce_candidates(chunk)) for chunk in reader)
         idx_start = self.filepath.index("AMF_US") +4
         idx_end = idx_start + 6
         self.site_id = self.filepath[idx_start:idx_end]
 
-        #convert hourly measurements to just yyyy-mm-dd to roll up the days readings
-        #mean of Air Temp, Summ of GPP
-        self.tower_df['DATE']= pd.to_datetime(self.tower_df['TIMESTAMP_START']).dt.date
-        gpp_df = self.tower_df.groupby('DATE')[self.col_sum].sum().reset_index()
-        air_temp_df = self.tower_df.groupby('DATE')[self.col_mean].mean().reset_index()
-        soil_temp_df= self.tower_df.groupby('DATE')[self.col_mean2].mean().reset_index()
-
-        #join GPP and Temp data together add site_id then join on lat long data ON site_id
-        self.tower_df = pd.merge(gpp_df,air_temp_df, on= 'DATE', how = 'inner')
-        self.tower_df = pd.merge(self.tower_df, soil_temp_df, on="DATE", how = "inner")
         self.tower_df= self.tower_df.rename(columns={self.col_mean:'TA', self.col_mean2:"TS", self.col_sum:"GPP"})
         self.tower_df['SITE_ID'] = self.site_id
         self.combined_df = self.tower_df.merge(self.lulc_lat_long_df, on= 'SITE_ID', how = 'left')
         return self.combined_df
 
 
+    def coalesce_candidates(self, tower_df):
+        '''
+        Collapse the candidate columns of each variable into its first
+        column, taking the first non-null value of each row
+        '''
+        for name, cols in self.candidates.items():
+            if len(cols) > 1:
+                tower_df[name] = column_resolver.coalesce(tower_df, cols)
+                tower_df = tower_df.drop(columns=cols[1:])
+        return tower_df
+
+
+    def keep_new_rows(self, tower_df):
+        '''
+        Track the last timestamp seen and drop the rows before self.since
+        '''
+        if len(tower_df) > 0:
+            chunk_last = int(tower_df['TIMESTAMP_START'].max())
+            if self.last_timestamp is None or chunk_last > self.last_timestamp:
+                self.last_timestamp = chunk_last
+        if self.since is None:
+            return tower_df
+        return tower_df[tower_df['TIMESTAMP_START'] >= self.since]
+
+
+    def roll_up_days(self, tower_df):
+        '''
+        tower_df: pd.DataFrame
+            half-hourly readings with the columns in self.cols
+
+        returns one row per day with the sum of GPP and the mean of
+        air and soil temperature
+        '''
+        #convert hourly measurements to just yyyy-mm-dd to roll up the days readings
+        #mean of Air Temp, Summ of GPP
+        tower_df = tower_df.assign(DATE = timestamp_parser.to_days(tower_df['TIMESTAMP_START']))
+        gpp_df = tower_df.groupby('DATE')[self.col_sum].sum().reset_index()
+        air_temp_df = tower_df.groupby('DATE')[self.col_mean].mean().reset_index()
+        soil_temp_df= tower_df.groupby('DATE')[self.col_mean2].mean().reset_index()
+
+        #join GPP and Temp data together
+        rolled_df = pd.merge(gpp_df,air_temp_df, on= 'DATE', how = 'inner')
+        rolled_df = pd.merge(rolled_df, soil_temp_df, on="DATE", how = "inner")
+
+        #add year and 8 day group from the day itself
+        buckets = timestamp_parser.eight_day_buckets(rolled_df['DATE'].to_numpy())
+        rolled_df[['year', 'day_group']] = buckets[['year', 'day_group']].to_numpy()
+        return rolled_df
+
+
+    def roll_up_days_chunked(self, reader):
+        '''
+        reader: iterator of pd.DataFrame chunks (pd.read_csv with chunksize)
+
+        AmeriFlux BASE files are written in time order, so a day can only
+        be split across the boundary between two chunks. The rows of the
+        last day in each chunk are held back and prepended to the next
+        chunk, so every day is rolled up from exactly the same rows as the
+        in-memory path.
+        '''
+        rolled = []
+        carry = None
+        for chunk in reader:
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+            if len(chunk) == 0:
+                continue
+            dates = timestamp_parser.to_days(chunk['TIMESTAMP_START'])
+            if (dates[1:] < dates[:-1]).any():
+                raise ValueError(f"{self.filepath} is not sorted by TIMESTAMP_START, read it without chunksize")
+            last_day = dates == dates[-1]
+            carry = chunk[last_day]
+            if not last_day.all():
+                rolled.append(self.roll_up_days(chunk[~last_day]))
+
+        if carry is not None and len(carry) > 0:
+            rolled.append(self.roll_up_days(carry))
+        if len(rolled) == 0:
+            return self.roll_up_days(pd.DataFrame(columns=self.cols))
+        return pd.concat(rolled, ignore_index=True)
+
+
 
     
 
@@ -60,46 +164,86 @@ class data_cleanse():
 
 
 
-if name ==__main__:
-import os
-from zipfile import ZipFile
-import json
-from pathlib import Path
-home = str(Path.home())
+if __name__ == '__main__':
+    import os
+    from zipfile import ZipFile
+    import json
+    from pathlib import Path
+    home = str(Path.home())
+
+    allfilespath = home+'/210/base_Items/*.zip'
+    filepath= home + '/210/base_Items/cleaned'
+    # rows per chunk when streaming the half-hourly files
+    CHUNKSIZE = 100000
 
-allfilespath = home+'/210/base_Items/*.zip'
-filepath= home + '/210/base_Items/cleaned'
+    lulc_lat_long_df = site_metadata(home + '/210/mids-w210-capstone/data/ameriflux_lulc_lat_long.csv').df
 
-lulc_lat_long_df = pd.read_csv(home + '/210/mids-w210-capstone/data/ameriflux_lulc_lat_long.csv', usecols=['SITE_ID','LULC','LATITUDE','LONGITUDE','ELEVATION'])
 
 
+    with open("/Users/csummitt/210/mids-w210-capstone/data/potential_sites2.json", "r") as file:
+        config = json.load(file)
 
-with open("/Users/csummitt/210/mids-w210-capstone/data/potential_sites2.json", "r") as file:
-    config = json.load(file)
 
+    # remembers which archives were already cleaned, see ingest_state.py
+    state = ingest_state(os.path.join(filepath, 'ingest_state.json'))
+    resolver = column_resolver(config)
 
-all_files = glob.glob(home + '/210/base_Items/*.zip')
-for file in all_files:
-    with ZipFile(file, 'r') as compressed:
-            compressed.extractall(home + '/210/base_Items/test')
-    for csv in glob.glob(home + '/210/base_Items/test/*.csv'):
-        idx_start = csv.index("AMF_US") +4
+    # only the newest data version of each site's archive, older ones would
+    # write over the same <site_id>.csv
+    site_files = {}
+    for file in glob.glob(home + '/210/base_Items/*.zip'):
+        idx_start = file.index("AMF_US") +4
         idx_end = idx_start + 6
-        site_id = csv[idx_start:idx_end]
-        try:
-            air_temp =config[site_id]["TA"]
-            gpp= config[site_id]["GPP"]
-            ts=config[site_id]["TS"]
-        except KeyError as arg:
-            print (arg ," Not found")
-        try:
-            print(f'try {site_id}')
-            cleaned = data_cleanse(csv,lulc_lat_long_df,  air_temp[0],gpp[0], ts[0])
-            cleaned = cleaned.make_df()
-            print(filepath +'/'+ site_id +".csv" )
-            cleaned.to_csv(filepath + site_id +".csv" )
-        except:
-            
-            print("did not load into df:" +file)
-        os.remove(csv)
-    
\ No newline at end of file
+        site_id = file[idx_start:idx_end]
+        if site_id in site_files and ingest_state.version(site_files[site_id]) > ingest_state.version(file):
+            print(f'skipping older version {file}')
+            continue
+        if site_id in site_files:
+            print(f'skipping older version {site_files[site_id]}')
+        site_files[site_id] = file
+
+    for site_id, file in site_files.items():
+        if site_id not in config:
+            print (site_id ," Not found")
+            continue
+
+        with ZipFile(file, 'r') as compressed:
+            members = [member for member in compressed.namelist() if member.endswith('.csv')]
+            for member in members:
+                # pick the columns this file actually has from the header only
+                try:
+                    columns = resolver.resolve(site_id, column_resolver.read_header(compressed, member))
+                except KeyError as arg:
+                    print(arg)
+                    continue
+
+                # skip members whose archive did not change since the last run
+                key = ingest_state.key(site_id, member)
+                if state.is_unchanged(key, file, columns):
+                    print(f'unchanged {site_id}')
+                    continue
+
+                # the last ingested day may have been partial, so start over from
+                # the beginning of that day and replace it in the cleaned file
+                since = state.resume_from(key, columns)
+                if since is not None:
+                    since = timestamp_parser.day_start(since)
+
+                csv = compressed.extract(member, home + '/210/base_Items/test')
+                try:
+                    print(f'try {site_id}')
+                    cleaned = data_cleanse(csv,lulc_lat_long_df,  columns["TA"], columns["GPP"], columns["TS"])
+                    cleaned_df = cleaned.make_df(chunksize=CHUNKSIZE, since=since)
+                    out_path = os.path.join(filepath, site_id +".csv")
+                    if since is not None and os.path.exists(out_path):
+                        previous_df = pd.read_csv(out_path, index_col=0)
+                        previous_df = previous_df[previous_df['DATE'] < str(timestamp_parser.to_days([since])[0])]
+                        cleaned_df = pd.concat([previous_df, cleaned_df], ignore_index=True)
+                    print(out_path)
+                    cleaned_df.to_csv(out_path)
+                    if cleaned.last_timestamp is not None:
+                        state.record(key, file, columns, str(cleaned.last_timestamp))
+                        state.save()
+                except Exception as arg:
+                    print("did not load into df:" +file, arg)
+                os.remove(csv)
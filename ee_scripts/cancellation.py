@@ -0,0 +1,78 @@
+'''
+Cooperative cancellation for analyses that make many Earth Engine
+requests.
+
+Every analysis carries a CancellationToken. AreaChange checks the token
+before each request and between pages of an export, so a cancelled
+analysis stops at the next safe point instead of running to the end and
+burning quota for a polygon nobody is looking at anymore.
+
+Tokens are registered per session with supersede(): starting a new
+analysis in a session cancels the one that session started before.
+
+# Sample Usage
+
+-------------
+token = supersede(session_id)
+try:
+    ac = AreaChange(geometry, 2021, token=token)
+    ac.get_area_of_change()
+except AnalysisCancelled:
+    pass
+finally:
+    release(session_id, token)
+'''
+import threading
+
+
+class AnalysisCancelled(Exception):
+    """Raised at the next checkpoint of an analysis whose token was cancelled"""
+    pass
+
+
+class CancellationToken:
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason='cancelled'):
+        self.reason = reason
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise AnalysisCancelled(self.reason)
+
+
+# session id -> token of the analysis that session is running
+_tokens = {}
+_lock = threading.Lock()
+
+
+def supersede(session_id):
+    '''
+    Cancels the analysis the session is running (if any) and returns a
+    fresh token for the new one.
+    '''
+    token = CancellationToken()
+    with _lock:
+        previous = _tokens.get(session_id)
+        _tokens[session_id] = token
+    if previous is not None:
+        previous.cancel('superseded by a newer analysis')
+    return token
+
+
+def release(session_id, token):
+    '''
+    Forgets the token once its analysis finished, unless a newer analysis
+    already replaced it.
+    '''
+    with _lock:
+        if _tokens.get(session_id) is token:
+            del _tokens[session_id]
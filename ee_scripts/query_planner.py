@@ -0,0 +1,200 @@
+'''
+This module picks the scale and tileScale of each Earth Engine request
+AreaChange makes instead of hardcoding scale=10, tileScale=16 and
+bestEffort=True for every polygon.
+
+The cost of a request is estimated locally as
+pixels x bands x images, where the pixel count comes from the polygon
+area (computed locally, no getInfo) and the image count from the cadence
+of the dataset over the requested time window. Small sites get tileScale=1
+at 10m. Large areas get a higher tileScale and, if needed, a coarser
+scale, chosen up front and reported with the results instead of being
+silently coarsened by bestEffort.
+
+Requests that still fail with a memory/too-many-pixels error are retried
+at a higher tileScale (then a coarser scale).
+
+# Sample Usage
+
+-------------
+planner = QueryPlanner(geometry)
+plan = planner.plan(bands=9, images=planner.images('dynamic_world', days=182))
+result, plan = planner.run(lambda plan: image.reduceRegion(..., scale=plan.scale, tileScale=plan.tile_scale).getInfo(), plan)
+print("Effective resolution (m): ", plan.scale)
+'''
+import math
+from dataclasses import dataclass, replace
+
+
+@dataclass
+class QueryPlan:
+    # pixel size in meters the request runs at
+    scale: int
+    tile_scale: int
+    # estimated pixels x bands x images
+    estimated_cost: float
+    pixels: float
+    # how many times the request was sent (retries included)
+    attempts: int = 0
+
+
+def polygon_area_m2(polygon):
+    '''
+    Approximate area (meters^2) of a polygon given as a list of
+    [longitude, latitude] pairs. The vertices are projected onto a local
+    equirectangular plane around the centroid, which is accurate enough
+    for the size of areas we analyse.
+    '''
+    if len(polygon) < 3:
+        return 0.0
+    lat_0 = math.radians(sum(point[1] for point in polygon) / len(polygon))
+    meters_per_degree_lat = 111132.954 - 559.822 * math.cos(2 * lat_0)
+    meters_per_degree_lon = 111319.488 * math.cos(lat_0)
+    xs = [point[0] * meters_per_degree_lon for point in polygon]
+    ys = [point[1] * meters_per_degree_lat for point in polygon]
+    twice_area = 0.0
+    for i in range(len(polygon)):
+        j = (i + 1) % len(polygon)
+        twice_area += xs[i] * ys[j] - xs[j] * ys[i]
+    return abs(twice_area) / 2
+
+
+def nesting_depth(geometry):
+    '''
+    How deeply coordinates are nested: 2 for a list of [longitude,
+    latitude] pairs, 3 for a list of rings, 4 for a list of polygons
+    (MultiPolygon coordinates)
+    '''
+    depth = 0
+    while isinstance(geometry, (list, tuple)) and len(geometry) > 0:
+        geometry = geometry[0]
+        depth += 1
+    return depth
+
+
+def geometry_area_m2(geometry):
+    '''
+    Approximate area (meters^2) of a polygon given as a list of [longitude,
+    latitude] pairs, a list of rings (exterior first, then holes) or a list
+    of polygons.
+    '''
+    depth = nesting_depth(geometry)
+    if depth <= 2:
+        return polygon_area_m2(geometry)
+    if depth == 3:
+        return max(0.0, polygon_area_m2(geometry[0]) - sum(polygon_area_m2(hole) for hole in geometry[1:]))
+    return sum(geometry_area_m2(polygon) for polygon in geometry)
+
+
+class QueryPlanner:
+    # candidate scales (meters), finest first
+    SCALES = [10, 20, 30, 50, 100, 250, 500]
+    TILE_SCALES = [1, 2, 4, 8, 16]
+    MAX_PIXELS = 1e9
+
+    # pixels x bands x images one tile handles comfortably. This is a
+    # heuristic tuned on the demo sites, every doubling of the cost above
+    # it doubles the tileScale.
+    TILE_COST = 1e8
+
+    # images per day of each dataset at a single location
+    CADENCES = {
+        'dynamic_world': 1 / 5,   # Sentinel-2 revisit, ~5 days
+        'gridmet': 1,             # daily
+        'gridmet_8_day': 1 / 8,   # our 8 day averages
+        'mod15': 1 / 8,           # 8 day composites
+        'landsat_gpp': 1 / 16,    # Landsat revisit
+        'elevation': 0,           # single image
+    }
+
+    # error messages that mean the request was too big, not wrong
+    RETRYABLE_ERRORS = ['memory limit exceeded',
+                        'too many pixels',
+                        'computation timed out',
+                        'output of image computation is too large',
+                        'too many concurrent aggregations']
+
+    MAX_ATTEMPTS = 6
+
+    def __init__(self, polygon=None):
+        '''
+        Arguments:
+            polygon: list of [longitude, latitude] pairs (or of rings, or
+                     MultiPolygon coordinates). When None (the
+                     geometry is already an ee.Geometry) the area is
+                     unknown and the planner falls back to the old
+                     defaults: scale 10, tileScale 16.
+        '''
+        self.area = geometry_area_m2(polygon) if polygon is not None else None
+
+    def images(self, dataset, days):
+        '''
+        Expected number of images of a dataset over a time window
+        '''
+        return max(1, math.ceil(self.CADENCES[dataset] * days))
+
+    def plan(self, bands, images, min_scale=10):
+        '''
+        Picks the finest scale (not finer than min_scale) whose pixel count
+        fits maxPixels and whose cost fits the largest tileScale, and the
+        smallest tileScale that fits that cost.
+        '''
+        if self.area is None:
+            return QueryPlan(scale=min_scale, tile_scale=16, estimated_cost=math.nan, pixels=math.nan)
+
+        scales = [scale for scale in self.SCALES if scale >= min_scale] or [min_scale]
+        for scale in scales:
+            pixels = self.area / (scale * scale)
+            cost = pixels * bands * images
+            if pixels <= self.MAX_PIXELS and cost <= self.TILE_COST * self.TILE_SCALES[-1]:
+                break
+        tile_scale = next((t for t in self.TILE_SCALES if cost <= self.TILE_COST * t), self.TILE_SCALES[-1])
+        return QueryPlan(scale=scale, tile_scale=tile_scale, estimated_cost=cost, pixels=pixels)
+
+    def escalate(self, plan):
+        '''
+        The next plan to try after a memory error: a higher tileScale, or a
+        coarser scale once tileScale is at its maximum. None when there is
+        nothing left to try.
+        '''
+        if plan.tile_scale < self.TILE_SCALES[-1]:
+            tile_scale = next(t for t in self.TILE_SCALES if t > plan.tile_scale)
+            return replace(plan, tile_scale=tile_scale)
+        coarser = [scale for scale in self.SCALES if scale > plan.scale]
+        if not coarser:
+            return None
+        ratio = (plan.scale / coarser[0]) ** 2
+        return replace(plan, scale=coarser[0], pixels=plan.pixels * ratio,
+                       estimated_cost=plan.estimated_cost * ratio)
+
+    def is_retryable(self, error):
+        message = str(error).lower()
+        return any(marker in message for marker in self.RETRYABLE_ERRORS)
+
+    def run(self, request, plan):
+        '''
+        Sends request(plan) and retries with escalated plans on memory
+        errors.
+
+        Arguments:
+            request: function taking a QueryPlan and returning the result
+                     (it should call getInfo itself)
+            plan: the first QueryPlan to try
+
+        Returns:
+            (result, the QueryPlan that succeeded)
+        '''
+        attempts = 0
+        while True:
+            attempts += 1
+            plan.attempts = attempts
+            try:
+                return request(plan), plan
+            except Exception as e:
+                if not self.is_retryable(e) or attempts >= self.MAX_ATTEMPTS:
+                    raise
+                next_plan = self.escalate(plan)
+                if next_plan is None:
+                    raise
+                print(f"Retrying at scale {next_plan.scale}m, tileScale {next_plan.tile_scale}: {e}")
+                plan = next_plan
@@ -0,0 +1,192 @@
+'''
+Rebuilds the model training table (8_day_grouped_data) from the Earth
+Engine exports and the cleaned AmeriFlux files, replacing the hand-run
+joins in "Ameriflux_EE joined EDA.ipynb".
+
+Instead of resampling MOD15 and Dynamic World to daily rows with ffill
+(which multiplies the row count by ~8 and ~90), each site's daily
+AmeriFlux/GRIDMET rows are matched to the latest MOD15 composite and
+Dynamic World quarter with as-of joins on the sorted dates. The result is
+grouped into 8 day buckets in one pass, one site at a time, so memory is
+bounded by the largest site.
+
+Usage:
+    python feature_builder.py --cleaned-dir ~/210/base_Items/cleaned \
+        --gridmet data/final_gridmet_export.csv \
+        --output data/8_day_grouped_data.csv
+'''
+import argparse
+import glob
+import os
+import numpy as np
+import pandas as pd
+import timestamp_parser
+from site_metadata import site_metadata
+
+DYNAMIC_WORLD_COLUMNS = ['water_mean',
+                         'trees_mean',
+                         'grass_mean',
+                         'flooded_vegetation_mean',
+                         'crops_mean',
+                         'shrub_and_scrub_mean',
+                         'built_mean',
+                         'bare_mean',
+                         'snow_and_ice_mean']
+GRIDMET_COLUMNS = ['srad', 'tmmn', 'tmmx', 'vpd']
+MOD_COLUMNS = ['Fpar_500m', 'Lai_500m']
+
+# averaged per 8 day group, named <column>_mean in the output like the
+# notebook's groupby().agg() did. Site coordinates are kept as they are.
+SITE_COLUMNS = ['LATITUDE_x', 'LONGITUDE_x']
+FEATURE_COLUMNS = (GRIDMET_COLUMNS + MOD_COLUMNS +
+                   ['ee_elevation', 'elevation_diff'] + DYNAMIC_WORLD_COLUMNS +
+                   ['label_mean', 'label_argmax_numeric'])
+
+
+class feature_builder():
+
+    def __init__(self, cleaned_dir, gridmet_path, mod_path='data/final_mod_export.csv',
+                 dw_path='data/final_dw_export.csv', elevation_path='data/final_elev_export.csv',
+                 sites_path='data/ameriflux_lulc_lat_long.csv'):
+        '''
+        cleaned_dir: string
+            folder with the per site daily csvs written by data_cleanse.py
+        gridmet_path, mod_path, dw_path, elevation_path: string
+            Earth Engine exports per SITE_ID
+        sites_path: string
+            AmeriFlux site metadata (see site_metadata.py)
+        '''
+        self.cleaned_files = sorted(glob.glob(os.path.join(cleaned_dir, 'US-*.csv')))
+
+        self.gridmet = pd.read_csv(gridmet_path, usecols=['SITE_ID', 'DATE'] + GRIDMET_COLUMNS)
+        self.gridmet['DATE'] = pd.to_datetime(self.gridmet['DATE'], errors='coerce')
+
+        self.mod = pd.read_csv(mod_path, usecols=['SITE_ID', 'DATE'] + MOD_COLUMNS)
+        self.mod['DATE'] = pd.to_datetime(self.mod['DATE'], errors='coerce')
+
+        self.dw = pd.read_csv(dw_path, usecols=['SITE_ID', 'START_DATE', 'label_mean'] + DYNAMIC_WORLD_COLUMNS)
+        self.dw['DATE'] = pd.to_datetime(self.dw['START_DATE'], errors='coerce')
+        # argmax instead of mean, there's no relationship between the labels 0-8.
+        # Missing bands are skipped like the notebook's idxmax did, rows
+        # without any band stay NaN
+        probabilities = self.dw[DYNAMIC_WORLD_COLUMNS].to_numpy(dtype='float64')
+        has_value = ~np.isnan(probabilities).all(axis=1)
+        labels = np.full(len(probabilities), np.nan)
+        labels[has_value] = np.nanargmax(probabilities[has_value], axis=1)
+        self.dw['label_argmax_numeric'] = labels
+        self.dw = self.dw.drop(columns=['START_DATE'])
+
+        sites = site_metadata(sites_path).df.drop_duplicates(subset='SITE_ID')
+        elevation = pd.read_csv(elevation_path).drop_duplicates(subset='SITE_ID')
+        self.sites = sites.merge(elevation, on='SITE_ID').rename(columns={
+            'LATITUDE': 'LATITUDE_x', 'LONGITUDE': 'LONGITUDE_x', 'elevation': 'ee_elevation'})
+        self.sites['elevation_diff'] = (self.sites['ELEVATION'] - self.sites['ee_elevation']).abs()
+        self.sites['SITE_ID'] = self.sites['SITE_ID'].astype(str)
+        self.sites = self.sites[['SITE_ID', 'LATITUDE_x', 'LONGITUDE_x', 'ee_elevation', 'elevation_diff']]
+
+
+    @staticmethod
+    def asof(daily, source):
+        '''
+        Attach to each daily row the latest source row on or before its date
+        '''
+        source = source.dropna(subset=['DATE']).sort_values('DATE').drop(columns=['SITE_ID'])
+        return pd.merge_asof(daily, source, on='DATE', direction='backward')
+
+
+    @staticmethod
+    def read_cleaned(cleaned_file):
+        '''
+        Daily GPP of one cleaned csv
+        '''
+        daily = pd.read_csv(cleaned_file, usecols=['DATE', 'GPP', 'SITE_ID'])
+        daily['DATE'] = pd.to_datetime(daily['DATE'], errors='coerce')
+        return daily.dropna(subset=['DATE'])
+
+
+    def join_site(self, daily):
+        '''
+        Joins one site's daily GPP with GRIDMET, the latest MOD15 composite,
+        the latest Dynamic World quarter and the site's static features
+        '''
+        site_id = daily['SITE_ID'].iloc[0] if len(daily) > 0 else None
+
+        gridmet = self.gridmet[self.gridmet['SITE_ID'] == site_id].drop(columns=['SITE_ID'])
+        daily = daily.merge(gridmet, on='DATE', how='inner').sort_values('DATE', kind='stable')
+        daily = self.asof(daily, self.mod[self.mod['SITE_ID'] == site_id])
+        daily = self.asof(daily, self.dw[self.dw['SITE_ID'] == site_id])
+        return daily.merge(self.sites, on='SITE_ID', how='inner')
+
+
+    @staticmethod
+    def group_days(daily):
+        '''
+        Groups joined daily rows into 8 day buckets, None when there are none
+        '''
+        if len(daily) == 0:
+            return None
+
+        buckets = timestamp_parser.eight_day_buckets(daily['DATE'].to_numpy().astype('datetime64[D]'))
+        daily = daily.assign(year=buckets['year'].to_numpy(), day_group=buckets['day_group'].to_numpy())
+
+        grouped = daily.groupby(['SITE_ID', 'day_group', 'year'], sort=True)
+        site = grouped[SITE_COLUMNS].first()
+        features = grouped[FEATURE_COLUMNS].mean().add_suffix('_mean')
+        gpp = grouped['GPP'].agg(['mean', 'sum']).add_prefix('GPP_')
+        return pd.concat([site, features, gpp], axis=1).reset_index()
+
+
+    def build_site(self, cleaned_file):
+        '''
+        8 day groups for the site in one cleaned csv
+        '''
+        return self.group_days(self.join_site(self.read_cleaned(cleaned_file)))
+
+
+    @staticmethod
+    def typed(features):
+        return features.astype({'SITE_ID': 'category', 'day_group': 'int16', 'year': 'int16'})
+
+
+    def build(self):
+        '''
+        8 day groups for all sites, sorted by SITE_ID, day_group and year
+        '''
+        grouped = [self.build_site(cleaned_file) for cleaned_file in self.cleaned_files]
+        grouped = [df for df in grouped if df is not None]
+        features = self.typed(pd.concat(grouped, ignore_index=True))
+        return features.sort_values(['SITE_ID', 'day_group', 'year'], kind='stable').reset_index(drop=True)
+
+
+    @staticmethod
+    def write(features, output_path):
+        '''
+        The tab separated csv GeeModel.adjust_and_write_training_data reads,
+        or .parquet to keep the column types (needs pyarrow or fastparquet,
+        which the requirements don't include)
+        '''
+        if output_path.endswith('.parquet'):
+            features.to_parquet(output_path, index=False)
+        else:
+            features.to_csv(output_path, sep='\t')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the 8 day grouped training data')
+    parser.add_argument('--cleaned-dir', required=True, help='folder with the data_cleanse.py output')
+    parser.add_argument('--gridmet', required=True, help='GRIDMET export per site')
+    parser.add_argument('--mod', default='data/final_mod_export.csv')
+    parser.add_argument('--dw', default='data/final_dw_export.csv')
+    parser.add_argument('--elevation', default='data/final_elev_export.csv')
+    parser.add_argument('--sites', default='data/ameriflux_lulc_lat_long.csv')
+    parser.add_argument('--output', default='data/8_day_grouped_data.csv')
+    args = parser.parse_args()
+
+    builder = feature_builder(args.cleaned_dir, args.gridmet, args.mod, args.dw, args.elevation, args.sites)
+    features = builder.build()
+    feature_builder.write(features, args.output)
+    print(f'{len(features)} rows for {features["SITE_ID"].nunique()} sites written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+'''
+Append-friendly store for the 8 day training features, keyed by
+(SITE_ID, year, day_group).
+
+Rows are stored in one partition per (SITE_ID, year). For every partition
+the manifest keeps a fingerprint of the source rows it was computed from
+(AmeriFlux GPP, GRIDMET, MOD15, Dynamic World and the static site
+features). A refresh fingerprints the sources again and only rejoins and
+regroups the partitions whose inputs changed, so adding a year of data
+only recomputes that year.
+
+Every refresh that changes something writes a new version of the manifest.
+Partition files are never overwritten, so training jobs can keep reading a
+consistent snapshot by version while newer versions are being written.
+
+Usage:
+    python feature_store.py refresh --store data/feature_store \
+        --cleaned-dir ~/210/base_Items/cleaned --gridmet data/final_gridmet_export.csv
+    python feature_store.py export --store data/feature_store --version 3 \
+        --output data/8_day_grouped_data.csv
+'''
+import argparse
+import hashlib
+import json
+import os
+from datetime import datetime
+import pandas as pd
+from feature_builder import feature_builder
+
+SOURCES = ['ameriflux', 'gridmet', 'mod', 'dw', 'site']
+
+
+class feature_store():
+
+    def __init__(self, store_dir):
+        '''
+        store_dir: string
+            folder holding manifest.json and the partition files
+        '''
+        self.store_dir = store_dir
+        self.manifest_path = os.path.join(store_dir, 'manifest.json')
+        self.manifest = {'versions': []}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as file:
+                self.manifest = json.load(file)
+
+
+    @staticmethod
+    def fingerprint(df):
+        '''
+        sha256 of the rows of a DataFrame (column names included)
+        '''
+        digest = hashlib.sha256(','.join(map(str, df.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+        return digest.hexdigest()
+
+
+    @staticmethod
+    def asof_window(source, year):
+        '''
+        Source rows an as-of join for the days of year can match: the rows
+        in the year plus the last one before it
+        '''
+        source = source.dropna(subset=['DATE']).sort_values('DATE')
+        start = pd.Timestamp(year=year, month=1, day=1)
+        end = pd.Timestamp(year=year + 1, month=1, day=1)
+        before = source[source['DATE'] < start].tail(1)
+        return pd.concat([before, source[(source['DATE'] >= start) & (source['DATE'] < end)]])
+
+
+    def partition_inputs(self, builder, daily, site_id, year):
+        '''
+        Fingerprint of every source slice the partition is computed from
+        '''
+        gridmet = builder.gridmet[builder.gridmet['SITE_ID'] == site_id]
+        slices = {
+            'ameriflux': daily[daily['DATE'].dt.year == year],
+            'gridmet': gridmet[gridmet['DATE'].dt.year == year],
+            'mod': self.asof_window(builder.mod[builder.mod['SITE_ID'] == site_id], year),
+            'dw': self.asof_window(builder.dw[builder.dw['SITE_ID'] == site_id], year),
+            'site': builder.sites[builder.sites['SITE_ID'] == site_id],
+        }
+        return {source: self.fingerprint(slices[source].reset_index(drop=True)) for source in SOURCES}
+
+
+    def versions(self):
+        return [version['version'] for version in self.manifest['versions']]
+
+
+    def partitions(self, version=None):
+        '''
+        {"SITE_ID/year": {"file": ..., "inputs": {...}}} of a version,
+        the latest one by default
+        '''
+        if len(self.manifest['versions']) == 0:
+            return {}
+        if version is None:
+            return self.manifest['versions'][-1]['partitions']
+        for entry in self.manifest['versions']:
+            if entry['version'] == version:
+                return entry['partitions']
+        raise KeyError(f'feature store version {version} does not exist')
+
+
+    def refresh(self, builder:feature_builder):
+        '''
+        Recomputes the partitions whose inputs changed and records a new
+        version when anything changed.
+
+        Returns:
+            the latest version number (None for an empty store)
+        '''
+        current = self.partitions()
+        latest = self.versions()[-1] if self.manifest['versions'] else 0
+        version = latest + 1
+        partitions = {}
+        changed = 0
+
+        for cleaned_file in builder.cleaned_files:
+            daily = builder.read_cleaned(cleaned_file)
+            if len(daily) == 0:
+                continue
+            site_id = daily['SITE_ID'].iloc[0]
+            joined = None
+            for year in sorted(daily['DATE'].dt.year.unique()):
+                key = f'{site_id}/{year}'
+                inputs = self.partition_inputs(builder, daily, site_id, int(year))
+                if key in current and current[key]['inputs'] == inputs:
+                    partitions[key] = current[key]
+                    continue
+
+                # join the whole site once, as-of joins need the earlier rows
+                if joined is None:
+                    joined = builder.join_site(daily)
+                grouped = builder.group_days(joined[joined['DATE'].dt.year == year])
+                if grouped is None:
+                    continue
+                file = os.path.join(site_id, f'{year}.v{version}.pkl')
+                os.makedirs(os.path.join(self.store_dir, site_id), exist_ok=True)
+                feature_builder.typed(grouped).to_pickle(os.path.join(self.store_dir, file))
+                partitions[key] = {'file': file, 'inputs': inputs}
+                changed += 1
+
+        if changed == 0 and set(partitions) == set(current):
+            print(f'feature store unchanged at version {latest or None}')
+            return latest or None
+
+        self.manifest['versions'].append({'version': version,
+                                          'created': datetime.now().isoformat(timespec='seconds'),
+                                          'partitions': partitions})
+        self.save()
+        print(f'feature store version {version}: {changed} of {len(partitions)} partitions recomputed')
+        return version
+
+
+    def read(self, version=None):
+        '''
+        All rows of a version (the latest by default), sorted by SITE_ID,
+        day_group and year like 8_day_grouped_data
+        '''
+        partitions = self.partitions(version)
+        frames = [pd.read_pickle(os.path.join(self.store_dir, partitions[key]['file'])) for key in sorted(partitions)]
+        if len(frames) == 0:
+            return pd.DataFrame()
+        features = feature_builder.typed(pd.concat(frames, ignore_index=True))
+        return features.sort_values(['SITE_ID', 'day_group', 'year'], kind='stable').reset_index(drop=True)
+
+
+    def save(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.manifest, file, indent=4)
+        os.replace(tmp_path, self.manifest_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental store for the 8 day training features')
+    parser.add_argument('command', choices=['refresh', 'export', 'versions'])
+    parser.add_argument('--store', default='data/feature_store')
+    parser.add_argument('--cleaned-dir', help='folder with the data_cleanse.py output (refresh)')
+    parser.add_argument('--gridmet', help='GRIDMET export per site (refresh)')
+    parser.add_argument('--mod', default='data/final_mod_export.csv')
+    parser.add_argument('--dw', default='data/final_dw_export.csv')
+    parser.add_argument('--elevation', default='data/final_elev_export.csv')
+    parser.add_argument('--sites', default='data/ameriflux_lulc_lat_long.csv')
+    parser.add_argument('--version', type=int, help='snapshot to export, latest by default')
+    parser.add_argument('--output', default='data/8_day_grouped_data.csv')
+    args = parser.parse_args()
+
+    store = feature_store(args.store)
+    if args.command == 'refresh':
+        if args.cleaned_dir is None or args.gridmet is None:
+            parser.error('refresh needs --cleaned-dir and --gridmet')
+        builder = feature_builder(args.cleaned_dir, args.gridmet, args.mod, args.dw, args.elevation, args.sites)
+        store.refresh(builder)
+    elif args.command == 'export':
+        features = store.read(args.version)
+        feature_builder.write(features, args.output)
+        print(f'{len(features)} rows written to {args.output}')
+    else:
+        print(store.versions())
+
+
+if __name__ == '__main__':
+    main()
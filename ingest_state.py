@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import re
+
+# data version at the end of AmeriFlux file names, AMF_US-Var_BASE-BADM_17-5.zip
+VERSION_PATTERN = re.compile(r'_(\d+)-(\d+)(\.\w+)?$')
+
+
+class ingest_state():
+    '''
+    Keeps track of which AmeriFlux archives in base_Items have already been
+    cleaned so data_cleanse.py only reprocesses what changed.
+
+    The state is kept per site and CSV member, without the data version
+    AmeriFlux puts in the file names, so a new version of a site's archive
+    (AMF_US-Var_BASE-BADM_18-5.zip replacing _17-5.zip) is found changed and
+    resumed from the last TIMESTAMP_START ingested from the old one. For
+    every member the state file records the archive it was read from, the
+    archive's size, mtime and sha256, the columns that were resolved from
+    potential_sites2.json and the last TIMESTAMP_START that was ingested:
+
+    {
+        "US-Var/AMF_US-Var_BASE_HH": {
+            "archive": "AMF_US-Var_BASE-BADM_17-5.zip",
+            "size": 12345678,
+            "mtime": 1667000000.0,
+            "sha256": "...",
+            "columns": {"TA": "TA", "GPP": "GPP_PI_F", "TS": "TS_PI_1"},
+            "last_timestamp": "202112312330"
+        }
+    }
+    '''
+
+    def __init__(self, state_filepath):
+        '''
+        state_filepath: string
+            json file the state is read from and saved to
+        '''
+        self.state_filepath = state_filepath
+        self.archives = {}
+        if os.path.exists(state_filepath):
+            with open(state_filepath, 'r') as file:
+                self.archives = json.load(file)
+
+
+    @staticmethod
+    def file_hash(archive_path, block_size=1 << 20):
+        '''
+        sha256 of the archive contents, read in blocks
+        '''
+        digest = hashlib.sha256()
+        with open(archive_path, 'rb') as file:
+            for block in iter(lambda: file.read(block_size), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+
+    @staticmethod
+    def version(path):
+        '''
+        (major, minor) data version of an AmeriFlux file name, (0, 0) when
+        the name has none
+        '''
+        match = VERSION_PATTERN.search(os.path.basename(path))
+        if match is None:
+            return (0, 0)
+        return (int(match.group(1)), int(match.group(2)))
+
+
+    @staticmethod
+    def key(site_id, member):
+        '''
+        State key of a CSV member of a site's archive, the same for every
+        data version of the archive
+        '''
+        name = os.path.splitext(os.path.basename(member))[0]
+        return site_id + '/' + VERSION_PATTERN.sub('', name)
+
+
+    def is_unchanged(self, key, archive_path, columns):
+        '''
+        True when the member was already ingested from this archive with the
+        same columns and the archive did not change. Size and mtime are
+        checked first, the archive is only hashed when the mtime moved but
+        the size did not (for example after a fresh download of the same
+        file).
+        '''
+        entry = self.archives.get(key)
+        if entry is None or entry['columns'] != columns or entry.get('archive') != os.path.basename(archive_path):
+            return False
+        stat = os.stat(archive_path)
+        if entry['size'] != stat.st_size:
+            return False
+        if entry['mtime'] == stat.st_mtime:
+            return True
+        return entry['sha256'] == self.file_hash(archive_path)
+
+
+    def resume_from(self, key, columns):
+        '''
+        The last TIMESTAMP_START (YYYYMMDDHHMM string) ingested for the
+        member from any version of the site's archive, or None when it has
+        to be processed from the start (never seen, or the columns changed).
+        '''
+        entry = self.archives.get(key)
+        if entry is None or entry['columns'] != columns:
+            return None
+        return entry.get('last_timestamp')
+
+
+    def record(self, key, archive_path, columns, last_timestamp):
+        '''
+        Remember that the member was ingested from the archive up to
+        last_timestamp
+        '''
+        stat = os.stat(archive_path)
+        self.archives[key] = {
+            'archive': os.path.basename(archive_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': self.file_hash(archive_path),
+            'columns': columns,
+            'last_timestamp': last_timestamp,
+        }
+
+
+    def save(self):
+        '''
+        Write the state next to the cleaned files. The file is replaced
+        atomically so an interrupted run never leaves a corrupt state.
+        '''
+        tmp_path = self.state_filepath + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.archives, file, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.state_filepath)
@@ -1,5 +1,5 @@
-import pandas as pd
 import json
+from site_metadata import site_metadata
   
 # Get the site ids 
 # These are the keys of the json file potential_sites2.json
@@ -7,8 +7,8 @@ potential_sites_file = open('data/potential_sites2.json')
 potential_sites_dict = json.load(potential_sites_file)
 potential_site_names = list(potential_sites_dict.keys())
 
-# Get the csv with all site data
-all_sites_df = pd.read_csv("data/ameriflux_lulc_lat_long.csv")
+# Get all site data (cached after the first read, see site_metadata.py)
+all_sites_df = site_metadata("data/ameriflux_lulc_lat_long.csv").df
 
 # Write a new csv that only has data for sites we want
 wanted_site_and_info  = all_sites_df[all_sites_df['SITE_ID'].isin(potential_site_names)]
@@ -0,0 +1,127 @@
+import os
+import pickle
+import pandas as pd
+from ameriflux_lulc_lat_long_file import lulc_lat_long_file
+from ingest_state import ingest_state
+
+
+class site_metadata():
+    '''
+    Site metadata (SITE_ID, LULC, LATITUDE, LONGITUDE, ELEVATION) for every
+    AmeriFlux tower, parsed once from the BADM workbook (or the
+    ameriflux_lulc_lat_long.csv built from it) and kept in a typed pickle
+    cache next to the source. The cache is reused while the source's mtime,
+    or failing that its sha256, is unchanged.
+
+    Sample usage:
+
+        sites = site_metadata('data/ameriflux_lulc_lat_long.csv')
+        sites.lookup('US-Var')
+        sites.by_lulc('GRA', 'WSA')
+        sites.within_bbox(-124.5, 36.0, -119.0, 42.0)
+    '''
+    COLUMNS = ['SITE_ID', 'LULC', 'LATITUDE', 'LONGITUDE', 'ELEVATION']
+
+    def __init__(self, source_path, cache_path=None):
+        '''
+        source_path: string
+            BADM workbook (.xlsx) or ameriflux_lulc_lat_long.csv
+        cache_path: string, optional
+            defaults to source_path + '.pkl'
+        '''
+        self.source_path = source_path
+        self.cache_path = cache_path or source_path + '.pkl'
+        self.df = self.load()
+
+        # SITE_ID -> first row of the site. A few sites list more than one
+        # IGBP class, all rows are kept in self.df.
+        self.positions = {}
+        for position, site_id in enumerate(self.df['SITE_ID'].to_numpy()):
+            self.positions.setdefault(site_id, position)
+        self.latitudes = self.df['LATITUDE'].to_numpy(dtype='float64')
+        self.longitudes = self.df['LONGITUDE'].to_numpy(dtype='float64')
+
+
+    def source_fingerprint(self, with_hash=False):
+        stat = os.stat(self.source_path)
+        fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        if with_hash:
+            fingerprint['sha256'] = ingest_state.file_hash(self.source_path)
+        return fingerprint
+
+
+    def load(self):
+        '''
+        Returns the cached table, rebuilding the cache when the source changed
+        '''
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path, 'rb') as file:
+                cached = pickle.load(file)
+            fingerprint = self.source_fingerprint()
+            source = cached['source']
+            if source['size'] == fingerprint['size'] and source['mtime'] == fingerprint['mtime']:
+                return cached['df']
+            # touched but maybe not modified, compare contents before parsing again
+            fingerprint = self.source_fingerprint(with_hash=True)
+            if source['sha256'] == fingerprint['sha256']:
+                self.save(cached['df'], fingerprint)
+                return cached['df']
+
+        df = self.parse()
+        self.save(df, self.source_fingerprint(with_hash=True))
+        return df
+
+
+    def parse(self):
+        '''
+        Reads the source into a typed table
+        '''
+        if self.source_path.endswith('.csv'):
+            df = pd.read_csv(self.source_path, usecols=self.COLUMNS)
+        else:
+            df = lulc_lat_long_file(self.source_path, []).build()[self.COLUMNS]
+        df = df.astype({'SITE_ID': 'category', 'LULC': 'category',
+                        'LATITUDE': 'float64', 'LONGITUDE': 'float64', 'ELEVATION': 'float64'})
+        return df.reset_index(drop=True)
+
+
+    def save(self, df, fingerprint):
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump({'source': fingerprint, 'df': df}, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.cache_path)
+
+
+    def lookup(self, site_id):
+        '''
+        Metadata of one site as a dict, or None when the site is unknown
+        '''
+        position = self.positions.get(site_id)
+        if position is None:
+            return None
+        return self.df.iloc[position].to_dict()
+
+
+    def lookup_many(self, site_ids):
+        '''
+        Metadata rows for a list of sites, in the order given. Unknown sites
+        are left out.
+        '''
+        positions = [self.positions[site_id] for site_id in site_ids if site_id in self.positions]
+        return self.df.iloc[positions].reset_index(drop=True)
+
+
+    def by_lulc(self, *lulc):
+        '''
+        All sites with one of the given IGBP classes (e.g. 'GRA', 'ENF')
+        '''
+        return self.df[self.df['LULC'].isin(lulc).to_numpy()].reset_index(drop=True)
+
+
+    def within_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        '''
+        All sites inside a longitude/latitude bounding box
+        '''
+        mask = ((self.longitudes >= min_lon) & (self.longitudes <= max_lon) &
+                (self.latitudes >= min_lat) & (self.latitudes <= max_lat))
+        return self.df[mask].reset_index(drop=True)
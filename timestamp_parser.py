@@ -0,0 +1,59 @@
+'''
+AmeriFlux timestamps (TIMESTAMP_START, TIMESTAMP_END) are fixed
+YYYYMMDDHHMM integers, so there is nothing to infer. Reading them as int64
+and splitting the digits with integer arithmetic is much cheaper than
+letting pandas guess the format and then building python date objects.
+'''
+import numpy as np
+import pandas as pd
+
+
+def days_from_civil(year, month, day):
+    '''
+    Days since 1970-01-01 for arrays of year, month and day
+    (Howard Hinnant's days_from_civil, vectorized).
+    '''
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def to_days(timestamps):
+    '''
+    timestamps: array-like of YYYYMMDDHHMM integers
+
+    Returns a datetime64[D] array with the day of each timestamp.
+    '''
+    ymd = np.asarray(timestamps, dtype='int64') // 10000
+    year = ymd // 10000
+    month = ymd // 100 % 100
+    day = ymd % 100
+    return days_from_civil(year, month, day).astype('datetime64[D]')
+
+
+def day_start(timestamp):
+    '''
+    The YYYYMMDDHHMM integer of midnight on the day of timestamp
+    '''
+    return int(timestamp) // 10000 * 10000
+
+
+def eight_day_buckets(dates):
+    '''
+    dates: datetime64[D] array
+
+    Splits each year into 8 day groups starting on January 1st, the same
+    way the MOD15 composites are cut. Returns a DataFrame with the year,
+    the day_group (0-45) and the first day of the group (datetime64[D]).
+    '''
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    jan_1 = dates.astype('datetime64[Y]').astype('datetime64[D]')
+    day_group = (dates - jan_1).astype('int64') // 8
+    return pd.DataFrame({
+        'year': dates.astype('datetime64[Y]').astype('int64') + 1970,
+        'day_group': day_group,
+        'DAY_GROUP_START': jan_1 + (day_group * 8).astype('timedelta64[D]'),
+    })